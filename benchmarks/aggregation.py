@@ -0,0 +1,181 @@
+"""
+Microbenchmarks of the aggregation hot loops, with upstream and Mongo out of
+the picture: the synthetic payload is built in memory and every case calls
+the same functions the services use on it.
+
+    python -m benchmarks.aggregation --categories 20 --items 5000 --output base.json
+    python -m benchmarks.aggregation --categories 20 --items 5000 --compare base.json
+
+Run from the repository root. Results are printed (and optionally written)
+as JSON keyed by case name; `--compare` reports the median ratio against an
+earlier run and exits with status 1 when any case got slower than
+`--threshold`.
+"""
+import argparse
+import json
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from datetime import date, datetime, timedelta
+
+from benchmarks.synthetic import make_budgets, make_categories, rollup_entries
+from services.aggregation import HAS_NUMPY, DailyTotalsBuilder, daily_totals, to_columns
+from services.category_stream import HAS_IJSON, CategoriesStreamParser, fold_categories
+from services.monthly_service import MonthlyService
+from services.rollup_service import rollup_fingerprint, spent_by_date
+
+
+def _git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _bench(fn, repeat: int, number: int) -> dict:
+    fn()  # warm up
+    runs = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for _ in range(number):
+            fn()
+        runs.append((time.perf_counter() - started) / number * 1000)
+    return {
+        "min_ms": round(min(runs), 4),
+        "median_ms": round(statistics.median(runs), 4),
+        "mean_ms": round(statistics.fmean(runs), 4),
+        "repeat": repeat,
+        "number": number,
+    }
+
+
+def build_cases(args):
+    end = datetime(2025, 12, 31, 23, 59, 59)
+    categories = make_categories(
+        args.categories, args.items, args.days, args.malformed, end=end, seed=args.seed,
+        bad_timestamps=args.bad_timestamps, aware=args.aware,
+    )
+    budgets = make_budgets(args.categories, seed=args.seed)
+    body = json.dumps(categories).encode("utf-8")
+
+    cols = to_columns(categories)
+    totals = daily_totals(cols)
+    entries = rollup_entries(cols.category_ids, totals)
+    category_list = [{"category_id": i, "name": n} for i, n in zip(cols.category_ids, cols.category_names)]
+
+    open_since = (end - timedelta(days=2)).date()
+    month_entries = [e for e in entries if e["date"].startswith("2025-12")]
+    week_keys = [(date(2025, 12, 25) + timedelta(days=i)).isoformat() for i in range(7)]
+    week_entries = [e for e in entries if week_keys[0] <= e["date"] <= week_keys[-1]]
+    year_months = [f"2025-{m:02d}" for m in range(1, 13)]
+    year_entries = [e for e in entries if e["date"].startswith("2025")]
+    monthly = MonthlyService()
+
+    def stream_parse():
+        builder = DailyTotalsBuilder()
+        parser = CategoriesStreamParser(builder)
+        for i in range(0, len(body), 65536):
+            parser.feed(body[i:i + 65536])
+        parser.close()
+        return builder.totals()
+
+    # the rows and fingerprints MonthlyService writes, without the Mongo round trips
+    def monthly_document():
+        return monthly._month_documents(category_list, ["2025-12"], month_entries, [budgets], {})
+
+    def weekly_document():
+        fingerprint = rollup_fingerprint(category_list, week_entries, week_keys)
+        spent = spent_by_date(week_entries)
+        return fingerprint, [{"date": k, "spent": spent.get(k, 0.0)} for k in week_keys]
+
+    def batch_year():
+        return monthly._month_documents(category_list, year_months, year_entries, [budgets] * 12, {})
+
+    cases = {
+        "to_columns": lambda: to_columns(categories),
+        "daily_totals.full": lambda: daily_totals(cols),
+        "daily_totals.open_days": lambda: daily_totals(cols, open_since),
+        "rollup.fold_parsed": lambda: fold_categories(DailyTotalsBuilder(), categories).totals(),
+        "monthly.document": monthly_document,
+        "weekly.document": weekly_document,
+        "monthly.batch_12": batch_year,
+    }
+    if HAS_IJSON:
+        cases["rollup.stream_parse"] = stream_parse
+
+    info = {
+        "items": len(cols),
+        "payload_bytes": len(body),
+        "rollup_entries": len(entries),
+        "month_entries": len(month_entries),
+    }
+    return cases, info
+
+
+def compare(results: dict, baseline_path: str, threshold: float) -> bool:
+    with open(baseline_path) as f:
+        baseline = json.load(f)["results"]
+    regressed = False
+    for name, current in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        ratio = current["median_ms"] / base["median_ms"] if base["median_ms"] else float("inf")
+        current["baseline_median_ms"] = base["median_ms"]
+        current["ratio"] = round(ratio, 3)
+        if ratio > threshold:
+            current["regression"] = True
+            regressed = True
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Aggregation microbenchmarks.")
+    parser.add_argument("--categories", type=int, default=20)
+    parser.add_argument("--items", type=int, default=2000, help="items per category")
+    parser.add_argument("--days", type=int, default=730, help="date spread of the items")
+    parser.add_argument("--malformed", type=float, default=0.01, help="fraction of bad prices/quantities")
+    parser.add_argument("--bad-timestamps", type=float, default=0.01, help="fraction of bad created_at")
+    parser.add_argument("--aware", type=float, default=0.0, help="fraction of created_at with an offset")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--number", type=int, default=3, help="calls per timed run")
+    parser.add_argument("--only", help="comma separated case names")
+    parser.add_argument("--output", help="also write the JSON result to this file")
+    parser.add_argument("--compare", help="JSON result of an earlier run")
+    parser.add_argument("--threshold", type=float, default=1.15, help="median ratio counted as a regression")
+    args = parser.parse_args()
+
+    cases, info = build_cases(args)
+    if args.only:
+        wanted = set(args.only.split(","))
+        cases = {k: v for k, v in cases.items() if k in wanted}
+
+    results = {name: _bench(fn, args.repeat, args.number) for name, fn in cases.items()}
+    regressed = compare(results, args.compare, args.threshold) if args.compare else False
+
+    report = {
+        "benchmark": "aggregation",
+        "revision": _git_revision(),
+        "python": platform.python_version(),
+        "numpy": HAS_NUMPY,
+        "ijson": HAS_IJSON,
+        "params": {k: v for k, v in vars(args).items() if k not in ("output", "compare", "only")},
+        "dataset": info,
+        "results": results,
+    }
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    if regressed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""
+Local stand-in for the category-budget service, used by the load test.
+
+Serves `GET /{user_id}/categories` and `GET /{user_id}/budgets` from a
+synthetic payload (the same for every user) with configurable latency,
+payload size and error rate, and answers `If-None-Match` with 304 like the
+real service behind a cache would. Configuration comes from the environment
+so it can be started with any ASGI server:
+
+    STUB_LATENCY_MS=40 STUB_ITEMS=500 uvicorn benchmarks.category_budget_stub:app --port 8002
+"""
+import asyncio
+import hashlib
+import json
+import os
+import random
+
+from fastapi import FastAPI, Request, Response
+
+from benchmarks.synthetic import make_budgets, make_categories
+
+STUB_LATENCY_MS = float(os.getenv("STUB_LATENCY_MS", "20"))
+STUB_JITTER_MS = float(os.getenv("STUB_JITTER_MS", "10"))
+STUB_CATEGORIES = int(os.getenv("STUB_CATEGORIES", "10"))
+STUB_ITEMS = int(os.getenv("STUB_ITEMS", "200"))
+STUB_DAYS = int(os.getenv("STUB_DAYS", "365"))
+STUB_ERROR_RATE = float(os.getenv("STUB_ERROR_RATE", "0"))
+STUB_ETAG = os.getenv("STUB_ETAG", "true").lower() in ("1", "true", "yes")
+
+app = FastAPI(title="category-budget stub")
+
+_CATEGORIES = json.dumps(make_categories(STUB_CATEGORIES, STUB_ITEMS, STUB_DAYS, malformed=0.01)).encode("utf-8")
+_BUDGETS = json.dumps(make_budgets(STUB_CATEGORIES)).encode("utf-8")
+_ETAGS = {
+    "categories": f'"{hashlib.blake2b(_CATEGORIES, digest_size=8).hexdigest()}"',
+    "budgets": f'"{hashlib.blake2b(_BUDGETS, digest_size=8).hexdigest()}"',
+}
+stats = {"requests": 0, "errors": 0, "not_modified": 0}
+
+
+async def _respond(request: Request, name: str, body: bytes) -> Response:
+    stats["requests"] += 1
+    delay = STUB_LATENCY_MS + random.uniform(-STUB_JITTER_MS, STUB_JITTER_MS)
+    if delay > 0:
+        await asyncio.sleep(delay / 1000)
+    if STUB_ERROR_RATE and random.random() < STUB_ERROR_RATE:
+        stats["errors"] += 1
+        return Response(json.dumps({"detail": "stub error"}), status_code=503, media_type="application/json")
+
+    if not STUB_ETAG:
+        return Response(body, media_type="application/json")
+    etag = _ETAGS[name]
+    if request.headers.get("if-none-match") == etag:
+        stats["not_modified"] += 1
+        return Response(status_code=304, headers={"ETag": etag})
+    return Response(body, media_type="application/json", headers={"ETag": etag})
+
+
+@app.get("/health")
+async def health():
+    return {"status": "ok", "payload_bytes": len(_CATEGORIES), **stats}
+
+
+@app.get("/{user_id}/categories")
+async def categories(user_id: str, request: Request):
+    return await _respond(request, "categories", _CATEGORIES)
+
+
+@app.get("/{user_id}/budgets")
+async def budgets(user_id: str, request: Request):
+    return await _respond(request, "budgets", _BUDGETS)
@@ -0,0 +1,117 @@
+"""
+Throughput and tail latency of a running analytics service at increasing
+numbers of concurrent clients.
+
+    python -m benchmarks.concurrency --url http://localhost:8003 --users u1,u2 \
+        --route monthly --month 2025-11 --levels 50,100,250,500 --duration 15
+
+Every client keeps exactly one request in flight. Tokens are minted with
+`AuthService`, so the server must share JWT_SECRET_KEY. To measure Mongo
+rather than the in-process cache, start the server with
+ANALYTICS_CACHE_ENABLED=false. To compare against another revision, run the
+same command against a server started from a worktree of that revision
+(`git worktree add /tmp/analytics-base <rev>`). Prints one JSON document.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import time
+
+import httpx
+
+from services.auth_service import auth_service
+
+ROUTES = {
+    "monthly": ("GET", "/{user_id}/analytics/monthly?month={month}"),
+    "weekly": ("GET", "/{user_id}/analytics/weekly/last7"),
+    "monthly-recompute": ("PUT", "/{user_id}/analytics/monthly/{month}/recompute"),
+    "weekly-recompute": ("PUT", "/{user_id}/analytics/weekly/last7/recompute"),
+}
+
+
+def percentile(sorted_values, pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    idx = min(len(sorted_values) - 1, max(0, int(round(pct / 100 * len(sorted_values))) - 1))
+    return sorted_values[idx]
+
+
+async def _worker(client, requests, deadline, latencies, errors):
+    while time.perf_counter() < deadline:
+        method, path, headers = next(requests)
+        started = time.perf_counter()
+        try:
+            r = await client.request(method, path, headers=headers)
+            error = str(r.status_code) if r.status_code >= 400 else None
+        except httpx.HTTPError as e:
+            error = type(e).__name__
+        if error is None:
+            latencies.append(time.perf_counter() - started)
+        else:
+            errors[error] = errors.get(error, 0) + 1
+
+
+async def run_level(url: str, requests, concurrency: int, duration: float, warmup: float) -> dict:
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=60) as client:
+        if warmup > 0:
+            await asyncio.gather(*(
+                _worker(client, requests, time.perf_counter() + warmup, [], {}) for _ in range(concurrency)
+            ))
+
+        latencies, errors = [], {}
+        started = time.perf_counter()
+        deadline = started + duration
+        await asyncio.gather(*(
+            _worker(client, requests, deadline, latencies, errors) for _ in range(concurrency)
+        ))
+        elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "concurrency": concurrency,
+        "requests": len(latencies) + sum(errors.values()),
+        "errors": errors,
+        "rps": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+        "max_ms": round((latencies[-1] if latencies else 0) * 1000, 2),
+    }
+
+
+async def _main(args):
+    method, template = ROUTES[args.route]
+    users = args.users.split(",")
+    prepared = [
+        (method, template.format(user_id=u, month=args.month),
+         {"Authorization": f"Bearer {auth_service.create_access_token(u, 3600)}"})
+        for u in users
+    ]
+    requests = itertools.cycle(prepared)
+
+    results = []
+    for level in (int(v) for v in args.levels.split(",")):
+        results.append(await run_level(args.url, requests, level, args.duration, args.warmup))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--url", default="http://localhost:8003")
+    parser.add_argument("--users", default="u1", help="comma separated user ids")
+    parser.add_argument("--route", choices=sorted(ROUTES), default="monthly")
+    parser.add_argument("--month", default=time.strftime("%Y-%m"))
+    parser.add_argument("--levels", default="50,100,250,500", help="comma separated client counts")
+    parser.add_argument("--duration", type=float, default=15, help="seconds measured per level")
+    parser.add_argument("--warmup", type=float, default=2, help="unmeasured seconds before each level")
+    parser.add_argument("--label", help="free-form tag stored in the output, e.g. the git revision")
+    args = parser.parse_args()
+
+    results = asyncio.run(_main(args))
+    print(json.dumps({"benchmark": "concurrency", "params": vars(args), "results": results}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
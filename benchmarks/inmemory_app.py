@@ -0,0 +1,34 @@
+"""
+`server:app` backed by an in-memory MongoDB (mongomock-motor) instead of a
+real database, for load tests on a machine without MongoDB:
+
+    uvicorn benchmarks.inmemory_app:app --port 8003
+
+Numbers measured this way include no network or storage cost for Mongo, so
+use them to compare revisions of the service, not to size replicas.
+"""
+import os
+
+import pymongo
+
+try:
+    import mongomock.collection
+    from mongomock_motor import AsyncMongoMockClient
+except ImportError as e:  # pragma: no cover - only needed for this launcher
+    raise SystemExit("the in-memory backend needs `pip install mongomock-motor`") from e
+
+os.environ.setdefault("MONGODB_URI", "mongodb://in-memory")
+
+# pymongo >= 4.11 passes `sort` to bulk update builders, which mongomock
+# does not accept yet
+_add_update = mongomock.collection.BulkOperationBuilder.add_update
+
+
+def _add_update_compat(self, *args, sort=None, **kwargs):
+    return _add_update(self, *args, **kwargs)
+
+
+mongomock.collection.BulkOperationBuilder.add_update = _add_update_compat
+pymongo.AsyncMongoClient = AsyncMongoMockClient
+
+from server import app  # noqa: E402,F401
@@ -0,0 +1,256 @@
+"""
+End-to-end load test: boots the category-budget stub and the analytics
+service, then drives mixed read/generate/recompute traffic for many
+synthetic users and reports throughput, latency percentiles and error
+rates per route.
+
+    python -m benchmarks.loadtest --users 200 --clients 100 --duration 60 --workers 4 \
+        --stub-latency-ms 50 --stub-items 2000 --stub-error-rate 0.01
+    python -m benchmarks.loadtest --mongo memory --users 5 --stub-days 10
+
+`--mongo` defaults to a local MongoDB (database `analytics_loadtest`). With
+`--mongo memory` the service runs on mongomock-motor instead, whose writes
+scan the whole collection, so that mode is only good for checking the
+harness or a change end-to-end with small data; size replicas against a
+real MongoDB. `--target`/`--stub-url` point at already running instances instead of
+starting them (the target must then use the same JWT_SECRET_KEY as this
+process). Run from the repository root. Prints one JSON document.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+import httpx
+
+from benchmarks.concurrency import percentile
+from services.auth_service import auth_service
+
+OPERATIONS = {
+    "read_monthly": ("GET", "/{user_id}/analytics/monthly?month={month}", None),
+    "read_weekly": ("GET", "/{user_id}/analytics/weekly/last7", None),
+    "generate_monthly": ("POST", "/{user_id}/analytics/monthly/generate", lambda month: {"month": month}),
+    "generate_weekly": ("POST", "/{user_id}/analytics/weekly/last7/generate", None),
+    "recompute_monthly": ("PUT", "/{user_id}/analytics/monthly/{month}/recompute", None),
+    "recompute_weekly": ("PUT", "/{user_id}/analytics/weekly/last7/recompute", None),
+}
+DEFAULT_MIX = (
+    "read_monthly=50,read_weekly=20,generate_monthly=5,generate_weekly=5,"
+    "recompute_monthly=10,recompute_weekly=10"
+)
+
+
+def _parse_mix(mix: str):
+    weights = {}
+    for part in mix.split(","):
+        name, _, weight = part.partition("=")
+        if name not in OPERATIONS:
+            raise SystemExit(f"unknown operation in --mix: {name}")
+        weights[name] = float(weight or 1)
+    return list(weights), list(weights.values())
+
+
+def _start(module_app: str, port: int, env: dict, workers: int = 1) -> subprocess.Popen:
+    cmd = [sys.executable, "-m", "uvicorn", module_app, "--host", "127.0.0.1", "--port", str(port),
+           "--log-level", "warning"]
+    if workers > 1:
+        cmd += ["--workers", str(workers)]
+    return subprocess.Popen(
+        cmd, env={**os.environ, **env}, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+
+
+def _wait_ready(url: str, path: str, proc: subprocess.Popen = None, timeout: float = 60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc is not None and proc.poll() is not None:
+            raise SystemExit(f"{url} exited with status {proc.returncode} during startup")
+        try:
+            if httpx.get(f"{url}{path}", timeout=1).status_code < 500:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise SystemExit(f"{url} did not become ready in {timeout:.0f}s")
+
+
+class RouteStats:
+    def __init__(self):
+        self.latencies = []
+        self.errors = {}
+
+    def record(self, seconds: float, error: str = None):
+        if error is None:
+            self.latencies.append(seconds)
+        else:
+            self.errors[error] = self.errors.get(error, 0) + 1
+
+    def report(self, elapsed: float) -> dict:
+        lat = sorted(self.latencies)
+        failed = sum(self.errors.values())
+        total = len(lat) + failed
+        return {
+            "requests": total,
+            "rps": round(len(lat) / elapsed, 1),
+            "error_rate": round(failed / total, 4) if total else 0.0,
+            "errors": self.errors,
+            "p50_ms": round(percentile(lat, 50) * 1000, 2),
+            "p95_ms": round(percentile(lat, 95) * 1000, 2),
+            "p99_ms": round(percentile(lat, 99) * 1000, 2),
+        }
+
+
+async def _call(client, op: str, user_id: str, month: str, headers: dict, stats: dict):
+    method, template, body = OPERATIONS[op]
+    started = time.perf_counter()
+    try:
+        r = await client.request(
+            method, template.format(user_id=user_id, month=month), headers=headers,
+            json=body(month) if body else None,
+        )
+        error = str(r.status_code) if r.status_code >= 400 else None
+    except httpx.HTTPError as e:
+        error = type(e).__name__
+    stats.setdefault(op, RouteStats()).record(time.perf_counter() - started, error)
+
+
+async def _seed(client, users, tokens, month, concurrency):
+    """Generates monthly and weekly analytics for every user so reads hit documents."""
+    sem = asyncio.Semaphore(concurrency)
+    stats = {}
+
+    async def one(user_id):
+        async with sem:
+            await _call(client, "generate_monthly", user_id, month, tokens[user_id], stats)
+            await _call(client, "generate_weekly", user_id, month, tokens[user_id], stats)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(u) for u in users))
+    elapsed = time.perf_counter() - started
+    return {op: s.report(elapsed) for op, s in stats.items()}
+
+
+async def _drive(args, target: str):
+    users = [f"load-user-{i}" for i in range(args.users)]
+    tokens = {
+        u: {"Authorization": f"Bearer {auth_service.create_access_token(u, int(args.duration) + 3600)}"}
+        for u in users
+    }
+    month = args.month
+    ops, weights = _parse_mix(args.mix)
+    rnd = random.Random(args.seed)
+
+    limits = httpx.Limits(max_connections=args.clients, max_keepalive_connections=args.clients)
+    async with httpx.AsyncClient(base_url=target, limits=limits, timeout=60) as client:
+        seeding = await _seed(client, users, tokens, month, args.clients) if args.seed_users else None
+
+        stats = {}
+        deadline = time.perf_counter() + args.duration
+
+        async def worker():
+            while time.perf_counter() < deadline:
+                user_id = rnd.choice(users)
+                op = rnd.choices(ops, weights)[0]
+                await _call(client, op, user_id, month, tokens[user_id], stats)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(args.clients)))
+        elapsed = time.perf_counter() - started
+
+    total = RouteStats()
+    for s in stats.values():
+        total.latencies.extend(s.latencies)
+        for k, v in s.errors.items():
+            total.errors[k] = total.errors.get(k, 0) + v
+    return {
+        "seeding": seeding,
+        "elapsed_seconds": round(elapsed, 2),
+        "total": total.report(elapsed),
+        "routes": {op: s.report(elapsed) for op, s in sorted(stats.items())},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end load test of the analytics service.")
+    parser.add_argument("--users", type=int, default=100, help="synthetic users")
+    parser.add_argument("--clients", type=int, default=50, help="concurrent clients")
+    parser.add_argument("--duration", type=float, default=30, help="measured seconds")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="operation=weight pairs")
+    parser.add_argument("--month", default=datetime.now().strftime("%Y-%m"))
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--no-seed-users", dest="seed_users", action="store_false",
+                        help="skip generating analytics for every user before measuring")
+    parser.add_argument("--target", help="URL of a running analytics service (skips starting one)")
+    parser.add_argument("--port", type=int, default=18003)
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn workers (real Mongo only)")
+    parser.add_argument("--mongo", default="mongodb://localhost:27017", help="MongoDB URI or 'memory'")
+    parser.add_argument("--mongo-db", default="analytics_loadtest")
+    parser.add_argument("--stub-url", help="URL of a running category-budget (skips starting the stub)")
+    parser.add_argument("--stub-port", type=int, default=18002)
+    parser.add_argument("--stub-latency-ms", type=float, default=20)
+    parser.add_argument("--stub-jitter-ms", type=float, default=10)
+    parser.add_argument("--stub-categories", type=int, default=10)
+    parser.add_argument("--stub-items", type=int, default=200, help="items per category")
+    parser.add_argument("--stub-days", type=int, default=60, help="date spread of the stub's items")
+    parser.add_argument("--stub-error-rate", type=float, default=0.0)
+    parser.add_argument("--extra-env", action="append", default=[], metavar="KEY=VALUE",
+                        help="extra environment for the analytics service, e.g. ANALYTICS_CACHE_ENABLED=false")
+    args = parser.parse_args()
+
+    procs = []
+    try:
+        stub_url = args.stub_url
+        if not stub_url:
+            stub_url = f"http://127.0.0.1:{args.stub_port}"
+            procs.append(_start("benchmarks.category_budget_stub:app", args.stub_port, {
+                "STUB_LATENCY_MS": str(args.stub_latency_ms),
+                "STUB_JITTER_MS": str(args.stub_jitter_ms),
+                "STUB_CATEGORIES": str(args.stub_categories),
+                "STUB_ITEMS": str(args.stub_items),
+                "STUB_DAYS": str(args.stub_days),
+                "STUB_ERROR_RATE": str(args.stub_error_rate),
+            }))
+            _wait_ready(stub_url, "/health", procs[-1])
+
+        target = args.target
+        if not target:
+            target = f"http://127.0.0.1:{args.port}"
+            env = {
+                "CATEGORY_BUDGET_URL": stub_url,
+                "SCHEDULER_ENABLED": "false",
+                "MONGODB_DB": args.mongo_db,
+                # tokens are minted here, so the service must verify with the same key
+                "JWT_SECRET_KEY": auth_service.secret_key,
+            }
+            env.update(kv.split("=", 1) for kv in args.extra_env)
+            if args.mongo == "memory":
+                procs.append(_start("benchmarks.inmemory_app:app", args.port, env))
+            else:
+                env["MONGODB_URI"] = args.mongo
+                procs.append(_start("server:app", args.port, env, args.workers))
+            _wait_ready(target, "/openapi.json", procs[-1])
+
+        results = asyncio.run(_drive(args, target))
+        try:
+            results["stub"] = httpx.get(f"{stub_url}/health", timeout=5).json()
+        except (httpx.HTTPError, ValueError):
+            pass
+    finally:
+        for proc in procs:
+            proc.terminate()
+        for proc in procs:
+            try:
+                proc.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+
+    print(json.dumps({"benchmark": "loadtest", "params": vars(args), **results}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+"""
+Serialization time of the monthly/weekly read responses, per response, for
+documents with a growing number of category rows:
+
+- `dict.jsonable_encoder`: the previous path, a plain dict run through
+  FastAPI's jsonable_encoder and JSONResponse,
+- `model.model_dump_json`: pydantic's compiled serializer alone,
+- `model.cached_response`: a cache hit, a MonthlyResponse from the
+  analytics cache whose body was already rendered once,
+- `model.from_document+response`: a cache miss, mapping the Mongo document
+  to the model and rendering it,
+- `dict.orjson`: orjson on the plain dict, for reference when installed.
+
+    python -m benchmarks.serialization --rows 10,100,500,1000
+
+Run from the repository root. Prints one JSON document.
+"""
+import argparse
+import json
+import platform
+import random
+from datetime import datetime
+
+from bson import ObjectId
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+from benchmarks.aggregation import _bench, _git_revision
+from models.monthly_model import MonthlyResponse
+from models.weekly_model import WeeklyResponse
+from routers.router import ModelResponse
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - orjson is only a reference point
+    orjson = None
+
+
+def monthly_document(rows: int, seed: int = 0) -> dict:
+    """A `monthly_data` document as read with MONTHLY_RESPONSE_PROJECTION."""
+    rnd = random.Random(seed)
+    now = datetime(2025, 12, 31, 23, 59, 59, 123000)
+    return {
+        "_id": ObjectId(),
+        "user_id": "u1",
+        "month": "2025-12",
+        "rows": [
+            {
+                "category_id": str(ObjectId()),
+                "category_name": f"Kategorija {i} – hrana",
+                "budget": float(rnd.randrange(0, 1000)),
+                "spent": round(rnd.uniform(0, 1500), 2),
+            }
+            for i in range(rows)
+        ],
+        "created_at": now,
+        "updated_at": now,
+    }
+
+
+def weekly_document() -> dict:
+    now = datetime(2025, 12, 31, 23, 59, 59, 123000)
+    return {
+        "_id": ObjectId(),
+        "user_id": "u1",
+        "type": "last7days",
+        "days": [{"date": f"2025-12-{d:02d}", "spent": d * 3.5} for d in range(25, 32)],
+        "created_at": now,
+        "updated_at": now,
+    }
+
+
+def _legacy_monthly(doc: dict) -> dict:
+    return {
+        "monthly_id": str(doc["_id"]),
+        "user_id": doc["user_id"],
+        "month": doc["month"],
+        "rows": doc.get("rows", []),
+        "created_at": doc.get("created_at"),
+        "updated_at": doc.get("updated_at"),
+    }
+
+
+def _legacy_weekly(doc: dict) -> dict:
+    return {
+        "weekly_id": str(doc["_id"]),
+        "user_id": doc["user_id"],
+        "type": doc.get("type", "last7days"),
+        "days": doc.get("days", []),
+        "created_at": doc.get("created_at"),
+        "updated_at": doc.get("updated_at"),
+    }
+
+
+def _cases(name: str, doc: dict, legacy, model_cls):
+    result = legacy(doc)
+    model = model_cls.from_document(doc)
+    cases = {
+        f"{name}.dict.jsonable_encoder": lambda: JSONResponse(jsonable_encoder(result)).body,
+        f"{name}.model.model_dump_json": lambda: model.model_dump_json(),
+        f"{name}.model.cached_response": lambda: ModelResponse(model).body,
+        f"{name}.model.from_document+response": lambda: ModelResponse(model_cls.from_document(doc)).body,
+    }
+    if orjson is not None:
+        cases[f"{name}.dict.orjson"] = lambda: orjson.dumps(result)
+    # same wire format on both paths
+    assert json.loads(cases[f"{name}.dict.jsonable_encoder"]()) == json.loads(ModelResponse(model).body)
+    return cases, len(ModelResponse(model).body)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Read response serialization benchmark.")
+    parser.add_argument("--rows", default="10,100,500,1000", help="comma separated rows per monthly document")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--number", type=int, default=200, help="responses per timed run")
+    args = parser.parse_args()
+
+    results = {}
+    body_bytes = {}
+    for rows in (int(r) for r in args.rows.split(",")):
+        cases, size = _cases(f"monthly.{rows}", monthly_document(rows, args.seed), _legacy_monthly, MonthlyResponse)
+        body_bytes[f"monthly.{rows}"] = size
+        results.update({name: _bench(fn, args.repeat, args.number) for name, fn in cases.items()})
+    cases, size = _cases("weekly", weekly_document(), _legacy_weekly, WeeklyResponse)
+    body_bytes["weekly"] = size
+    results.update({name: _bench(fn, args.repeat, args.number) for name, fn in cases.items()})
+
+    for name, r in results.items():
+        r["per_response_us"] = round(r["median_ms"] * 1000, 1)
+
+    print(json.dumps({
+        "benchmark": "serialization",
+        "revision": _git_revision(),
+        "python": platform.python_version(),
+        "orjson": orjson is not None,
+        "params": vars(args),
+        "body_bytes": body_bytes,
+        "results": results,
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
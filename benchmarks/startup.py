@@ -0,0 +1,124 @@
+"""
+Cold-start time of the analytics service: how long `import server` takes,
+and how long a freshly spawned uvicorn needs until `/health/live` and
+`/health/ready` answer 200, for each worker count.
+
+    python -m benchmarks.startup --workers 1,2,4 --repeat 5
+    python -m benchmarks.startup --mongo memory --rabbitmq-port 1
+
+`--mongo` defaults to a local MongoDB; `memory` uses the mongomock-motor
+launcher (readiness then measures only the app itself). Pointing
+`--rabbitmq-port` at a closed port checks that a missing broker does not
+delay startup. Run from the repository root. Prints one JSON document.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+import httpx
+
+from benchmarks.loadtest import _start
+
+IMPORT_SNIPPET = (
+    "import time; started = time.perf_counter(); import server; "
+    "print(time.perf_counter() - started)"
+)
+
+
+def _summary(values):
+    values = [v for v in values if v is not None]
+    if not values:
+        return None
+    return {
+        "median_ms": round(statistics.median(values) * 1000, 1),
+        "min_ms": round(min(values) * 1000, 1),
+        "max_ms": round(max(values) * 1000, 1),
+    }
+
+
+def _import_time(env: dict) -> float:
+    out = subprocess.run(
+        [sys.executable, "-c", IMPORT_SNIPPET], env={**os.environ, **env},
+        capture_output=True, text=True, check=True,
+    )
+    return float(out.stdout.strip().splitlines()[-1])
+
+
+def _until_ok(client: httpx.Client, path: str, started: float, proc, timeout: float):
+    """Seconds from `started` until `path` answers 200, or None on timeout."""
+    deadline = started + timeout
+    while time.perf_counter() < deadline:
+        if proc.poll() is not None:
+            raise SystemExit(f"server exited with status {proc.returncode} during startup")
+        try:
+            if client.get(path).status_code == 200:
+                return time.perf_counter() - started
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.005)
+    return None
+
+
+def _boot(app: str, port: int, env: dict, workers: int, timeout: float):
+    started = time.perf_counter()
+    proc = _start(app, port, env, workers)
+    try:
+        with httpx.Client(base_url=f"http://127.0.0.1:{port}", timeout=1) as client:
+            live = _until_ok(client, "/health/live", started, proc, timeout)
+            ready = _until_ok(client, "/health/ready", started, proc, timeout) if live is not None else None
+    finally:
+        proc.terminate()
+        try:
+            proc.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+    return live, ready
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Startup time of the analytics service.")
+    parser.add_argument("--workers", default="1", help="comma separated uvicorn worker counts")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--port", type=int, default=18013)
+    parser.add_argument("--timeout", type=float, default=60, help="seconds to wait for each endpoint")
+    parser.add_argument("--mongo", default="mongodb://localhost:27017", help="MongoDB URI or 'memory'")
+    parser.add_argument("--rabbitmq-host", default=os.getenv("RABBITMQ_HOST", "localhost"))
+    parser.add_argument("--rabbitmq-port", default=os.getenv("RABBITMQ_PORT", "5672"))
+    args = parser.parse_args()
+
+    env = {
+        "SCHEDULER_ENABLED": "false",
+        "RABBITMQ_HOST": args.rabbitmq_host,
+        "RABBITMQ_PORT": str(args.rabbitmq_port),
+    }
+    if args.mongo == "memory":
+        app = "benchmarks.inmemory_app:app"
+        env["MONGODB_URI"] = "mongodb://in-memory"
+    else:
+        app = "server:app"
+        env["MONGODB_URI"] = args.mongo
+
+    imports = [_import_time(env) for _ in range(args.repeat)]
+    results = {}
+    for workers in (int(w) for w in args.workers.split(",")):
+        runs = [_boot(app, args.port, env, workers, args.timeout) for _ in range(args.repeat)]
+        results[str(workers)] = {
+            "live": _summary([live for live, _ in runs]),
+            "ready": _summary([ready for _, ready in runs]),
+            "not_ready_runs": sum(1 for _, ready in runs if ready is None),
+        }
+
+    print(json.dumps({
+        "benchmark": "startup",
+        "params": vars(args),
+        "import": _summary(imports),
+        "workers": results,
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
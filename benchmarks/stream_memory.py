@@ -0,0 +1,124 @@
+"""
+Peak memory of turning a `/{user_id}/categories` response into daily totals:
+`response.json()` + `to_columns` + `daily_totals` versus the streaming parser
+(`CategoryBudgetClient.stream_categories`).
+
+    python -m benchmarks.stream_memory --categories 20 --items 20000
+
+Run from the repository root. Peaks are measured with tracemalloc (NumPy
+buffers included) after the response body is already in memory, so they only
+cover parsing and aggregation. `p99_loop_block_ms` / `max_loop_block_ms`
+are how long the event loop could not run anything else meanwhile (gaps of a
+1 ms ticker, measured in a second run without tracemalloc), i.e. how long
+other requests of the worker wait. Prints
+one JSON document.
+"""
+import argparse
+import asyncio
+import json
+import time
+import tracemalloc
+from typing import List
+
+import httpx
+
+from benchmarks.synthetic import make_categories
+from services.aggregation import DailyTotalsBuilder, daily_totals, to_columns
+from services.category_budget_client import CATEGORY_BUDGET_STREAM_CHUNK, CategoryBudgetClient
+from services.category_stream import HAS_IJSON
+
+
+def _client(body: bytes) -> CategoryBudgetClient:
+    async def chunks():
+        view = memoryview(body)
+        for i in range(0, len(view), CATEGORY_BUDGET_STREAM_CHUNK):
+            # a socket read suspends the caller between chunks
+            await asyncio.sleep(0)
+            yield bytes(view[i:i + CATEGORY_BUDGET_STREAM_CHUNK])
+
+    def handler(request):
+        return httpx.Response(200, headers={"Content-Type": "application/json"}, content=chunks())
+
+    client = CategoryBudgetClient()
+    client._client = httpx.AsyncClient(base_url="http://category-budget", transport=httpx.MockTransport(handler))
+    return client
+
+
+async def _buffered(client: CategoryBudgetClient):
+    categories = await client.get_categories("u1")
+    return daily_totals(to_columns(categories))
+
+
+async def _streamed(client: CategoryBudgetClient):
+    builder = DailyTotalsBuilder()
+    await client.stream_categories("u1", builder)
+    return builder.totals()
+
+
+async def _blocking(client: CategoryBudgetClient, fn) -> List[float]:
+    """Sorted gaps between ticks of a 1 ms ticker while `fn` runs, in seconds."""
+    gaps = []
+
+    async def ticker():
+        last = time.perf_counter()
+        while True:
+            await asyncio.sleep(0.001)
+            now = time.perf_counter()
+            gaps.append(now - last)
+            last = now
+
+    task = asyncio.create_task(ticker())
+    await asyncio.sleep(0)
+    try:
+        await fn(client)
+        # let the ticker see the gap up to the end of `fn`
+        await asyncio.sleep(0.005)
+    finally:
+        task.cancel()
+    return sorted(gaps)
+
+
+def _measure(body: bytes, fn):
+    client = _client(body)
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    started = time.perf_counter()
+    totals = asyncio.run(fn(client))
+    seconds = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    gaps = asyncio.run(_blocking(_client(body), fn))
+    return {
+        "peak_bytes": peak, "seconds": round(seconds, 4), "entries": len(totals),
+        "p99_loop_block_ms": round(gaps[int(len(gaps) * 0.99)] * 1000, 1),
+        "max_loop_block_ms": round(gaps[-1] * 1000, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--categories", type=int, default=20)
+    parser.add_argument("--items", type=int, default=20000, help="items per category")
+    parser.add_argument("--days", type=int, default=730)
+    parser.add_argument("--malformed", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    body = json.dumps(
+        make_categories(args.categories, args.items, args.days, args.malformed, seed=args.seed)
+    ).encode("utf-8")
+
+    results = {"buffered": _measure(body, _buffered)}
+    if HAS_IJSON:
+        results["streamed"] = _measure(body, _streamed)
+        results["peak_ratio"] = round(results["buffered"]["peak_bytes"] / results["streamed"]["peak_bytes"], 2)
+
+    print(json.dumps({
+        "benchmark": "stream_memory",
+        "params": {**vars(args), "payload_bytes": len(body), "chunk_bytes": CATEGORY_BUDGET_STREAM_CHUNK},
+        "results": results,
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
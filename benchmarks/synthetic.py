@@ -0,0 +1,59 @@
+"""
+Synthetic category-budget payloads in the shape served by
+`GET /{user_id}/categories` and `GET /{user_id}/budgets`, plus the
+`daily_spend` rollup entries the services read back from Mongo.
+"""
+import random
+from datetime import datetime, timedelta
+from typing import List
+
+
+def make_categories(categories: int = 10, items_per_category: int = 1000, days: int = 365,
+                    malformed: float = 0.0, end: datetime = None, seed: int = 0,
+                    bad_timestamps: float = 0.0, aware: float = 0.0) -> List[dict]:
+    """
+    `categories` categories with `items_per_category` items each, spread
+    uniformly over the `days` days before `end`.
+
+    `malformed` is the fraction of items with an unparseable price or
+    quantity, `bad_timestamps` the fraction with an unparseable or missing
+    `created_at`, and `aware` the fraction of timestamps carrying a UTC offset.
+    """
+    rnd = random.Random(seed)
+    end = end or datetime.now().replace(microsecond=0)
+    span = days * 86400
+    payload = []
+    for c in range(categories):
+        items = []
+        for i in range(items_per_category):
+            created = end - timedelta(seconds=rnd.randrange(span))
+            created_at = created.isoformat()
+            if aware and rnd.random() < aware:
+                created_at += rnd.choice(("Z", "+02:00", "-05:00"))
+            item = {
+                "item_id": f"i{c}-{i}",
+                "item_name": f"item {i}",
+                "item_price": round(rnd.uniform(0.5, 200), 2),
+                "item_quantity": rnd.randint(1, 5),
+                "created_at": created_at,
+            }
+            if bad_timestamps and rnd.random() < bad_timestamps:
+                item["created_at"] = rnd.choice(("not-a-date", "", "2024-13-45T00:00:00", None))
+            if malformed and rnd.random() < malformed:
+                item[rnd.choice(("item_price", "item_quantity"))] = "n/a"
+            items.append(item)
+        payload.append({"category_id": f"cat{c}", "name": f"Category {c}", "items": items})
+    return payload
+
+
+def make_budgets(categories: int = 10, seed: int = 0) -> List[dict]:
+    rnd = random.Random(seed)
+    return [{"category_id": f"cat{c}", "limit": float(rnd.randrange(100, 2000, 50))} for c in range(categories)]
+
+
+def rollup_entries(category_ids: List[str], totals) -> List[dict]:
+    """`daily_totals` output as the documents `DailySpendRollup.window` returns."""
+    return [
+        {"category_id": category_ids[code], "date": day, "spent": spent}
+        for code, day, spent in totals
+    ]
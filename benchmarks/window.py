@@ -0,0 +1,86 @@
+"""
+Cost of answering a window of days (total, spend per category and per day)
+three ways, on the same synthetic payload:
+
+- `items.{N}`: summing every item again (`daily_totals` over the columns),
+  what a window without a rollup would have to do; the payload is already
+  parsed into columns, so download and parsing are not included,
+- `rollup.{N}`: summing the window's `daily_spend` entries, as weekly does,
+- `histogram.{N}`: prefix-sum lookups on the cached DailyHistogram,
+
+plus `histogram.build`, the one-off cost per rollup refresh.
+
+    python -m benchmarks.window --categories 20 --items 5000 --windows 7,30,90,365
+
+Run from the repository root. Prints one JSON document.
+"""
+import argparse
+import json
+import platform
+from datetime import datetime, timedelta
+
+from benchmarks.aggregation import _bench, _git_revision
+from benchmarks.synthetic import make_categories, rollup_entries
+from services.aggregation import daily_totals, to_columns
+from services.histogram import DailyHistogram
+from services.rollup_service import spent_by_category, spent_by_date
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rolling window analytics benchmark.")
+    parser.add_argument("--categories", type=int, default=20)
+    parser.add_argument("--items", type=int, default=5000, help="items per category")
+    parser.add_argument("--days", type=int, default=730, help="days the items are spread over")
+    parser.add_argument("--windows", default="7,30,90,365", help="comma separated window lengths in days")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--number", type=int, default=20)
+    args = parser.parse_args()
+
+    end = datetime(2025, 12, 31, 23, 59, 59)
+    categories = make_categories(args.categories, args.items, args.days, end=end, seed=args.seed)
+    cols = to_columns(categories)
+    entries = rollup_entries(cols.category_ids, daily_totals(cols))
+    histogram = DailyHistogram.from_entries(entries)
+    stop = end.date() + timedelta(days=1)
+
+    results = {"histogram.build": _bench(lambda: DailyHistogram.from_entries(entries), args.repeat, 1)}
+    for days in (int(d) for d in args.windows.split(",")):
+        start = stop - timedelta(days=days)
+
+        def items():
+            totals = daily_totals(cols, start)
+            return rollup_entries(cols.category_ids, totals)
+
+        # Mongo's range query does this part
+        window = [e for e in entries if start.isoformat() <= e["date"] < stop.isoformat()]
+
+        def rollup():
+            return spent_by_date(window), spent_by_category(window)
+
+        def prefix_sums():
+            return histogram.total(start, stop), histogram.by_category(start, stop), histogram.daily(start, stop)
+
+        # same answer on every path
+        by_day, by_cat = rollup()
+        hist_total, hist_by_cat, hist_days = prefix_sums()
+        assert abs(sum(by_day.values()) - hist_total) < 1e-6 * max(1.0, hist_total)
+        assert all(abs(by_cat.get(c, 0.0) - s) < 1e-6 * max(1.0, s) for c, s in hist_by_cat.items())
+        assert len(hist_days) == days
+
+        results[f"items.{days}"] = _bench(items, args.repeat, max(1, args.number // 10))
+        results[f"rollup.{days}"] = _bench(rollup, args.repeat, args.number)
+        results[f"histogram.{days}"] = _bench(prefix_sums, args.repeat, args.number * 10)
+
+    print(json.dumps({
+        "benchmark": "window",
+        "revision": _git_revision(),
+        "python": platform.python_version(),
+        "params": vars(args),
+        "info": {"items": len(cols), "rollup_entries": len(entries), "histogram_days": histogram.days},
+        "results": results,
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,19 +1,136 @@
+import asyncio
+import logging
 import os
+import time
+from datetime import datetime
+from typing import Optional
 from dotenv import load_dotenv
-from pymongo import MongoClient
+from pymongo import ASCENDING, AsyncMongoClient
+from pymongo.errors import ConnectionFailure, PyMongoError
 import certifi
+from services.metrics import mongo_event_listeners
 
 load_dotenv()
 
 MONGODB_URI = os.getenv("MONGODB_URI")
 MONGODB_DB = os.getenv("MONGODB_DB", "analytics_db")
+MONGODB_CONNECT_TIMEOUT_MS = int(os.getenv("MONGODB_CONNECT_TIMEOUT_MS", "5000"))
+MONGODB_SERVER_SELECTION_TIMEOUT_MS = int(os.getenv("MONGODB_SERVER_SELECTION_TIMEOUT_MS", "5000"))
 
-if not MONGODB_URI:
-    raise RuntimeError("MONGODB_URI ni najden/ga ni brat")
+_client: Optional[AsyncMongoClient] = None
+_client_pid: Optional[int] = None
+indexes_ready = False
 
-client = MongoClient(MONGODB_URI, tlsCAFile=certifi.where())
-db = client[MONGODB_DB]
+INDEXES = {
+    "monthly_data": [
+        ([("user_id", ASCENDING), ("month", ASCENDING)], {"name": "user_month_unique", "unique": True}),
+    ],
+    "weekly_data": [
+        ([("user_id", ASCENDING), ("type", ASCENDING)], {"name": "user_type_unique", "unique": True}),
+    ],
+    "window_data": [
+        (
+            [("user_id", ASCENDING), ("window", ASCENDING), ("category_id", ASCENDING)],
+            {"name": "user_window_category_unique", "unique": True},
+        ),
+    ],
+    "daily_spend": [
+        (
+            [("user_id", ASCENDING), ("date", ASCENDING), ("category_id", ASCENDING)],
+            {"name": "user_date_category_unique", "unique": True},
+        ),
+    ],
+    "daily_spend_state": [
+        ([("user_id", ASCENDING)], {"name": "user_unique", "unique": True}),
+    ],
+    "analytics_event_state": [
+        ([("user_id", ASCENDING)], {"name": "user_unique", "unique": True}),
+    ],
+    "upstream_cache_invalidations": [
+        ([("user_id", ASCENDING)], {"name": "user_unique", "unique": True}),
+    ],
+}
+
+
+def get_client() -> AsyncMongoClient:
+    """
+    The process's Mongo client, created on first use. Nothing connects at
+    import, and a process forked after the parent created its client gets
+    its own instead of sharing the parent's sockets.
+    """
+    global _client, _client_pid
+    if _client is None or _client_pid != os.getpid():
+        if not MONGODB_URI:
+            raise RuntimeError("MONGODB_URI ni najden/ga ni brat")
+        _client = AsyncMongoClient(
+            MONGODB_URI,
+            tlsCAFile=certifi.where(),
+            event_listeners=mongo_event_listeners(),
+            connectTimeoutMS=MONGODB_CONNECT_TIMEOUT_MS,
+            serverSelectionTimeoutMS=MONGODB_SERVER_SELECTION_TIMEOUT_MS,
+        )
+        _client_pid = os.getpid()
+    return _client
 
 
 def get_db():
-    return db
+    return get_client()[MONGODB_DB]
+
+
+async def ensure_indexes() -> bool:
+    """
+    Creates the indexes the services query by. Safe to call on every startup;
+    a failure (e.g. existing duplicates blocking a unique index) is logged and
+    does not stop the service. Returns False if Mongo could not be reached,
+    so the caller can try again later.
+    """
+    global indexes_ready
+    logger = logging.getLogger("soa-analytics")
+    db = get_db()
+    failed = False
+    for collection, indexes in INDEXES.items():
+        for keys, options in indexes:
+            try:
+                await db[collection].create_index(keys, **options)
+            except ConnectionFailure as e:
+                logger.warning("MongoDB unreachable, indexes not ensured yet", extra={"detail": str(e)})
+                return False
+            except PyMongoError as e:
+                failed = True
+                logger.error(
+                    "Failed to create index",
+                    extra={"detail": f"{collection}.{options['name']}: {e}"},
+                )
+    indexes_ready = not failed
+    return True
+
+
+async def ensure_indexes_until_reachable(max_delay: float = 60.0):
+    """ensure_indexes, retried with backoff while Mongo is unreachable."""
+    delay = 1.0
+    while not await ensure_indexes():
+        await asyncio.sleep(delay)
+        delay = min(max_delay, delay * 2)
+
+
+async def ping_db(timeout: float) -> dict:
+    """Round-trips a `ping` for the readiness check; never raises."""
+    started = time.perf_counter()
+    try:
+        await asyncio.wait_for(get_db().command("ping"), timeout)
+    except (PyMongoError, asyncio.TimeoutError, RuntimeError) as e:
+        return {"ok": False, "error": str(e) or type(e).__name__}
+    return {"ok": True, "latency_ms": round((time.perf_counter() - started) * 1000, 2)}
+
+
+async def close_db():
+    global _client, _client_pid
+    if _client is not None and _client_pid == os.getpid():
+        await _client.close()
+    _client = _client_pid = None
+
+
+def mongo_now() -> datetime:
+    """datetime.now() truncated to the millisecond precision BSON stores."""
+    now = datetime.now()
+    return now.replace(microsecond=now.microsecond // 1000 * 1000)
@@ -2,7 +2,10 @@ import contextvars
 import json
 import logging
 import os
+import random
+import threading
 import time
+from collections import deque
 from datetime import datetime, timezone
 from typing import Optional
 from uuid import uuid4
@@ -15,12 +18,18 @@ correlation_id_var: contextvars.ContextVar[Optional[str]] = contextvars.ContextV
 
 _logger: Optional[logging.Logger] = None
 _service_name: Optional[str] = None
+_rabbit_handler: Optional["RabbitMQHandler"] = None
+_rabbit_pid: Optional[int] = None
 
 
 def get_correlation_id() -> Optional[str]:
     return correlation_id_var.get()
 
 
+DROP_OLDEST = "drop_oldest"
+DROP_NEWEST = "drop_newest"
+
+
 def _rabbit_config():
     return {
         "host": os.getenv("RABBITMQ_HOST", "localhost"),
@@ -30,10 +39,31 @@ def _rabbit_config():
         "exchange": os.getenv("RABBITMQ_EXCHANGE", "logs-exchange"),
         "queue": os.getenv("RABBITMQ_QUEUE", "logs-queue"),
         "routing_key": os.getenv("RABBITMQ_ROUTING_KEY", "logs.route"),
+        "heartbeat": int(os.getenv("RABBITMQ_HEARTBEAT", "30")),
+        "connect_timeout": float(os.getenv("RABBITMQ_CONNECT_TIMEOUT", "3")),
+        "queue_size": int(os.getenv("RABBITMQ_LOG_QUEUE_SIZE", "10000")),
+        "batch_size": int(os.getenv("RABBITMQ_LOG_BATCH_SIZE", "100")),
+        "flush_interval": float(os.getenv("RABBITMQ_LOG_FLUSH_INTERVAL", "0.5")),
+        "flush_timeout": float(os.getenv("RABBITMQ_LOG_FLUSH_TIMEOUT", "5")),
+        "drop_policy": os.getenv("RABBITMQ_LOG_DROP_POLICY", DROP_OLDEST),
+        "max_backoff": float(os.getenv("RABBITMQ_RECONNECT_MAX_BACKOFF", "30")),
     }
 
 
+class _PublishError(Exception):
+    """A publish failed part-way through a batch; the rest is already requeued."""
+
+
 class RabbitMQHandler(logging.Handler):
+    """
+    Publishes log records to RabbitMQ without blocking the caller.
+
+    emit() only serializes the record and appends it to a bounded in-memory
+    queue; a background thread owns the connection, publishes in batches and
+    reconnects with exponential backoff. When the queue is full the configured
+    drop policy discards either the oldest queued record or the new one.
+    """
+
     def __init__(self, service_name: str):
         super().__init__()
         cfg = _rabbit_config()
@@ -42,15 +72,35 @@ class RabbitMQHandler(logging.Handler):
             host=cfg["host"],
             port=cfg["port"],
             credentials=credentials,
-            heartbeat=0,
+            heartbeat=cfg["heartbeat"],
+            socket_timeout=cfg["connect_timeout"],
+            blocked_connection_timeout=cfg["connect_timeout"],
+            connection_attempts=1,
         )
         self.exchange = cfg["exchange"]
         self.queue = cfg["queue"]
         self.routing_key = cfg["routing_key"]
         self.service_name = service_name
+        self.queue_size = cfg["queue_size"]
+        self.batch_size = cfg["batch_size"]
+        self.flush_interval = cfg["flush_interval"]
+        self.flush_timeout = cfg["flush_timeout"]
+        self.drop_policy = cfg["drop_policy"]
+        self.max_backoff = cfg["max_backoff"]
         self.connection = None
         self.channel = None
-        self._connect()
+
+        self.published = 0
+        self.dropped = 0
+        self.publish_errors = 0
+
+        self._buffer = deque()
+        self._cond = threading.Condition()
+        self._closing = False
+        self._thread = threading.Thread(
+            target=self._run, name="rabbitmq-log-publisher", daemon=True
+        )
+        self._thread.start()
 
     def _connect(self):
         if self.connection and getattr(self.connection, "is_open", False):
@@ -65,37 +115,150 @@ class RabbitMQHandler(logging.Handler):
             queue=self.queue, exchange=self.exchange, routing_key=self.routing_key
         )
 
+    def _disconnect(self):
+        try:
+            if self.connection and self.connection.is_open:
+                self.connection.close()
+        except Exception:
+            pass
+        self.connection = None
+        self.channel = None
+
+    def _serialize(self, record: logging.LogRecord) -> bytes:
+        correlation_id = getattr(record, "correlation_id", None) or get_correlation_id()
+        url = getattr(record, "url", "") or getattr(record, "path", "")
+        timestamp = datetime.now(timezone.utc).isoformat()
+        payload = {
+            "timestamp": timestamp,
+            "level": record.levelname,
+            "message": record.getMessage(),
+            "service": self.service_name,
+            "correlation_id": correlation_id,
+            "url": url,
+            "method": getattr(record, "method", ""),
+            "status_code": getattr(record, "status_code", None),
+        }
+        profile = getattr(record, "profile", None)
+        if profile is not None:
+            payload["profile"] = profile
+        payload["formatted"] = (
+            f"{timestamp} {record.levelname} {url} "
+            f"Correlation:{correlation_id or '-'} [{self.service_name}] - {payload['message']}"
+        )
+        return json.dumps(payload).encode("utf-8")
+
     def emit(self, record: logging.LogRecord):
         try:
-            self._connect()
-            correlation_id = getattr(record, "correlation_id", None) or get_correlation_id()
-            url = getattr(record, "url", "") or getattr(record, "path", "")
-            timestamp = datetime.now(timezone.utc).isoformat()
-            payload = {
-                "timestamp": timestamp,
-                "level": record.levelname,
-                "message": record.getMessage(),
-                "service": self.service_name,
-                "correlation_id": correlation_id,
-                "url": url,
-                "method": getattr(record, "method", ""),
-                "status_code": getattr(record, "status_code", None),
-            }
-            payload["formatted"] = (
-                f"{timestamp} {record.levelname} {url} "
-                f"Correlation:{correlation_id or '-'} [{self.service_name}] - {payload['message']}"
-            )
-            body = json.dumps(payload).encode("utf-8")
-            self.channel.basic_publish(
-                exchange=self.exchange,
-                routing_key=self.routing_key,
-                body=body,
-                properties=pika.BasicProperties(
-                    content_type="application/json", delivery_mode=2
-                ),
-            )
+            body = self._serialize(record)
         except Exception:
             self.handleError(record)
+            return
+
+        with self._cond:
+            if self._closing:
+                self.dropped += 1
+                return
+            if len(self._buffer) >= self.queue_size:
+                self.dropped += 1
+                if self.drop_policy == DROP_NEWEST:
+                    return
+                self._buffer.popleft()
+            self._buffer.append(body)
+            if len(self._buffer) >= self.batch_size:
+                self._cond.notify()
+
+    def _take_batch(self):
+        with self._cond:
+            if not self._buffer and not self._closing:
+                self._cond.wait(self.flush_interval)
+            batch = []
+            while self._buffer and len(batch) < self.batch_size:
+                batch.append(self._buffer.popleft())
+            return batch
+
+    def _requeue(self, bodies):
+        with self._cond:
+            for body in reversed(bodies):
+                if len(self._buffer) >= self.queue_size:
+                    # the queue filled up while we were disconnected; the
+                    # unsent bodies are the oldest records
+                    self.dropped += 1
+                    continue
+                self._buffer.appendleft(body)
+
+    def _publish(self, batch):
+        properties = pika.BasicProperties(content_type="application/json", delivery_mode=2)
+        for i, body in enumerate(batch):
+            try:
+                self.channel.basic_publish(
+                    exchange=self.exchange,
+                    routing_key=self.routing_key,
+                    body=body,
+                    properties=properties,
+                )
+            except Exception as e:
+                self._requeue(batch[i:])
+                raise _PublishError() from e
+            self.published += 1
+
+    def _run(self):
+        backoff = 0.0
+        while True:
+            batch = self._take_batch()
+            if not batch:
+                if self._closing:
+                    break
+                # keep the connection's heartbeats serviced while idle
+                if self.connection is not None:
+                    try:
+                        self.connection.process_data_events(time_limit=0)
+                    except Exception:
+                        self._disconnect()
+                continue
+
+            try:
+                self._connect()
+                self._publish(batch)
+                backoff = 0.0
+                continue
+            except Exception as e:
+                if not isinstance(e, _PublishError):
+                    self._requeue(batch)
+                self.publish_errors += 1
+                self._disconnect()
+
+            if self._closing:
+                break
+            backoff = min(self.max_backoff, backoff * 2 or 0.5)
+            time.sleep(backoff * random.uniform(0.5, 1.0))
+
+        self._disconnect()
+
+    def flush(self, timeout: Optional[float] = None):
+        """Waits until the queue is drained or `timeout` seconds pass."""
+        deadline = time.monotonic() + (self.flush_timeout if timeout is None else timeout)
+        with self._cond:
+            self._cond.notify()
+        while self._buffer and self._thread.is_alive() and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def close(self):
+        if not self._closing:
+            self.flush()
+            with self._cond:
+                self._closing = True
+                self._cond.notify()
+            self._thread.join(self.flush_timeout)
+        super().close()
+
+    def stats(self):
+        return {
+            "connected": bool(self.connection is not None and getattr(self.connection, "is_open", False)),
+            "queued": len(self._buffer),
+            "published": self.published,
+            "dropped": self.dropped,
+            "publish_errors": self.publish_errors,
+        }
 
 
 def setup_logging(service_name: str) -> logging.Logger:
@@ -124,15 +287,50 @@ def setup_logging(service_name: str) -> logging.Logger:
     stream_handler.setFormatter(formatter)
     logger.addHandler(stream_handler)
 
+    _logger = logger
+    return logger
+
+
+def start_log_shipping() -> Optional["RabbitMQHandler"]:
+    """
+    Attaches the RabbitMQ handler (and its publisher thread) to the service
+    logger in the current process. Call it from the app lifespan, i.e. in
+    each worker after any fork; a handler inherited from a parent process is
+    replaced, since its thread did not survive the fork.
+    """
+    global _rabbit_handler, _rabbit_pid
+    logger = get_logger()
+    if _rabbit_handler is not None:
+        if _rabbit_pid == os.getpid():
+            return _rabbit_handler
+        logger.removeHandler(_rabbit_handler)
+        _rabbit_handler = None
     try:
-        rabbit_handler = RabbitMQHandler(service_name)
-        rabbit_handler.setFormatter(formatter)
-        logger.addHandler(rabbit_handler)
+        handler = RabbitMQHandler(_service_name or logger.name)
     except Exception as e:
         logger.error("Failed to initialize RabbitMQ logger: %s", e)
+        return None
+    if logger.handlers:
+        handler.setFormatter(logger.handlers[0].formatter)
+    logger.addHandler(handler)
+    _rabbit_handler, _rabbit_pid = handler, os.getpid()
+    return handler
+
+
+def stop_log_shipping():
+    """Flushes and detaches the RabbitMQ handler of this process."""
+    global _rabbit_handler, _rabbit_pid
+    if _rabbit_handler is None or _rabbit_pid != os.getpid():
+        return
+    get_logger().removeHandler(_rabbit_handler)
+    _rabbit_handler.close()
+    _rabbit_handler = _rabbit_pid = None
 
-    _logger = logger
-    return logger
+
+def log_shipping_stats() -> Optional[dict]:
+    if _rabbit_handler is None or _rabbit_pid != os.getpid():
+        return None
+    return _rabbit_handler.stats()
 
 
 def get_logger() -> logging.Logger:
@@ -143,9 +341,19 @@ def get_logger() -> logging.Logger:
     return logging.getLogger()
 
 
-def init_request_logging(app, service_name: str):
+def _route_template(request) -> str:
+    route = request.scope.get("route")
+    return getattr(route, "path", None) or "unmatched"
+
+
+def init_request_logging(app, service_name: str, on_request=None, profiler=None):
     """
     Registers middleware for correlation IDs and request logging.
+    `on_request(method, route, status_code, seconds)` is called for every
+    request, with the route template (not the raw path) as `route`.
+    With a `profiler` (services.profiling.RequestProfiler) the requests it
+    selects get a timing breakdown in the `profile` field of their log
+    record; without one the middleware does no profiling work at all.
     """
     logger = setup_logging(service_name)
 
@@ -155,36 +363,43 @@ def init_request_logging(app, service_name: str):
         correlation_id_var.set(correlation_id)
         request.state.correlation_id = correlation_id
 
+        profile = profiler.select(request) if profiler is not None else None
         start = time.perf_counter()
         try:
             response = await call_next(request)
         except Exception:
             elapsed = time.perf_counter() - start
-            logger.exception(
-                "Request failed",
-                extra={
-                    "correlation_id": correlation_id,
-                    "url": str(request.url),
-                    "path": request.url.path,
-                    "method": request.method,
-                    "status_code": 500,
-                    "duration_ms": int(elapsed * 1000),
-                },
-            )
-            raise
-
-        elapsed = time.perf_counter() - start
-        response.headers["X-Correlation-Id"] = correlation_id
-        logger.info(
-            "Request handled in %.2f ms", elapsed * 1000,
-            extra={
+            extra = {
                 "correlation_id": correlation_id,
                 "url": str(request.url),
                 "path": request.url.path,
                 "method": request.method,
-                "status_code": response.status_code,
-            },
-        )
+                "status_code": 500,
+                "duration_ms": int(elapsed * 1000),
+            }
+            if profile is not None:
+                extra["profile"] = await profiler.finish(profile, request, correlation_id)
+            logger.exception("Request failed", extra=extra)
+            if on_request:
+                on_request(request.method, _route_template(request), 500, elapsed)
+            raise
+
+        elapsed = time.perf_counter() - start
+        if on_request:
+            on_request(request.method, _route_template(request), response.status_code, elapsed)
+        response.headers["X-Correlation-Id"] = correlation_id
+        extra = {
+            "correlation_id": correlation_id,
+            "url": str(request.url),
+            "path": request.url.path,
+            "method": request.method,
+            "status_code": response.status_code,
+        }
+        if profile is not None:
+            extra["profile"] = await profiler.finish(profile, request, correlation_id)
+            if profile.by_token:
+                response.headers["Server-Timing"] = profiler.server_timing(extra["profile"])
+        logger.info("Request handled in %.2f ms", elapsed * 1000, extra=extra)
         return response
 
     return logger
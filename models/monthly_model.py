@@ -1,24 +1,35 @@
 from datetime import datetime
-from pydantic import BaseModel, field_serializer
-from typing import List
+from pydantic import BaseModel, Field
+from typing import List, Optional
+from models.response_model import ResponseModel
 
 class MonthlyGenerateRequest(BaseModel):
     month: str
 
+class MonthlyBatchGenerateRequest(BaseModel):
+    months: Optional[List[str]] = None
+    from_month: Optional[str] = Field(None, alias="from")
+    to_month: Optional[str] = Field(None, alias="to")
+
 class MonthlyRow(BaseModel):
     category_id: str
     category_name: str
     budget: float
     spent: float
 
-class MonthlyResponse(BaseModel):
+class MonthlyResponse(ResponseModel):
     monthly_id: str
     user_id: str
     month: str
-    rows: List[MonthlyRow]
-    created_at: datetime
-    updated_at: datetime
+    rows: List[MonthlyRow] = []
+    created_at: Optional[datetime] = None
+    updated_at: Optional[datetime] = None
+
+    @classmethod
+    def from_document(cls, doc: dict) -> "MonthlyResponse":
+        """Maps a `monthly_data` document read with MONTHLY_RESPONSE_PROJECTION."""
+        return cls.model_validate({**doc, "monthly_id": str(doc["_id"])})
+
 
-    @field_serializer("created_at", "updated_at", mode="plain", when_used="json")
-    def serialize_datetime(self, value: datetime) -> str:
-        return value.strftime("%Y/%m/%d %H:%M:%S")
+# only what MonthlyResponse needs; leaves out fingerprint and applied event ids
+MONTHLY_RESPONSE_PROJECTION = {"_id": 1, "user_id": 1, "month": 1, "rows": 1, "created_at": 1, "updated_at": 1}
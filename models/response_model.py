@@ -0,0 +1,14 @@
+from functools import cached_property
+from pydantic import BaseModel
+
+class ResponseModel(BaseModel):
+    """
+    Base of models returned by read endpoints. The JSON body is rendered
+    once per instance by pydantic's compiled serializer, so an instance held
+    in the analytics cache is serialized once and not on every hit.
+    Instances must not be modified after the first render.
+    """
+
+    @cached_property
+    def json_body(self) -> bytes:
+        return self.model_dump_json().encode("utf-8")
@@ -1,19 +1,25 @@
 from datetime import datetime
-from pydantic import BaseModel, field_serializer
-from typing import List
+from pydantic import BaseModel
+from typing import List, Optional
+from models.response_model import ResponseModel
 
 class WeeklyDay(BaseModel):
     date: str
     spent: float
 
-class WeeklyResponse(BaseModel):
+class WeeklyResponse(ResponseModel):
     weekly_id: str
     user_id: str
-    type: str
-    days: List[WeeklyDay]
-    created_at: datetime
-    updated_at: datetime
+    type: str = "last7days"
+    days: List[WeeklyDay] = []
+    created_at: Optional[datetime] = None
+    updated_at: Optional[datetime] = None
 
-    @field_serializer("created_at", "updated_at", mode="plain", when_used="json")
-    def serialize_datetime(self, value: datetime) -> str:
-        return value.strftime("%Y/%m/%d %H:%M:%S")
+    @classmethod
+    def from_document(cls, doc: dict) -> "WeeklyResponse":
+        """Maps a `weekly_data` document read with WEEKLY_RESPONSE_PROJECTION."""
+        return cls.model_validate({**doc, "weekly_id": str(doc["_id"])})
+
+
+# only what WeeklyResponse needs; leaves out fingerprint and applied event ids
+WEEKLY_RESPONSE_PROJECTION = {"_id": 1, "user_id": 1, "type": 1, "days": 1, "created_at": 1, "updated_at": 1}
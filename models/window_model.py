@@ -0,0 +1,43 @@
+from datetime import datetime
+from pydantic import BaseModel, Field
+from typing import List, Optional
+from models.response_model import ResponseModel
+
+class WindowGenerateRequest(BaseModel):
+    from_day: Optional[str] = Field(None, alias="from")
+    to_day: Optional[str] = Field(None, alias="to")
+    last: Optional[int] = None
+    category_id: Optional[str] = None
+
+class WindowDay(BaseModel):
+    date: str
+    spent: float
+
+class WindowCategory(BaseModel):
+    category_id: str
+    category_name: str
+    spent: float
+
+class WindowResponse(ResponseModel):
+    window_id: str
+    user_id: str
+    window: str
+    start: str
+    end: str
+    category_id: Optional[str] = None
+    spent: float = 0.0
+    days: List[WindowDay] = []
+    categories: List[WindowCategory] = []
+    created_at: Optional[datetime] = None
+    updated_at: Optional[datetime] = None
+
+    @classmethod
+    def from_document(cls, doc: dict) -> "WindowResponse":
+        """Maps a `window_data` document read with WINDOW_RESPONSE_PROJECTION."""
+        return cls.model_validate({**doc, "window_id": str(doc["_id"])})
+
+
+WINDOW_RESPONSE_PROJECTION = {
+    "_id": 1, "user_id": 1, "window": 1, "start": 1, "end": 1, "category_id": 1,
+    "spent": 1, "days": 1, "categories": 1, "created_at": 1, "updated_at": 1,
+}
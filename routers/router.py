@@ -1,15 +1,27 @@
-from fastapi import APIRouter, Path, status, HTTPException, Query, Body, Depends
-from models.monthly_model import MonthlyGenerateRequest
+from fastapi import APIRouter, Path, status, HTTPException, Query, Body, Depends, Header, Response
+from fastapi.responses import StreamingResponse
+from models.response_model import ResponseModel
+from models.monthly_model import MonthlyGenerateRequest, MonthlyBatchGenerateRequest, MonthlyResponse
+from models.weekly_model import WeeklyResponse
+from models.window_model import WindowGenerateRequest, WindowResponse
 from services.monthly_service import MonthlyService
 from services.weekly_service import WeeklyService
+from services.summary_service import SummaryService
+from services.window_service import WindowService, resolve_window
 from services.auth_service import auth_service, security
+from services.category_budget_client import category_budget_client
+from services.etag import ANALYTICS_CACHE_CONTROL, etag_matches, make_etag
+from services.profiling import phase
+from services.resilience import UpstreamUnavailableError
 
 router = APIRouter(prefix="/{user_id}/analytics", tags=["analytics"])
 
 monthly_service = MonthlyService()
 weekly_service = WeeklyService()
+summary_service = SummaryService()
+window_service = WindowService()
 
-def verify_jwt_token(user_id: str = Path(...), credentials = Depends(security)):
+async def verify_jwt_token(user_id: str = Path(...), credentials = Depends(security)):
     """
     Dependency function to verify JWT token and validate user_id.
     Returns tuple of (payload, token_string) for forwarding to other services.
@@ -19,58 +31,199 @@ def verify_jwt_token(user_id: str = Path(...), credentials = Depends(security)):
     auth_service.validate_user_id(token_user_id, user_id)
     return {"payload": payload, "token": credentials.credentials}
 
-@router.get("/monthly", status_code=status.HTTP_200_OK)
-def get_monthly(user_id: str = Path(...), month: str = Query(...), token_data = Depends(verify_jwt_token)):
+def not_modified(etag: str) -> Response:
+    return Response(
+        status_code=status.HTTP_304_NOT_MODIFIED,
+        headers={"ETag": etag, "Cache-Control": ANALYTICS_CACHE_CONTROL},
+    )
+
+def set_cache_headers(response: Response, etag: str):
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = ANALYTICS_CACHE_CONTROL
+
+class ModelResponse(Response):
+    """
+    JSON body rendered by the model's compiled pydantic serializer. Returning
+    it skips FastAPI's response_model validation and jsonable_encoder, which
+    would otherwise walk every row of the document in Python.
+    """
+    media_type = "application/json"
+
+    def render(self, content: ResponseModel) -> bytes:
+        with phase("serialization"):
+            return content.json_body
+
+def model_response(model: ResponseModel, etag: str) -> ModelResponse:
+    response = ModelResponse(model)
+    set_cache_headers(response, etag)
+    return response
+
+def window_bounds(from_day, to_day, last):
     try:
-        return monthly_service.get(user_id, month)
+        return resolve_window(from_day, to_day, last)
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
 
-@router.get("/weekly/last7", status_code=status.HTTP_200_OK)
-def get_weekly_last7(user_id: str = Path(...), token_data = Depends(verify_jwt_token)):
+def upstream_unavailable(e: UpstreamUnavailableError) -> HTTPException:
+    headers = {"Retry-After": str(max(1, round(e.retry_after)))} if e.retry_after else None
+    return HTTPException(status_code=503, detail=str(e), headers=headers)
+
+@router.get("/monthly", status_code=status.HTTP_200_OK, response_model=MonthlyResponse)
+async def get_monthly(user_id: str = Path(...), month: str = Query(...), if_none_match: str = Header(None), token_data = Depends(verify_jwt_token)):
+    try:
+        if if_none_match:
+            etag = await monthly_service.get_etag(user_id, month)
+            if etag_matches(if_none_match, etag):
+                return not_modified(etag)
+        result = await monthly_service.get(user_id, month)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return model_response(result, make_etag(result.monthly_id, result.updated_at))
+
+@router.get("/monthly/range", status_code=status.HTTP_200_OK)
+async def get_monthly_range(user_id: str = Path(...), from_month: str = Query(..., alias="from"), to_month: str = Query(..., alias="to"), totals: bool = Query(False), token_data = Depends(verify_jwt_token)):
     try:
-        return weekly_service.get_last7days(user_id)
+        chunks = await monthly_service.get_range(user_id, from_month, to_month, totals)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return StreamingResponse(chunks, media_type="application/json")
+
+@router.get("/summary/categories", status_code=status.HTTP_200_OK)
+async def get_summary_categories(user_id: str = Path(...), from_month: str = Query(..., alias="from"), to_month: str = Query(..., alias="to"), token_data = Depends(verify_jwt_token)):
+    try:
+        return await summary_service.categories(user_id, from_month, to_month)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@router.get("/summary/over-budget", status_code=status.HTTP_200_OK)
+async def get_summary_over_budget(user_id: str = Path(...), from_month: str = Query(..., alias="from"), to_month: str = Query(..., alias="to"), limit: int = Query(5), token_data = Depends(verify_jwt_token)):
+    try:
+        return await summary_service.over_budget(user_id, from_month, to_month, limit)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@router.get("/summary/trend", status_code=status.HTTP_200_OK)
+async def get_summary_trend(user_id: str = Path(...), from_month: str = Query(..., alias="from"), to_month: str = Query(..., alias="to"), token_data = Depends(verify_jwt_token)):
+    try:
+        return await summary_service.trend(user_id, from_month, to_month)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@router.get("/weekly/last7", status_code=status.HTTP_200_OK, response_model=WeeklyResponse)
+async def get_weekly_last7(user_id: str = Path(...), if_none_match: str = Header(None), token_data = Depends(verify_jwt_token)):
+    try:
+        if if_none_match:
+            etag = await weekly_service.get_last7days_etag(user_id)
+            if etag_matches(if_none_match, etag):
+                return not_modified(etag)
+        result = await weekly_service.get_last7days(user_id)
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    return model_response(result, make_etag(result.weekly_id, result.updated_at))
+
+@router.get("/window", status_code=status.HTTP_200_OK, response_model=WindowResponse)
+async def get_window(user_id: str = Path(...), from_day: str = Query(None, alias="from"), to_day: str = Query(None, alias="to"), last: int = Query(None), category_id: str = Query(None), if_none_match: str = Header(None), token_data = Depends(verify_jwt_token)):
+    start, end = window_bounds(from_day, to_day, last)
+    try:
+        if if_none_match:
+            etag = await window_service.get_etag(user_id, start, end, category_id)
+            if etag_matches(if_none_match, etag):
+                return not_modified(etag)
+        result = await window_service.get(user_id, start, end, category_id)
     except ValueError as e:
         raise HTTPException(status_code=404, detail=str(e))
+    return model_response(result, make_etag(result.window_id, result.updated_at))
 
 @router.post("/monthly/generate", status_code=status.HTTP_201_CREATED)
-def generate_monthly(user_id: str = Path(...), payload: MonthlyGenerateRequest = Body(...), token_data = Depends(verify_jwt_token)):
+async def generate_monthly(user_id: str = Path(...), payload: MonthlyGenerateRequest = Body(...), token_data = Depends(verify_jwt_token)):
+    try:
+        return await monthly_service.generate(user_id, payload.month, token_data["token"])
+    except UpstreamUnavailableError as e:
+        raise upstream_unavailable(e)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@router.post("/monthly/generate/batch", status_code=status.HTTP_201_CREATED)
+async def generate_monthly_batch(user_id: str = Path(...), payload: MonthlyBatchGenerateRequest = Body(...), token_data = Depends(verify_jwt_token)):
     try:
-        return monthly_service.generate(user_id, payload.month, token_data["token"])
+        return await monthly_service.generate_batch(
+            user_id, payload.months, payload.from_month, payload.to_month, token_data["token"]
+        )
+    except UpstreamUnavailableError as e:
+        raise upstream_unavailable(e)
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
 
 @router.post("/weekly/last7/generate", status_code=status.HTTP_201_CREATED)
-def generate_weekly_last7(user_id: str = Path(...), token_data = Depends(verify_jwt_token)):
+async def generate_weekly_last7(user_id: str = Path(...), token_data = Depends(verify_jwt_token)):
+    try:
+        return await weekly_service.generate_last7days(user_id, token_data["token"])
+    except UpstreamUnavailableError as e:
+        raise upstream_unavailable(e)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@router.post("/window/generate", status_code=status.HTTP_201_CREATED)
+async def generate_window(user_id: str = Path(...), payload: WindowGenerateRequest = Body(...), token_data = Depends(verify_jwt_token)):
+    start, end = window_bounds(payload.from_day, payload.to_day, payload.last)
     try:
-        return weekly_service.generate_last7days(user_id, token_data["token"])
+        return await window_service.generate(user_id, start, end, payload.category_id, token_data["token"])
+    except UpstreamUnavailableError as e:
+        raise upstream_unavailable(e)
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
 
 @router.put("/monthly/{month}/recompute", status_code=status.HTTP_200_OK)
-def recompute_monthly(user_id: str = Path(...), month: str = Path(...), token_data = Depends(verify_jwt_token)):
+async def recompute_monthly(user_id: str = Path(...), month: str = Path(...), token_data = Depends(verify_jwt_token)):
     try:
-        return monthly_service.generate(user_id, month, token_data["token"])
+        return await monthly_service.generate(user_id, month, token_data["token"])
+    except UpstreamUnavailableError as e:
+        raise upstream_unavailable(e)
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
 
 @router.put("/weekly/last7/recompute", status_code=status.HTTP_200_OK)
-def recompute_weekly_last7(user_id: str = Path(...), token_data = Depends(verify_jwt_token)):
+async def recompute_weekly_last7(user_id: str = Path(...), token_data = Depends(verify_jwt_token)):
+    try:
+        return await weekly_service.generate_last7days(user_id, token_data["token"])
+    except UpstreamUnavailableError as e:
+        raise upstream_unavailable(e)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@router.put("/window/recompute", status_code=status.HTTP_200_OK)
+async def recompute_window(user_id: str = Path(...), from_day: str = Query(None, alias="from"), to_day: str = Query(None, alias="to"), last: int = Query(None), category_id: str = Query(None), token_data = Depends(verify_jwt_token)):
+    start, end = window_bounds(from_day, to_day, last)
     try:
-        return weekly_service.generate_last7days(user_id, token_data["token"])
+        return await window_service.generate(user_id, start, end, category_id, token_data["token"])
+    except UpstreamUnavailableError as e:
+        raise upstream_unavailable(e)
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
 
 @router.delete("/monthly/{month}/delete", status_code=status.HTTP_200_OK)
-def delete_monthly(user_id: str = Path(...), month: str = Path(...), token_data = Depends(verify_jwt_token)):
+async def delete_monthly(user_id: str = Path(...), month: str = Path(...), token_data = Depends(verify_jwt_token)):
     try:
-        return monthly_service.delete(user_id, month)
+        return await monthly_service.delete(user_id, month)
     except ValueError as e:
         raise HTTPException(status_code=404, detail=str(e))
 
 @router.delete("/weekly/last7/delete", status_code=status.HTTP_200_OK)
-def delete_weekly_last7(user_id: str = Path(...), token_data = Depends(verify_jwt_token)):
+async def delete_weekly_last7(user_id: str = Path(...), token_data = Depends(verify_jwt_token)):
+    try:
+        return await weekly_service.delete_last7days(user_id)
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+@router.delete("/window/delete", status_code=status.HTTP_200_OK)
+async def delete_window(user_id: str = Path(...), from_day: str = Query(None, alias="from"), to_day: str = Query(None, alias="to"), last: int = Query(None), category_id: str = Query(None), token_data = Depends(verify_jwt_token)):
+    start, end = window_bounds(from_day, to_day, last)
     try:
-        return weekly_service.delete_last7days(user_id)
+        return await window_service.delete(user_id, start, end, category_id)
     except ValueError as e:
         raise HTTPException(status_code=404, detail=str(e))
+
+@router.delete("/upstream-cache", status_code=status.HTTP_200_OK)
+async def invalidate_upstream_cache(user_id: str = Path(...), token_data = Depends(verify_jwt_token)):
+    await category_budget_client.invalidate(user_id)
+    return {"message": "Upstream cache invalidated"}
@@ -1,14 +1,53 @@
-from fastapi import FastAPI
+import asyncio
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, Response
+from fastapi.encoders import jsonable_encoder
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.openapi.docs import get_swagger_ui_html
 from fastapi.openapi.utils import get_openapi
+from fastapi.responses import JSONResponse
 from routers.router import router
-from logging_utils import init_request_logging
+from logging_utils import init_request_logging, log_shipping_stats, start_log_shipping, stop_log_shipping
+from db_two import database
+from db_two.database import close_db, ensure_indexes_until_reachable, get_client, ping_db
+from services.auth_service import auth_service
+from services.category_budget_client import category_budget_client
+from services.event_consumer import ANALYTICS_EVENTS_ENABLED, event_consumer
+from services.metrics import METRICS_ENABLED, observe_request, render_metrics
+from services.profiling import request_profiler
+from services.scheduler import SCHEDULER_ENABLED, precompute_scheduler
 import uvicorn
 import os
 
+HEALTH_CHECK_TIMEOUT = float(os.getenv("HEALTH_CHECK_TIMEOUT", "2"))
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # everything that opens connections or threads is created here, in the
+    # worker process, and startup does not wait for Mongo or RabbitMQ
+    if SCHEDULER_ENABLED or ANALYTICS_EVENTS_ENABLED:
+        # both call category-budget with service tokens
+        auth_service.check_service_secret()
+    start_log_shipping()
+    get_client()
+    index_task = asyncio.create_task(ensure_indexes_until_reachable())
+    if SCHEDULER_ENABLED:
+        precompute_scheduler.start()
+    if ANALYTICS_EVENTS_ENABLED:
+        event_consumer.start()
+    yield
+    index_task.cancel()
+    await precompute_scheduler.stop()
+    await event_consumer.stop()
+    await category_budget_client.close()
+    await close_db()
+    stop_log_shipping()
+
+
 app = FastAPI(
     title="Analytics Service",
+    lifespan=lifespan,
     docs_url="/docs",
     redoc_url=None,
     openapi_url="/openapi.json",
@@ -34,9 +73,53 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-init_request_logging(app, "soa-analytics")
+init_request_logging(app, "soa-analytics", on_request=observe_request, profiler=request_profiler)
 app.include_router(router)
 
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    """Prometheus scrape endpoint."""
+    if not METRICS_ENABLED:
+        raise HTTPException(status_code=404, detail="Metrics are disabled")
+    body, content_type = render_metrics()
+    return Response(content=body, media_type=content_type)
+
+
+@app.get("/health/live", include_in_schema=False)
+async def liveness():
+    """The process is up and its event loop answers."""
+    return {"status": "ok"}
+
+
+@app.get("/health/ready", include_in_schema=False)
+async def readiness():
+    """
+    Ready when MongoDB answers a ping. Indexes, log shipping and the
+    category-budget circuit are reported but do not fail the check:
+    requests still work without them, and an open circuit is served from
+    stored documents.
+    """
+    mongo = await ping_db(HEALTH_CHECK_TIMEOUT)
+    rabbitmq = log_shipping_stats()
+    checks = {
+        "mongo": mongo,
+        "indexes": {"ok": database.indexes_ready},
+        "rabbitmq": {"ok": bool(rabbitmq and rabbitmq["connected"]), **(rabbitmq or {"error": "not started"})},
+        "category_budget": {
+            "ok": category_budget_client.breaker.state != category_budget_client.breaker.OPEN,
+            **category_budget_client.breaker.stats(),
+        },
+    }
+    if ANALYTICS_EVENTS_ENABLED:
+        events = event_consumer.stats()
+        checks["events"] = {"ok": events["running"] and events["last_error"] is None, **jsonable_encoder(events)}
+    ready = mongo["ok"]
+    return JSONResponse(
+        {"status": "ready" if ready else "not_ready", "checks": checks},
+        status_code=200 if ready else 503,
+    )
+
+
 @app.get("/openapi.json", include_in_schema=False)
 async def custom_openapi():
     """Serve OpenAPI schema without authentication."""
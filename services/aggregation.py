@@ -0,0 +1,245 @@
+"""
+Shared bucketing of category items into per-category and per-day totals.
+
+The categories payload from category-budget is converted once into columns
+(timestamps, prices, quantities, category codes) and every aggregation runs
+on those columns. NumPy is used when available; otherwise the same API is
+served by plain Python lists.
+"""
+import os
+import warnings
+from datetime import date, datetime, time, timezone
+from typing import Dict, List, Optional, Tuple
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover - numpy is optional
+    np = None
+
+HAS_NUMPY = np is not None
+
+ANALYTICS_STREAM_BATCH_SIZE = int(os.getenv("ANALYTICS_STREAM_BATCH_SIZE", "5000"))
+
+_MIN_TS = datetime(1, 1, 1)
+_MAX_TS = datetime(9999, 12, 31, 23, 59, 59, 999999)
+
+
+def parse_iso(s) -> Optional[datetime]:
+    """
+    Parses an ISO timestamp. Aware values are normalized to naive UTC so they
+    can be compared with the naive month/day bounds used by the services.
+    """
+    try:
+        dt = datetime.fromisoformat(str(s).replace("Z", "+00:00"))
+    except Exception:
+        return None
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(timezone.utc).replace(tzinfo=None)
+    return dt
+
+
+def _to_number(value, default, cast):
+    try:
+        return cast(value if value is not None else default)
+    except (TypeError, ValueError, OverflowError):
+        return None
+
+
+def _to_quantity(value):
+    return int(float(value))
+
+
+class ItemColumns:
+    """
+    Columnar view of a categories payload.
+
+    `category_ids`/`category_names` are indexed by category code (the position
+    of the category in the payload). With NumPy, `ts` is datetime64[us] (NaT for
+    unparseable values) and `amount` holds price * quantity; without it both are
+    plain lists with None for rejected items.
+    """
+
+    def __init__(self, category_ids, category_names, ts, price, qty, cat_code):
+        self.category_ids: List[str] = category_ids
+        self.category_names: List[str] = category_names
+        self.ts = ts
+        self.price = price
+        self.qty = qty
+        self.cat_code = cat_code
+        if HAS_NUMPY:
+            self.amount = price * qty
+            self.valid = ~np.isnat(ts) & ~np.isnan(self.amount)
+        else:
+            self.amount = [
+                p * q if t is not None and p is not None and q is not None else None
+                for t, p, q in zip(ts, price, qty)
+            ]
+
+    def __len__(self):
+        return len(self.cat_code)
+
+    @property
+    def num_categories(self) -> int:
+        return len(self.category_ids)
+
+
+def to_columns(categories) -> ItemColumns:
+    category_ids = []
+    category_names = []
+    raw_ts = []
+    raw_price = []
+    raw_qty = []
+    codes = []
+
+    for code, c in enumerate(categories):
+        category_ids.append(str(c.get("category_id")))
+        category_names.append(c.get("name", "Unknown"))
+        for it in c.get("items", []) or []:
+            raw_ts.append(it.get("created_at"))
+            raw_price.append(it.get("item_price", 0))
+            raw_qty.append(it.get("item_quantity", 1))
+            codes.append(code)
+
+    return _columns(category_ids, category_names, raw_ts, raw_price, raw_qty, codes)
+
+
+def _columns(category_ids, category_names, raw_ts, raw_price, raw_qty, codes) -> ItemColumns:
+    if not HAS_NUMPY:
+        return ItemColumns(
+            category_ids,
+            category_names,
+            [parse_iso(s) for s in raw_ts],
+            [_to_number(p, 0, float) for p in raw_price],
+            [_to_number(q, 1, _to_quantity) for q in raw_qty],
+            codes,
+        )
+
+    return ItemColumns(
+        category_ids,
+        category_names,
+        _ts_column(raw_ts),
+        _number_column(raw_price, 0, float),
+        np.trunc(_number_column(raw_qty, 1, _to_quantity)),
+        np.asarray(codes, dtype=np.int64),
+    )
+
+
+def _ts_column(raw):
+    strings = ["NaT" if s is None else str(s) for s in raw]
+    try:
+        with warnings.catch_warnings():
+            # numpy warns on (and converts to UTC) explicit offsets, which is
+            # exactly what parse_iso does as well
+            warnings.simplefilter("ignore")
+            ts = np.array(strings, dtype="datetime64[us]")
+        ok = ~np.isnat(ts)
+        # numpy accepts some strings fromisoformat rejects (e.g. bare digits
+        # are read as a year or an epoch offset, "YYYY-MM" as a month), so
+        # anything shorter than a full date or out of range re-parses
+        if not ok.any() or (
+            ts[ok].min() >= np.datetime64(_MIN_TS) and ts[ok].max() <= np.datetime64(_MAX_TS)
+            and min(len(s) for s in strings if s != "NaT") >= 10
+        ):
+            return ts
+    except (ValueError, TypeError, OverflowError):
+        pass
+
+    return np.array(
+        [np.datetime64(dt, "us") if dt else np.datetime64("NaT", "us") for dt in map(parse_iso, raw)],
+        dtype="datetime64[us]",
+    )
+
+
+def _number_column(raw, default, cast):
+    try:
+        return np.asarray([default if v is None else v for v in raw], dtype=np.float64)
+    except (ValueError, TypeError):
+        values = [_to_number(v, default, cast) for v in raw]
+        return np.asarray([np.nan if v is None else v for v in values], dtype=np.float64)
+
+
+def daily_totals(cols: ItemColumns, since: Optional[date] = None) -> List[Tuple[int, str, float]]:
+    """
+    Sparse per-category-per-day totals as (category code, YYYY-MM-DD, spent),
+    only for days on or after `since` when given.
+    """
+    if not HAS_NUMPY:
+        since_dt = datetime.combine(since, time.min) if since else None
+        totals: Dict[Tuple[int, str], float] = {}
+        for t, a, code in zip(cols.ts, cols.amount, cols.cat_code):
+            if a is None or (since_dt is not None and t < since_dt):
+                continue
+            key = (code, t.date().isoformat())
+            totals[key] = totals.get(key, 0.0) + a
+        return [(code, day, spent) for (code, day), spent in sorted(totals.items())]
+
+    mask = cols.valid
+    if since is not None:
+        mask = mask & (cols.ts >= np.datetime64(since, "us"))
+    n = cols.num_categories
+    days = cols.ts[mask].astype("datetime64[D]").astype(np.int64)
+    flat = days * n + cols.cat_code[mask]
+    keys, inverse = np.unique(flat, return_inverse=True)
+    sums = np.bincount(inverse, weights=cols.amount[mask], minlength=len(keys))
+    codes = (keys % n).tolist()
+    dates = (keys // n).astype("datetime64[D]").astype(str).tolist()
+    return sorted(zip(codes, dates, sums.tolist()))
+
+
+class DailyTotalsBuilder:
+    """
+    Incremental counterpart of `to_columns` + `daily_totals` for payloads that
+    are parsed as a stream. Items are buffered as raw values and folded into
+    the running per-category-per-day totals every `batch_size` items, so
+    memory is bounded by the batch plus the number of (category, day) pairs
+    instead of the number of items in the payload.
+    """
+
+    def __init__(self, since: Optional[date] = None, batch_size: int = ANALYTICS_STREAM_BATCH_SIZE):
+        self.since = since
+        self.batch_size = max(1, batch_size)
+        self.category_ids: List[str] = []
+        self.category_names: List[str] = []
+        self.items = 0
+        self._raw_ts = []
+        self._raw_price = []
+        self._raw_qty = []
+        self._codes = []
+        self._totals: Dict[Tuple[int, str], float] = {}
+
+    def add_category(self, category_id=None, name="Unknown") -> int:
+        """Registers the next category and returns its code."""
+        self.category_ids.append(str(category_id))
+        self.category_names.append(name)
+        return len(self.category_ids) - 1
+
+    def set_category_id(self, code: int, category_id):
+        self.category_ids[code] = str(category_id)
+
+    def set_category_name(self, code: int, name):
+        self.category_names[code] = name
+
+    def add_item(self, code: int, created_at=None, price=0, quantity=1):
+        self._raw_ts.append(created_at)
+        self._raw_price.append(price)
+        self._raw_qty.append(quantity)
+        self._codes.append(code)
+        self.items += 1
+        if len(self._codes) >= self.batch_size:
+            self._flush()
+
+    def _flush(self):
+        if not self._codes:
+            return
+        cols = _columns(
+            self.category_ids, self.category_names, self._raw_ts, self._raw_price, self._raw_qty, self._codes
+        )
+        for code, day, spent in daily_totals(cols, self.since):
+            key = (code, day)
+            self._totals[key] = self._totals.get(key, 0.0) + spent
+        self._raw_ts, self._raw_price, self._raw_qty, self._codes = [], [], [], []
+
+    def totals(self) -> List[Tuple[int, str, float]]:
+        """Same shape as `daily_totals`: sorted (category code, YYYY-MM-DD, spent)."""
+        self._flush()
+        return [(code, day, spent) for (code, day), spent in sorted(self._totals.items())]
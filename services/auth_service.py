@@ -1,5 +1,6 @@
 import jwt
 import os
+from datetime import datetime, timedelta, timezone
 from typing import Dict, Optional
 from fastapi import HTTPException, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
@@ -9,6 +10,8 @@ security = HTTPBearer()
 class AuthService:
     def __init__(self):
         self.secret_key = os.getenv("JWT_SECRET_KEY", "your-secret-key-change-in-production")
+        self.service_secret_key = os.getenv("SERVICE_JWT_SECRET_KEY", "")
+        self.service_name = os.getenv("SERVICE_NAME", "soa-analytics")
         self.algorithm = "HS256"
 
     def verify_token(self, token: str, token_type: str = "access") -> Optional[Dict]:
@@ -25,6 +28,45 @@ class AuthService:
         except jwt.InvalidTokenError:
             return None
 
+    def create_access_token(self, user_id: str, ttl_seconds: int = 300) -> str:
+        """
+        Mints a user access token for `user_id`, as the auth service would
+        issue it. Only for local harnesses (benchmarks) that log in as users.
+        """
+        now = datetime.now(timezone.utc)
+        payload = {"sub": user_id, "type": "access", "iat": now, "exp": now + timedelta(seconds=ttl_seconds)}
+        return jwt.encode(payload, self.secret_key, algorithm=self.algorithm)
+
+    def check_service_secret(self):
+        """
+        Raises RuntimeError unless service tokens can be issued, so jobs that
+        need them fail at startup instead of at their first call.
+        """
+        if not self.service_secret_key:
+            raise RuntimeError("SERVICE_JWT_SECRET_KEY is not set, cannot issue service tokens")
+        if self.service_secret_key == self.secret_key:
+            raise RuntimeError("SERVICE_JWT_SECRET_KEY must differ from JWT_SECRET_KEY")
+
+    def create_service_token(self, user_id: str, ttl_seconds: int = 300) -> str:
+        """
+        Mints a short-lived service token so background jobs can call
+        category-budget for `user_id` without a forwarded JWT. It is not a user
+        access token: `type` is "service", `sub` is this service and the user
+        is in `on_behalf_of`, and it is signed with SERVICE_JWT_SECRET_KEY, so
+        neither this service nor category-budget accepts it as a user login.
+        """
+        self.check_service_secret()
+        now = datetime.now(timezone.utc)
+        payload = {
+            "sub": self.service_name,
+            "type": "service",
+            "on_behalf_of": user_id,
+            "aud": "soa-category-budget",
+            "iat": now,
+            "exp": now + timedelta(seconds=ttl_seconds),
+        }
+        return jwt.encode(payload, self.service_secret_key, algorithm=self.algorithm)
+
     def get_current_user(self, credentials: HTTPAuthorizationCredentials) -> Dict:
         """
         Validates JWT token from Authorization header and returns user info.
@@ -0,0 +1,115 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Hashable
+
+ANALYTICS_CACHE_ENABLED = os.getenv("ANALYTICS_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+ANALYTICS_CACHE_SIZE = int(os.getenv("ANALYTICS_CACHE_SIZE", "10000"))
+ANALYTICS_CACHE_TTL = float(os.getenv("ANALYTICS_CACHE_TTL", "60"))
+
+MISSING = object()
+
+
+class TTLCache:
+    """
+    Bounded LRU cache whose entries also expire after `ttl` seconds.
+
+    Readers that fill the cache after an await take `generation(key)` before
+    reading the source and pass it to `set`. `invalidate` bumps the key's
+    generation, so a read that started before a write cannot put the old
+    value back afterwards. The services call it from the event loop only;
+    the lock keeps it safe to share with other threads.
+    """
+
+    def __init__(self, maxsize: int, ttl: float, enabled: bool = True):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.enabled = enabled and maxsize > 0 and ttl > 0
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        # key -> generation of its last invalidation; keys not in it are at
+        # _floor, which is raised whenever the dict is pruned
+        self._generations: "dict[Hashable, int]" = {}
+        self._clock = 0
+        self._floor = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key: Hashable) -> Any:
+        """Returns the cached value or MISSING."""
+        if not self.enabled:
+            return MISSING
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return MISSING
+            expires_at, value = entry
+            if expires_at <= time.monotonic():
+                del self._data[key]
+                self.expirations += 1
+                self.misses += 1
+                return MISSING
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def generation(self, key: Hashable) -> int:
+        """Token to pass to `set` after reading the value for `key`."""
+        with self._lock:
+            return self._generations.get(key, self._floor)
+
+    def set(self, key: Hashable, value: Any, generation: int = None):
+        """
+        Stores `value`, unless `generation` is given and `key` was invalidated
+        since it was taken.
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            if generation is not None and self._generations.get(key, self._floor) != generation:
+                return
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key: Hashable):
+        with self._lock:
+            self._data.pop(key, None)
+            self._clock += 1
+            self._generations[key] = self._clock
+            if len(self._generations) > max(self.maxsize, 1024):
+                self._prune()
+
+    def _prune(self):
+        # every pruned key moves to the new floor, which is above any token
+        # taken before its invalidation
+        self._generations.clear()
+        self._floor = self._clock
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._clock += 1
+            self._prune()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+
+analytics_cache = TTLCache(ANALYTICS_CACHE_SIZE, ANALYTICS_CACHE_TTL, ANALYTICS_CACHE_ENABLED)
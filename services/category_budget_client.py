@@ -0,0 +1,435 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from typing import Optional
+
+import httpx
+
+from logging_utils import get_correlation_id
+from services.aggregation import DailyTotalsBuilder
+from services.category_stream import HAS_IJSON, CategoriesStreamParser, fold_categories
+from services.metrics import (
+    UPSTREAM_BYTES, UPSTREAM_CIRCUIT_STATE, UPSTREAM_CIRCUIT_TRANSITIONS, UPSTREAM_HEDGES, UPSTREAM_REQUESTS,
+    UPSTREAM_RETRIES, UPSTREAM_SECONDS, timed,
+)
+from services.resilience import CircuitBreaker, LatencyWindow, RetryBudget, UpstreamUnavailableError, backoff
+from services.upstream_cache import CachedResponse, upstream_cache
+
+CATEGORY_BUDGET_URL = os.getenv("CATEGORY_BUDGET_URL", "http://localhost:8002").rstrip("/")
+CATEGORY_BUDGET_MAX_CONNECTIONS = int(os.getenv("CATEGORY_BUDGET_MAX_CONNECTIONS", "100"))
+CATEGORY_BUDGET_MAX_KEEPALIVE = int(os.getenv("CATEGORY_BUDGET_MAX_KEEPALIVE", "20"))
+CATEGORY_BUDGET_KEEPALIVE_EXPIRY = float(os.getenv("CATEGORY_BUDGET_KEEPALIVE_EXPIRY", "30"))
+CATEGORY_BUDGET_CONNECT_TIMEOUT = float(os.getenv("CATEGORY_BUDGET_CONNECT_TIMEOUT", "3"))
+CATEGORY_BUDGET_TIMEOUT = float(os.getenv("CATEGORY_BUDGET_TIMEOUT", "8"))
+CATEGORY_BUDGET_STREAMING = os.getenv("CATEGORY_BUDGET_STREAMING", "true").lower() in ("1", "true", "yes")
+CATEGORY_BUDGET_STREAM_CHUNK = int(os.getenv("CATEGORY_BUDGET_STREAM_CHUNK", "65536"))
+# parsing at least this many bytes at once runs in a worker thread, so it
+# does not hold up the event loop
+CATEGORY_BUDGET_PARSE_IN_THREAD = int(os.getenv("CATEGORY_BUDGET_PARSE_IN_THREAD", "65536"))
+CATEGORY_BUDGET_ATTEMPT_TIMEOUT = float(os.getenv("CATEGORY_BUDGET_ATTEMPT_TIMEOUT", "3"))
+CATEGORY_BUDGET_RETRIES = int(os.getenv("CATEGORY_BUDGET_RETRIES", "2"))
+CATEGORY_BUDGET_RETRY_BACKOFF = float(os.getenv("CATEGORY_BUDGET_RETRY_BACKOFF", "0.1"))
+CATEGORY_BUDGET_RETRY_BACKOFF_MAX = float(os.getenv("CATEGORY_BUDGET_RETRY_BACKOFF_MAX", "1"))
+CATEGORY_BUDGET_RETRY_BUDGET_RATIO = float(os.getenv("CATEGORY_BUDGET_RETRY_BUDGET_RATIO", "0.2"))
+CATEGORY_BUDGET_RETRY_BUDGET_MIN = float(os.getenv("CATEGORY_BUDGET_RETRY_BUDGET_MIN", "1"))
+CATEGORY_BUDGET_HEDGING = os.getenv("CATEGORY_BUDGET_HEDGING", "false").lower() in ("1", "true", "yes")
+CATEGORY_BUDGET_HEDGE_PERCENTILE = float(os.getenv("CATEGORY_BUDGET_HEDGE_PERCENTILE", "95"))
+CATEGORY_BUDGET_HEDGE_MIN_DELAY = float(os.getenv("CATEGORY_BUDGET_HEDGE_MIN_DELAY", "0.05"))
+CATEGORY_BUDGET_BREAKER_FAILURES = int(os.getenv("CATEGORY_BUDGET_BREAKER_FAILURES", "5"))
+CATEGORY_BUDGET_BREAKER_RESET = float(os.getenv("CATEGORY_BUDGET_BREAKER_RESET", "10"))
+# a monthly generate makes two upstream calls at once, so let both probe
+CATEGORY_BUDGET_BREAKER_PROBES = int(os.getenv("CATEGORY_BUDGET_BREAKER_PROBES", "2"))
+CATEGORY_BUDGET_SERVE_STALE = os.getenv("CATEGORY_BUDGET_SERVE_STALE", "true").lower() in ("1", "true", "yes")
+
+RETRYABLE_STATUSES = frozenset((429, 502, 503, 504))
+_CIRCUIT_STATES = {CircuitBreaker.CLOSED: 0, CircuitBreaker.HALF_OPEN: 1, CircuitBreaker.OPEN: 2}
+
+
+class UpstreamResult:
+    """
+    Body of an upstream response plus the validators (ETag/Last-Modified) it
+    came with. `not_modified` is set when a conditional request got a 304, in
+    which case `data` is None.
+    """
+
+    __slots__ = ("data", "validators", "not_modified")
+
+    def __init__(self, data, validators: Optional[dict] = None, not_modified: bool = False):
+        self.data = data
+        self.validators = validators or {}
+        self.not_modified = not_modified
+
+
+def _validators(response: httpx.Response) -> dict:
+    validators = {}
+    if response.headers.get("ETag"):
+        validators["etag"] = response.headers["ETag"]
+    if response.headers.get("Last-Modified"):
+        validators["last_modified"] = response.headers["Last-Modified"]
+    return validators
+
+
+def _fold_body(builder: DailyTotalsBuilder, body: bytes):
+    """Folds a whole cached `/{user_id}/categories` body into `builder`."""
+    if HAS_IJSON:
+        parser = CategoriesStreamParser(builder)
+        # chunk by chunk, as if streamed: one huge feed holds the GIL in C
+        # for all of it and materializes every parse event at once
+        view = memoryview(body)
+        for i in range(0, len(view), CATEGORY_BUDGET_STREAM_CHUNK):
+            parser.feed(view[i:i + CATEGORY_BUDGET_STREAM_CHUNK])
+        parser.close()
+    else:
+        fold_categories(builder, json.loads(body))
+
+
+class CategoryBudgetClient:
+    """
+    Shared async client for the category-budget service.
+    One connection pool per process, reused by every service.
+    """
+
+    def __init__(self):
+        self.logger = logging.getLogger("soa-analytics")
+        self._client: Optional[httpx.AsyncClient] = None
+        self.retry_budget = RetryBudget(CATEGORY_BUDGET_RETRY_BUDGET_RATIO, CATEGORY_BUDGET_RETRY_BUDGET_MIN)
+        self.breaker = CircuitBreaker(
+            CATEGORY_BUDGET_BREAKER_FAILURES, CATEGORY_BUDGET_BREAKER_RESET, CATEGORY_BUDGET_BREAKER_PROBES,
+            self._circuit_changed,
+        )
+        self.latency = {}
+        UPSTREAM_CIRCUIT_STATE.labels("category-budget").set(0)
+
+    def _circuit_changed(self, state: str):
+        UPSTREAM_CIRCUIT_STATE.labels("category-budget").set(_CIRCUIT_STATES[state])
+        UPSTREAM_CIRCUIT_TRANSITIONS.labels("category-budget", state).inc()
+        log = self.logger.warning if state == CircuitBreaker.OPEN else self.logger.info
+        log(
+            "category-budget circuit breaker changed state",
+            extra={"correlation_id": get_correlation_id(), "url": CATEGORY_BUDGET_URL, "detail": f"state={state}"},
+        )
+
+    def _get_client(self) -> httpx.AsyncClient:
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                base_url=CATEGORY_BUDGET_URL,
+                limits=httpx.Limits(
+                    max_connections=CATEGORY_BUDGET_MAX_CONNECTIONS,
+                    max_keepalive_connections=CATEGORY_BUDGET_MAX_KEEPALIVE,
+                    keepalive_expiry=CATEGORY_BUDGET_KEEPALIVE_EXPIRY,
+                ),
+                timeout=httpx.Timeout(
+                    CATEGORY_BUDGET_TIMEOUT, connect=CATEGORY_BUDGET_CONNECT_TIMEOUT
+                ),
+            )
+        return self._client
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def _headers(self, jwt_token: str = None):
+        headers = {}
+        correlation_id = get_correlation_id()
+        if correlation_id:
+            headers["X-Correlation-Id"] = correlation_id
+        if jwt_token:
+            headers["Authorization"] = f"Bearer {jwt_token}"
+        return headers
+
+    def _conditional_headers(self, jwt_token: str = None, validators: Optional[dict] = None):
+        headers = self._headers(jwt_token)
+        if validators:
+            if validators.get("etag"):
+                headers["If-None-Match"] = validators["etag"]
+            if validators.get("last_modified"):
+                headers["If-Modified-Since"] = validators["last_modified"]
+        return headers
+
+    def _raise_for_status(self, r: httpx.Response, label: str, url: str):
+        try:
+            error_detail = r.json().get("detail", r.text)
+        except Exception:
+            error_detail = r.text or f"Status code: {r.status_code}"
+        self.logger.error(
+            f"{label} service error",
+            extra={
+                "correlation_id": get_correlation_id(),
+                "url": url,
+                "method": "GET",
+                "status_code": r.status_code,
+                "detail": error_detail,
+            },
+        )
+        if r.status_code >= 500 or r.status_code == 429:
+            raise UpstreamUnavailableError(f"{label} service error ({r.status_code}): {error_detail}")
+        raise ValueError(f"{label} service error ({r.status_code}): {error_detail}")
+
+    async def _send_once(self, path: str, endpoint: str, headers: dict, params, stream: bool,
+                         deadline: float) -> httpx.Response:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise httpx.TimeoutException("category-budget deadline exceeded")
+        attempt = min(CATEGORY_BUDGET_ATTEMPT_TIMEOUT, remaining)
+        client = self._get_client()
+        request = client.build_request(
+            "GET", path, params=params, headers=headers,
+            timeout=httpx.Timeout(attempt, connect=min(CATEGORY_BUDGET_CONNECT_TIMEOUT, attempt)),
+        )
+        started = time.perf_counter()
+        try:
+            r = await client.send(request, stream=stream)
+        except httpx.HTTPError:
+            UPSTREAM_REQUESTS.labels(endpoint, "error").inc()
+            raise
+        UPSTREAM_REQUESTS.labels(endpoint, str(r.status_code)).inc()
+        if r.status_code < 500:
+            self.latency.setdefault(endpoint, LatencyWindow()).record(time.perf_counter() - started)
+        return r
+
+    async def _send_hedged(self, send, endpoint: str) -> httpx.Response:
+        """
+        Sends one request and, if it is still running after the recent
+        CATEGORY_BUDGET_HEDGE_PERCENTILE latency, a second identical one;
+        the first usable response wins and the other is cancelled.
+        """
+        window = self.latency.get(endpoint)
+        delay = window.percentile(CATEGORY_BUDGET_HEDGE_PERCENTILE) if window else None
+        first = asyncio.ensure_future(send())
+        if delay is None:
+            return await first
+        done, _ = await asyncio.wait({first}, timeout=max(delay, CATEGORY_BUDGET_HEDGE_MIN_DELAY))
+        if done or not self.retry_budget.try_spend():
+            return await first
+
+        UPSTREAM_HEDGES.labels(endpoint, "sent").inc()
+        second = asyncio.ensure_future(send())
+        pending = {first, second}
+        last = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    last = task
+                    if task.exception() is None and task.result().status_code not in RETRYABLE_STATUSES:
+                        if task is second:
+                            UPSTREAM_HEDGES.labels(endpoint, "won").inc()
+                        return task.result()
+            return last.result()
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def _request(self, path: str, endpoint: str, headers: dict, params=None,
+                       stream: bool = False) -> httpx.Response:
+        """
+        GET with per-attempt timeouts inside an overall CATEGORY_BUDGET_TIMEOUT
+        deadline, jittered retries on transport errors and 429/502/503/504
+        (bounded by the retry budget), optional hedging for buffered requests
+        and the circuit breaker. Returns the last response, which may still
+        be an error status, or raises UpstreamUnavailableError.
+        """
+        if not self.breaker.allow():
+            raise UpstreamUnavailableError(
+                "Category-budget service unavailable (circuit open)", self.breaker.retry_after()
+            )
+        deadline = time.monotonic() + CATEGORY_BUDGET_TIMEOUT
+        self.retry_budget.record_call()
+
+        def send():
+            return self._send_once(path, endpoint, headers, params, stream, deadline)
+
+        hedge = CATEGORY_BUDGET_HEDGING and not stream
+        attempt = 0
+        while True:
+            r = error = None
+            try:
+                r = await (self._send_hedged(send, endpoint) if hedge else send())
+            except httpx.TransportError as e:
+                error = e
+            if r is not None and r.status_code not in RETRYABLE_STATUSES:
+                if r.status_code >= 500:
+                    self.breaker.record_failure()
+                else:
+                    self.breaker.record_success()
+                return r
+            self.breaker.record_failure()
+
+            attempt += 1
+            delay = backoff(attempt, CATEGORY_BUDGET_RETRY_BACKOFF, CATEGORY_BUDGET_RETRY_BACKOFF_MAX)
+            reason = type(error).__name__ if error is not None else str(r.status_code)
+            give_up = (
+                attempt > CATEGORY_BUDGET_RETRIES
+                or time.monotonic() + delay >= deadline
+                or self.breaker.state == CircuitBreaker.OPEN
+            )
+            if not give_up and not self.retry_budget.try_spend():
+                UPSTREAM_RETRIES.labels(endpoint, "budget_exhausted").inc()
+                give_up = True
+            if give_up:
+                if r is not None:
+                    return r
+                raise UpstreamUnavailableError(
+                    f"Category-budget service unavailable ({reason})", self.breaker.retry_after()
+                ) from error
+
+            if r is not None and stream:
+                await r.aclose()
+            UPSTREAM_RETRIES.labels(endpoint, reason).inc()
+            await asyncio.sleep(delay)
+
+    async def _get(self, path: str, label: str, jwt_token: str = None, params=None,
+                   validators: Optional[dict] = None, cache_key=None) -> UpstreamResult:
+        if cache_key is not None:
+            cached = await upstream_cache.get(cache_key)
+            if cached is not None:
+                if validators and cached.validators == validators:
+                    return UpstreamResult(None, validators, not_modified=True)
+                return UpstreamResult(json.loads(cached.body), cached.validators)
+
+        headers = self._conditional_headers(jwt_token, validators)
+        endpoint = path.rsplit("/", 1)[-1]
+        fetched_at = time.time()
+        with timed(UPSTREAM_SECONDS, endpoint, phase="upstream"):
+            r = await self._request(path, endpoint, headers, params)
+        UPSTREAM_BYTES.labels(endpoint).observe(len(r.content))
+        if r.status_code == 304 and validators:
+            return UpstreamResult(None, validators, not_modified=True)
+        if r.status_code != 200:
+            self._raise_for_status(r, label, f"{CATEGORY_BUDGET_URL}{path}")
+
+        result = UpstreamResult(r.json(), _validators(r))
+        if cache_key is not None:
+            await upstream_cache.set(cache_key, r.content, result.validators, fetched_at)
+        return result
+
+    async def fetch_budgets(self, user_id: str, month: str, jwt_token: str = None,
+                            validators: Optional[dict] = None) -> UpstreamResult:
+        self.logger.info(
+            "Requesting budgets",
+            extra={
+                "correlation_id": get_correlation_id(),
+                "url": f"{CATEGORY_BUDGET_URL}/{user_id}/budgets",
+                "method": "GET",
+            },
+        )
+        return await self._get(
+            f"/{user_id}/budgets", "Budget", jwt_token, params={"month": month}, validators=validators,
+            cache_key=(user_id, "budgets", month),
+        )
+
+    async def fetch_categories(self, user_id: str, jwt_token: str = None,
+                               validators: Optional[dict] = None) -> UpstreamResult:
+        self.logger.info(
+            "Requesting categories",
+            extra={
+                "correlation_id": get_correlation_id(),
+                "url": f"{CATEGORY_BUDGET_URL}/{user_id}/categories",
+                "method": "GET",
+            },
+        )
+        return await self._get(
+            f"/{user_id}/categories", "Category", jwt_token, validators=validators,
+            cache_key=(user_id, "categories", None),
+        )
+
+    async def stream_categories(self, user_id: str, builder: DailyTotalsBuilder, jwt_token: str = None,
+                                validators: Optional[dict] = None) -> UpstreamResult:
+        """
+        Like `fetch_categories`, but folds the payload into `builder` while it
+        is being downloaded; `data` of the result is the builder. Falls back to
+        a regular `fetch_categories` when streaming is disabled or ijson is not
+        installed.
+        """
+        if not (CATEGORY_BUDGET_STREAMING and HAS_IJSON):
+            res = await self.fetch_categories(user_id, jwt_token, validators)
+            if res.not_modified:
+                return res
+            return UpstreamResult(fold_categories(builder, res.data), res.validators)
+
+        cache_key = (user_id, "categories", None)
+        cached = await upstream_cache.get(cache_key)
+        if cached is not None:
+            return await self._fold_cached(cached, builder, validators)
+
+        path = f"/{user_id}/categories"
+        self.logger.info(
+            "Streaming categories",
+            extra={"correlation_id": get_correlation_id(), "url": f"{CATEGORY_BUDGET_URL}{path}", "method": "GET"},
+        )
+        headers = self._conditional_headers(jwt_token, validators)
+        fetched_at = time.time()
+        with timed(UPSTREAM_SECONDS, "categories", phase="upstream"):
+            r = await self._request(path, "categories", headers, stream=True)
+            try:
+                if r.status_code == 304 and validators:
+                    return UpstreamResult(None, validators, not_modified=True)
+                if r.status_code != 200:
+                    await r.aread()
+                    self._raise_for_status(r, "Category", f"{CATEGORY_BUDGET_URL}{path}")
+
+                parser = CategoriesStreamParser(builder)
+                size = 0
+                # chunks are parsed in a worker thread once enough of them
+                # have arrived, smaller bodies on the loop at the end
+                pending, pending_size = [], 0
+                # chunks are kept for the upstream cache only while the
+                # body still fits into one cache entry
+                kept = []
+                try:
+                    async for chunk in r.aiter_bytes(CATEGORY_BUDGET_STREAM_CHUNK):
+                        size += len(chunk)
+                        pending.append(chunk)
+                        pending_size += len(chunk)
+                        if pending_size >= CATEGORY_BUDGET_PARSE_IN_THREAD:
+                            await asyncio.to_thread(parser.feed, b"".join(pending))
+                            pending, pending_size = [], 0
+                        if kept is not None:
+                            if upstream_cache.accepts(size):
+                                kept.append(chunk)
+                            else:
+                                kept = None
+                except httpx.TransportError as e:
+                    # the builder already holds part of the body, so this
+                    # cannot be retried here
+                    self.breaker.record_failure()
+                    raise UpstreamUnavailableError(
+                        f"Category-budget service unavailable ({type(e).__name__})", self.breaker.retry_after()
+                    ) from e
+                if pending:
+                    # an empty feed would end the parse
+                    parser.feed(b"".join(pending))
+                parser.close()
+                UPSTREAM_BYTES.labels("categories").observe(size)
+                res = UpstreamResult(builder, _validators(r))
+                if kept is not None:
+                    await upstream_cache.set(cache_key, b"".join(kept), res.validators, fetched_at)
+                return res
+            finally:
+                await r.aclose()
+
+    async def _fold_cached(self, cached: CachedResponse, builder: DailyTotalsBuilder,
+                           validators: Optional[dict] = None) -> UpstreamResult:
+        if validators and cached.validators == validators:
+            return UpstreamResult(None, validators, not_modified=True)
+        if len(cached.body) >= CATEGORY_BUDGET_PARSE_IN_THREAD:
+            await asyncio.to_thread(_fold_body, builder, cached.body)
+        else:
+            _fold_body(builder, cached.body)
+        return UpstreamResult(builder, cached.validators)
+
+    async def invalidate(self, user_id: str):
+        """Forgets cached upstream responses of `user_id`, e.g. after its items changed."""
+        await upstream_cache.invalidate(user_id)
+
+    async def get_budgets(self, user_id: str, month: str, jwt_token: str = None):
+        return (await self.fetch_budgets(user_id, month, jwt_token)).data
+
+    async def get_categories(self, user_id: str, jwt_token: str = None):
+        return (await self.fetch_categories(user_id, jwt_token)).data
+
+
+category_budget_client = CategoryBudgetClient()
@@ -0,0 +1,86 @@
+"""
+Incremental parser for the `/{user_id}/categories` payload.
+
+The response body is fed chunk by chunk into ijson and every item is folded
+into a `DailyTotalsBuilder` as soon as it is complete, so the full list of
+categories and items is never materialized as Python objects. ijson is
+optional; without it the client falls back to `response.json()`.
+"""
+from services.aggregation import DailyTotalsBuilder
+
+try:
+    import ijson
+except ImportError:  # pragma: no cover - ijson is optional
+    ijson = None
+
+HAS_IJSON = ijson is not None
+
+_ITEM_FIELDS = {
+    "item.items.item.created_at": 0,
+    "item.items.item.item_price": 1,
+    "item.items.item.item_quantity": 2,
+}
+_SCALARS = frozenset(("string", "number", "boolean", "null"))
+
+
+class CategoriesStreamParser:
+    """
+    Push parser: call `feed(chunk)` for every chunk of the body and `close()`
+    at the end. Only `category_id`, `name` and the item fields `created_at`,
+    `item_price` and `item_quantity` are kept; everything else is skipped by
+    the tokenizer.
+    """
+
+    def __init__(self, builder: DailyTotalsBuilder):
+        if not HAS_IJSON:
+            raise RuntimeError("ijson is not installed")
+        self.builder = builder
+        self._events = ijson.sendable_list()
+        self._coro = ijson.parse_coro(self._events, use_float=True)
+        self._code = None
+        self._item = None
+
+    def feed(self, chunk: bytes):
+        self._coro.send(chunk)
+        self._handle()
+
+    def close(self):
+        self._coro.close()
+        self._handle()
+
+    def _handle(self):
+        builder = self.builder
+        item = self._item
+        for prefix, event, value in self._events:
+            # item fields and item map keys are by far the most frequent events
+            field = _ITEM_FIELDS.get(prefix)
+            if field is not None:
+                if item is not None and event in _SCALARS:
+                    item[field] = value
+            elif prefix == "item.items.item":
+                if event == "start_map":
+                    # same defaults as to_columns: missing price is 0, missing quantity 1
+                    item = [None, 0, 1]
+                elif event == "end_map":
+                    builder.add_item(self._code, *item)
+                    item = None
+            elif prefix == "item":
+                if event == "start_map":
+                    self._code = builder.add_category()
+            elif prefix == "item.category_id":
+                if event in _SCALARS:
+                    builder.set_category_id(self._code, value)
+            elif prefix == "item.name":
+                if event in _SCALARS:
+                    builder.set_category_name(self._code, value)
+        self._item = item
+        del self._events[:]
+
+
+def fold_categories(builder: DailyTotalsBuilder, categories) -> DailyTotalsBuilder:
+    """Feeds an already parsed categories payload into `builder`."""
+    for c in categories:
+        code = builder.add_category(c.get("category_id"), c.get("name", "Unknown"))
+        for it in c.get("items", []) or []:
+            builder.add_item(code, it.get("created_at"), it.get("item_price", 0), it.get("item_quantity", 1))
+    return builder
@@ -0,0 +1,28 @@
+import hashlib
+import os
+from datetime import datetime
+from typing import Optional
+
+ANALYTICS_CACHE_CONTROL = os.getenv("ANALYTICS_CACHE_CONTROL", "private, no-cache")
+
+
+def make_etag(doc_id, updated_at: Optional[datetime]) -> str:
+    """Strong ETag for a stored analytics document; changes on every write."""
+    stamp = updated_at.isoformat() if isinstance(updated_at, datetime) else str(updated_at)
+    digest = hashlib.blake2b(f"{doc_id}:{stamp}".encode("utf-8"), digest_size=12).hexdigest()
+    return f'"{digest}"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """If-None-Match comparison (weak, as RFC 9110 prescribes for this header)."""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == etag:
+            return True
+    return False
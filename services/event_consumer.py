@@ -0,0 +1,786 @@
+"""
+Keeps stored analytics current from item and budget events instead of
+waiting for the next generate/recompute.
+
+Runs inside the app (enabled via ANALYTICS_EVENTS_ENABLED, started from the
+lifespan) or as its own worker:
+
+    python -m services.event_consumer [--prefetch 100]
+
+Events are JSON messages on a topic exchange (routing keys `item.*` and
+`budget.*`):
+
+    {"event_id": "...", "type": "item.created" | "item.updated" | "item.deleted",
+     "user_id": "u1", "seq": 42, "occurred_at": "2026-10-17T10:00:00Z",
+     "item": {"category_id": "c1", "created_at": "...", "item_price": 2.5, "item_quantity": 2},
+     "previous": {...}}                      # item.updated: the item before the change
+    {"event_id": "...", "type": "budget.changed", "user_id": "u1", "seq": 43,
+     "budget": {"category_id": "c1", "month": "2026-10", "limit": 100}}
+
+Item events become `$inc` deltas on the `daily_spend` entry, the matching
+`monthly_data` row and the `weekly_data` day; budget events `$set` the row
+budget. Every updated document remembers the ids of the last events applied
+to it and the update is conditional on them, so redelivered events are not
+counted twice. `seq`, when the producer sends it, is a per-user counter: a
+jump means events were lost and the user's analytics are recomputed from
+category-budget instead. A sealed day only gets the delta if the change
+`occurred_at` after the rollup's last refresh; otherwise that refresh may
+already have read it and the user's rollup is rebuilt instead.
+
+A user whose recompute fails for good (e.g. category-budget answers 404)
+has its events of the batch dead-lettered while the rest is acknowledged.
+Only Mongo connection errors and an unavailable category-budget requeue the
+batch, at most ANALYTICS_EVENTS_MAX_ATTEMPTS times per event, after which
+the event is dead-lettered too.
+
+The queue is declared single-active-consumer: every instance may run the
+consumer, but the broker delivers to one of them at a time and fails over
+to another when it disconnects. Events are therefore applied in order, and
+caches of the other processes expire by their TTL (histograms are rebuilt
+as soon as the rollup's `rebuilt_at` changes).
+"""
+import argparse
+import asyncio
+import concurrent.futures
+import json
+import logging
+import os
+import time
+from collections import deque
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+from uuid import uuid4
+
+import pika
+from pymongo import UpdateOne
+from pymongo.errors import ConnectionFailure, DuplicateKeyError
+
+from db_two.database import close_db, get_db, mongo_now
+from logging_utils import _rabbit_config, correlation_id_var, stop_log_shipping
+from services.aggregation import _to_number, _to_quantity, parse_iso
+from services.auth_service import auth_service
+from services.cache import analytics_cache
+from services.category_budget_client import category_budget_client
+from services.metrics import ANALYTICS_EVENT_BATCH, ANALYTICS_EVENTS
+from services.monthly_service import MAX_BATCH_MONTHS, MONTH_RE, MonthlyService
+from services.resilience import UpstreamUnavailableError
+from services.rollup_service import daily_spend_rollup
+from services.upstream_cache import upstream_cache
+from services.weekly_service import WeeklyService
+from services.window_service import histogram_cache
+
+ANALYTICS_EVENTS_ENABLED = os.getenv("ANALYTICS_EVENTS_ENABLED", "false").lower() in ("1", "true", "yes")
+ANALYTICS_EVENTS_EXCHANGE = os.getenv("ANALYTICS_EVENTS_EXCHANGE", "expense-events")
+ANALYTICS_EVENTS_QUEUE = os.getenv("ANALYTICS_EVENTS_QUEUE", "analytics-events")
+ANALYTICS_EVENTS_ROUTING_KEYS = os.getenv("ANALYTICS_EVENTS_ROUTING_KEYS", "item.*,budget.*")
+ANALYTICS_EVENTS_PREFETCH = int(os.getenv("ANALYTICS_EVENTS_PREFETCH", "100"))
+ANALYTICS_EVENTS_BATCH_WAIT = float(os.getenv("ANALYTICS_EVENTS_BATCH_WAIT", "0.2"))
+ANALYTICS_EVENTS_ID_HISTORY = int(os.getenv("ANALYTICS_EVENTS_ID_HISTORY", "200"))
+ANALYTICS_EVENTS_DEAD_LETTER_EXCHANGE = os.getenv("ANALYTICS_EVENTS_DEAD_LETTER_EXCHANGE", "expense-events.dead-letter")
+ANALYTICS_EVENTS_DEAD_LETTER_QUEUE = os.getenv("ANALYTICS_EVENTS_DEAD_LETTER_QUEUE", "analytics-events.dead-letter")
+ANALYTICS_EVENTS_MAX_ATTEMPTS = int(os.getenv("ANALYTICS_EVENTS_MAX_ATTEMPTS", "10"))
+ANALYTICS_EVENTS_CLOCK_SKEW = float(os.getenv("ANALYTICS_EVENTS_CLOCK_SKEW", "5"))
+
+ITEM_EVENTS = ("item.created", "item.updated", "item.deleted")
+BUDGET_EVENTS = ("budget.changed",)
+RECOMPUTE_TOKEN_TTL = 300
+# worth retrying the whole batch for; anything else is the event's problem
+TRANSIENT_ERRORS = (ConnectionFailure, UpstreamUnavailableError)
+
+
+def _amount(item: dict) -> Tuple[str, str, float]:
+    """(category_id, YYYY-MM-DD, price * quantity) of an item, as the rollup buckets it."""
+    day = parse_iso(item.get("created_at"))
+    price = _to_number(item.get("item_price"), 0, float)
+    qty = _to_number(item.get("item_quantity"), 1, _to_quantity)
+    if item.get("category_id") is None or day is None or price is None or qty is None:
+        raise ValueError("item needs category_id, a valid created_at, item_price and item_quantity")
+    return str(item["category_id"]), day.date().isoformat(), price * qty
+
+
+def _occurred_at(value) -> Optional[datetime]:
+    """An ISO timestamp as naive local time, comparable with mongo_now()."""
+    try:
+        dt = datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    return dt.astimezone().replace(tzinfo=None) if dt.tzinfo is not None else dt
+
+
+def parse_event(body: bytes, routing_key: str = None) -> dict:
+    """
+    Validates a message and reduces it to what the updater needs: `deltas`
+    as (category_id, day, amount) for item events, `budget` as
+    (category_id, month, limit) for budget events. Raises ValueError.
+    """
+    try:
+        raw = json.loads(body)
+    except (TypeError, ValueError):
+        raise ValueError("event is not valid JSON")
+    if not isinstance(raw, dict):
+        raise ValueError("event must be a JSON object")
+    event_type = raw.get("type") or routing_key
+    if not raw.get("event_id") or not raw.get("user_id"):
+        raise ValueError("event_id and user_id are required")
+    seq = raw.get("seq")
+    if seq is not None and (not isinstance(seq, int) or isinstance(seq, bool)):
+        raise ValueError("seq must be an integer")
+
+    event = {"event_id": str(raw["event_id"]), "type": event_type, "user_id": str(raw["user_id"]), "seq": seq}
+    if event_type in ITEM_EVENTS:
+        event["occurred_at"] = _occurred_at(raw.get("occurred_at"))
+        if event["occurred_at"] is None:
+            raise ValueError(f"{event_type} needs occurred_at as an ISO timestamp")
+        deltas = {}
+        changes = []
+        if event_type in ("item.updated", "item.deleted"):
+            changes.append((raw.get("previous") if event_type == "item.updated" else raw.get("item"), -1))
+        if event_type in ("item.created", "item.updated"):
+            changes.append((raw.get("item"), 1))
+        for item, sign in changes:
+            if not isinstance(item, dict):
+                raise ValueError(f"{event_type} needs {'previous and item' if event_type == 'item.updated' else 'item'}")
+            cat_id, day, amount = _amount(item)
+            deltas[(cat_id, day)] = deltas.get((cat_id, day), 0.0) + sign * amount
+        event["deltas"] = [(cat_id, day, amount) for (cat_id, day), amount in deltas.items() if amount]
+    elif event_type in BUDGET_EVENTS:
+        budget = raw.get("budget")
+        if not isinstance(budget, dict) or budget.get("category_id") is None:
+            raise ValueError("budget.changed needs budget.category_id")
+        month = str(budget.get("month", ""))
+        limit = _to_number(budget.get("limit"), 0, float)
+        if not MONTH_RE.match(month) or limit is None:
+            raise ValueError("budget.changed needs month in YYYY-MM format and a numeric limit")
+        event["budget"] = (str(budget["category_id"]), month, limit)
+    else:
+        raise ValueError(f"unknown event type {event_type!r}")
+    return event
+
+
+class IncrementalUpdater:
+    """
+    Applies a batch of parsed events to Mongo with one conditional update per
+    affected document. Analytics that were never generated are left alone;
+    rows that cannot be located (a category new to that month, a window
+    rewritten concurrently) and users with a `seq` gap are recomputed.
+
+    An event consumed after a generate that already saw its change is
+    counted twice in monthly/weekly documents until their next generate,
+    which rebuilds them from the rollup (the fingerprint is dropped on every
+    incremental update, so that generate always writes). Sealed days of the
+    rollup are never reread, so a change there that may predate the last
+    refresh resets the user's rollup instead of adding the delta.
+
+    A recompute that fails with anything but TRANSIENT_ERRORS marks the
+    user's events of the batch "failed" instead of failing the batch.
+    """
+
+    def __init__(self, id_history: int = ANALYTICS_EVENTS_ID_HISTORY):
+        self.logger = logging.getLogger("soa-analytics")
+        self.monthly_service = MonthlyService()
+        self.weekly_service = WeeklyService()
+        self.id_history = max(1, id_history)
+
+    @property
+    def db(self):
+        return get_db()
+
+    async def _guarded_update(self, col, flt: dict, contributions: List[tuple], build, upsert: bool = False) -> bool:
+        """
+        Runs `build(contributions)` as a single update of the document matching
+        `flt` that has none of the contributions' event ids yet, and records
+        the ids. If some were applied before (a redelivery), only the rest is
+        retried. False if no such document exists any more.
+        """
+        for _ in range(2):
+            ids = [c[0] for c in contributions]
+            update = build(contributions)
+            update.setdefault("$push", {})["applied_events"] = {"$each": ids, "$slice": -self.id_history}
+            try:
+                res = await col.update_one({**flt, "applied_events": {"$nin": ids}}, update, upsert=upsert)
+                if res.matched_count or res.upserted_id is not None:
+                    return True
+            except DuplicateKeyError:
+                pass
+            doc = await col.find_one(flt, {"applied_events": 1})
+            if doc is None:
+                return False
+            applied = set(doc.get("applied_events", []))
+            contributions = [c for c in contributions if c[0] not in applied]
+            if not contributions:
+                return True
+        return False
+
+    async def _sequence(self, events: List[dict], outcomes: Dict[str, str]):
+        """
+        Splits the batch per user into events to apply and users whose `seq`
+        jumped. Events at or below the stored seq were applied already (or
+        covered by a recompute) and are skipped.
+        """
+        users = sorted({e["user_id"] for e in events})
+        stored = {
+            d["user_id"]: d.get("seq")
+            async for d in self.db["analytics_event_state"].find({"user_id": {"$in": users}}, {"_id": 0})
+        }
+        accepted, gaps, last_seq, seen = [], set(), {}, set()
+        expected = {u: (stored[u] + 1 if stored.get(u) is not None else None) for u in users}
+        for e in sorted(events, key=lambda e: (e["seq"] is None, e["seq"] or 0)):
+            user_id, seq = e["user_id"], e["seq"]
+            if seq is not None:
+                last_seq[user_id] = max(seq, last_seq.get(user_id, seq))
+            if e["event_id"] in seen:
+                # redelivered within the same batch; the first copy is counted below
+                continue
+            seen.add(e["event_id"])
+            if user_id in gaps:
+                outcomes[e["event_id"]] = "gap"
+            elif seq is None:
+                accepted.append(e)
+            elif expected[user_id] is not None and seq < expected[user_id]:
+                outcomes[e["event_id"]] = "duplicate"
+            elif expected[user_id] is not None and seq > expected[user_id]:
+                gaps.add(user_id)
+                outcomes[e["event_id"]] = "gap"
+            else:
+                expected[user_id] = seq + 1
+                accepted.append(e)
+        # keep the batch order for everything that is applied (budget $sets do not commute)
+        order = {id(e): i for i, e in enumerate(events)}
+        accepted.sort(key=lambda e: order[id(e)])
+        return accepted, gaps, last_seq
+
+    async def apply(self, events: List[dict]) -> Dict[str, str]:
+        """Applies `events` and returns the outcome per event id."""
+        outcomes: Dict[str, str] = {}
+        accepted, gaps, last_seq = await self._sequence(events, outcomes)
+
+        daily: Dict[tuple, list] = {}
+        monthly: Dict[tuple, list] = {}
+        weekly: Dict[str, list] = {}
+        for e in accepted:
+            user_id, eid = e["user_id"], e["event_id"]
+            for cat_id, day, amount in e.get("deltas", ()):
+                daily.setdefault((user_id, cat_id, day), []).append((eid, amount, e["occurred_at"]))
+                monthly.setdefault((user_id, day[:7]), []).append((eid, "spent", cat_id, amount))
+                weekly.setdefault(user_id, []).append((eid, day, amount))
+            if "budget" in e:
+                cat_id, month, limit = e["budget"]
+                monthly.setdefault((user_id, month), []).append((eid, "budget", cat_id, limit))
+            outcomes[eid] = "applied"
+
+        recompute_months: Dict[str, set] = {}
+        recompute_weekly = set()
+        now = mongo_now()
+
+        monthly_docs = {}
+        weekly_docs = {}
+        sealed = {}
+        if daily:
+            async for d in self.db["daily_spend_state"].find(
+                {"user_id": {"$in": sorted({u for u, _, _ in daily})}},
+                {"user_id": 1, "sealed_through": 1, "refreshed_at": 1},
+            ):
+                sealed[d["user_id"]] = (d["sealed_through"], d.get("refreshed_at"))
+        if monthly:
+            users = sorted({u for u, _ in monthly})
+            months = sorted({m for _, m in monthly})
+            async for d in self.db["monthly_data"].find(
+                {"user_id": {"$in": users}, "month": {"$in": months}}, {"user_id": 1, "month": 1, "rows.category_id": 1}
+            ):
+                monthly_docs[(d["user_id"], d["month"])] = [r["category_id"] for r in d.get("rows", [])]
+        if weekly:
+            async for d in self.db["weekly_data"].find(
+                {"user_id": {"$in": sorted(weekly)}, "type": "last7days"}, {"user_id": 1, "days.date": 1}
+            ):
+                weekly_docs[d["user_id"]] = [day["date"] for day in d.get("days", [])]
+
+        writes = []
+        reset = set()
+        for (user_id, cat_id, day), contributions in daily.items():
+            # open days are rebuilt from upstream on the next refresh, which
+            # already includes the change; only sealed days need the delta
+            sealed_through, refreshed_at = sealed.get(user_id, ("", None))
+            if day > sealed_through:
+                continue
+            # ... and only changes the last refresh cannot have read
+            if refreshed_at is None or any(
+                c[2] <= refreshed_at + timedelta(seconds=ANALYTICS_EVENTS_CLOCK_SKEW) for c in contributions
+            ):
+                reset.add(user_id)
+        for (user_id, cat_id, day), contributions in daily.items():
+            if day <= sealed.get(user_id, ("", None))[0] and user_id not in reset:
+                writes.append(self._daily(user_id, cat_id, day, contributions, now))
+        for (user_id, month), contributions in monthly.items():
+            categories = monthly_docs.get((user_id, month))
+            if categories is None:
+                continue
+            if any(c[2] not in categories for c in contributions):
+                recompute_months.setdefault(user_id, set()).add(month)
+                continue
+            writes.append(self._monthly(user_id, month, categories, contributions, now, recompute_months))
+        for user_id, contributions in weekly.items():
+            days = weekly_docs.get(user_id)
+            if days is None:
+                continue
+            contributions = [c for c in contributions if c[1] in days]
+            if contributions:
+                writes.append(self._weekly(user_id, days, contributions, now, recompute_weekly))
+        await asyncio.gather(*writes)
+        for user_id in sorted(reset - gaps):
+            self.logger.warning(
+                "Resetting daily spend rollup, event may predate its last refresh",
+                extra={"path": f"/{user_id}/analytics"},
+            )
+            await daily_spend_rollup.reset(user_id)
+
+        failed: Dict[str, Exception] = {}
+        for user_id in sorted(gaps):
+            await self._try_recompute(user_id, failed, full=True)
+        for user_id in sorted(set(recompute_months) | recompute_weekly):
+            if user_id not in gaps:
+                await self._try_recompute(user_id, failed, months=sorted(recompute_months.get(user_id, ())),
+                                          weekly=user_id in recompute_weekly)
+        for e in accepted:
+            if e["user_id"] in recompute_months or e["user_id"] in recompute_weekly:
+                outcomes[e["event_id"]] = "recompute"
+        for e in events:
+            if e["user_id"] in failed:
+                outcomes[e["event_id"]] = "failed"
+        # the seq of a failed user stays put, so its next event recomputes again
+        last_seq = {u: seq for u, seq in last_seq.items() if u not in failed}
+
+        if last_seq:
+            await self.db["analytics_event_state"].bulk_write([
+                UpdateOne({"user_id": u}, {"$max": {"seq": seq}, "$set": {"updated_at": now}}, upsert=True)
+                for u, seq in last_seq.items()
+            ], ordered=False)
+
+        for user_id, month in monthly:
+            analytics_cache.invalidate(("monthly", user_id, month))
+        for user_id in {e["user_id"] for e in events}:
+            analytics_cache.invalidate(("weekly", user_id, "last7days"))
+            histogram_cache.invalidate(user_id)
+            await upstream_cache.invalidate(user_id)
+        return outcomes
+
+    async def _try_recompute(self, user_id: str, failed: Dict[str, Exception], **kwargs):
+        try:
+            await self._recompute(user_id, **kwargs)
+        except TRANSIENT_ERRORS:
+            raise
+        except Exception as e:
+            failed[user_id] = e
+            self.logger.error(
+                "Recomputing analytics failed, dead-lettering the user's events",
+                extra={"path": f"/{user_id}/analytics", "detail": f"{type(e).__name__}: {e}"},
+            )
+
+    async def _daily(self, user_id, cat_id, day, contributions, now):
+        def build(contribs):
+            return {"$inc": {"spent": sum(c[1] for c in contribs)}, "$set": {"updated_at": now}}
+        if await self._guarded_update(
+            self.db["daily_spend"], {"user_id": user_id, "category_id": cat_id, "date": day},
+            contributions, build, upsert=True,
+        ):
+            # histograms cached by other processes are stamped with rebuilt_at
+            await daily_spend_rollup.touch(user_id, now)
+
+    async def _monthly(self, user_id, month, categories, contributions, now, recompute_months):
+        index = {cat_id: i for i, cat_id in enumerate(categories)}
+
+        def build(contribs):
+            inc, budgets = {}, {}
+            for _, field, cat_id, value in contribs:
+                if field == "spent":
+                    inc[f"rows.{index[cat_id]}.spent"] = inc.get(f"rows.{index[cat_id]}.spent", 0.0) + value
+                else:
+                    budgets[f"rows.{index[cat_id]}.budget"] = value
+            # the stored fingerprint no longer describes the rows
+            update = {"$set": {**budgets, "updated_at": now}, "$unset": {"fingerprint": ""}}
+            if inc:
+                update["$inc"] = inc
+            return update
+
+        # the row positions read above must still hold
+        flt = {"user_id": user_id, "month": month}
+        flt.update({f"rows.{index[c[2]]}.category_id": c[2] for c in contributions})
+        if not await self._guarded_update(self.db["monthly_data"], flt, contributions, build):
+            recompute_months.setdefault(user_id, set()).add(month)
+
+    async def _weekly(self, user_id, days, contributions, now, recompute_weekly):
+        index = {day: i for i, day in enumerate(days)}
+
+        def build(contribs):
+            inc = {}
+            for _, day, amount in contribs:
+                inc[f"days.{index[day]}.spent"] = inc.get(f"days.{index[day]}.spent", 0.0) + amount
+            return {"$inc": inc, "$set": {"updated_at": now}, "$unset": {"fingerprint": ""}}
+
+        flt = {"user_id": user_id, "type": "last7days"}
+        flt.update({f"days.{index[c[1]]}.date": c[1] for c in contributions})
+        if not await self._guarded_update(self.db["weekly_data"], flt, contributions, build):
+            recompute_weekly.add(user_id)
+
+    async def _recompute(self, user_id: str, months: List[str] = (), weekly: bool = False, full: bool = False):
+        """
+        Regenerates stored analytics from category-budget. `full` rebuilds the
+        whole rollup and every stored month and window of the user.
+        Raises if upstream is unavailable, so the batch is retried.
+        """
+        correlation_id_var.set(f"events-{uuid4()}")
+        token = auth_service.create_service_token(user_id, RECOMPUTE_TOKEN_TTL)
+        if full:
+            await daily_spend_rollup.reset(user_id)
+            months = sorted(await self.db["monthly_data"].distinct("month", {"user_id": user_id}))
+            weekly = await self.db["weekly_data"].find_one({"user_id": user_id, "type": "last7days"}, {"_id": 1}) is not None
+        self.logger.warning(
+            "Recomputing analytics after missed events",
+            extra={"path": f"/{user_id}/analytics", "detail": f"full={full} months={len(months)} weekly={weekly}"},
+        )
+        for i in range(0, len(months), MAX_BATCH_MONTHS):
+            await self.monthly_service.generate_batch(user_id, months=months[i:i + MAX_BATCH_MONTHS], jwt_token=token)
+        if weekly:
+            result = await self.weekly_service.generate_last7days(user_id, token)
+            if result.get("stale"):
+                raise UpstreamUnavailableError("category-budget unavailable, served stale")
+
+
+class Message:
+    __slots__ = ("tag", "body", "routing_key", "channel")
+
+    def __init__(self, tag, body: bytes, routing_key: str = None, channel=None):
+        self.tag = tag
+        self.body = body
+        self.routing_key = routing_key
+        self.channel = channel
+
+
+class MemoryEventSource:
+    """In-process stand-in for the broker, for local runs and benchmarks."""
+
+    def __init__(self):
+        self._queue: "deque[Message]" = deque()
+        self._ready = asyncio.Event()
+        self._tags = 0
+        self.acked = 0
+        self.requeued = 0
+        self.dead_letters: List[Message] = []
+
+    def publish(self, event: dict, routing_key: str = None):
+        self._tags += 1
+        self._queue.append(Message(self._tags, json.dumps(event).encode("utf-8"), routing_key or event.get("type")))
+        self._ready.set()
+
+    def __len__(self):
+        return len(self._queue)
+
+    async def fetch(self, max_messages: int, timeout: float) -> List[Message]:
+        if not self._queue:
+            self._ready.clear()
+            try:
+                await asyncio.wait_for(self._ready.wait(), timeout)
+            except asyncio.TimeoutError:
+                return []
+        batch = []
+        while self._queue and len(batch) < max_messages:
+            batch.append(self._queue.popleft())
+        return batch
+
+    async def ack(self, messages: List[Message]):
+        self.acked += len(messages)
+
+    async def nack(self, messages: List[Message]):
+        self.requeued += len(messages)
+        self._queue.extendleft(reversed(messages))
+        self._ready.set()
+
+    async def reject(self, messages: List[Message]):
+        self.dead_letters.extend(messages)
+
+    async def close(self):
+        pass
+
+
+class RabbitMQEventSource:
+    """
+    Consumes the events queue with pika. Nothing connects until the first
+    fetch; every pika call runs on one dedicated thread, since a
+    BlockingConnection must not be shared between threads. The broker never
+    has more than `prefetch` unacknowledged messages in flight, which is
+    also the largest batch. Rejected messages go to the dead-letter queue.
+    """
+
+    def __init__(self, prefetch: int = ANALYTICS_EVENTS_PREFETCH, batch_wait: float = ANALYTICS_EVENTS_BATCH_WAIT):
+        cfg = _rabbit_config()
+        self.connection_params = pika.ConnectionParameters(
+            host=cfg["host"],
+            port=cfg["port"],
+            credentials=pika.PlainCredentials(cfg["user"], cfg["password"]),
+            heartbeat=cfg["heartbeat"],
+            socket_timeout=cfg["connect_timeout"],
+            blocked_connection_timeout=cfg["connect_timeout"],
+            connection_attempts=1,
+        )
+        self.prefetch = max(1, prefetch)
+        self.batch_wait = batch_wait
+        self.connection = None
+        self.channel = None
+        self._consumer = None
+        self._executor = None
+
+    def _run(self, fn, *args):
+        if self._executor is None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix="rabbitmq-events")
+        return asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    def _connect(self):
+        if self.connection and self.connection.is_open and self.channel and self.channel.is_open:
+            return
+        self._disconnect()
+        self.connection = pika.BlockingConnection(self.connection_params)
+        self.channel = self.connection.channel()
+        self.channel.exchange_declare(exchange=ANALYTICS_EVENTS_EXCHANGE, exchange_type="topic", durable=True)
+        # only one consumer of the queue gets messages, the others wait as
+        # standbys: two workers applying events of the same user at once
+        # would see each other's seq as gaps
+        self.channel.exchange_declare(exchange=ANALYTICS_EVENTS_DEAD_LETTER_EXCHANGE, exchange_type="fanout", durable=True)
+        self.channel.queue_declare(queue=ANALYTICS_EVENTS_DEAD_LETTER_QUEUE, durable=True)
+        self.channel.queue_bind(queue=ANALYTICS_EVENTS_DEAD_LETTER_QUEUE, exchange=ANALYTICS_EVENTS_DEAD_LETTER_EXCHANGE)
+        self.channel.queue_declare(
+            queue=ANALYTICS_EVENTS_QUEUE, durable=True,
+            arguments={
+                "x-single-active-consumer": True,
+                "x-dead-letter-exchange": ANALYTICS_EVENTS_DEAD_LETTER_EXCHANGE,
+            },
+        )
+        for key in ANALYTICS_EVENTS_ROUTING_KEYS.split(","):
+            self.channel.queue_bind(queue=ANALYTICS_EVENTS_QUEUE, exchange=ANALYTICS_EVENTS_EXCHANGE, routing_key=key.strip())
+        self.channel.basic_qos(prefetch_count=self.prefetch)
+        # short inactivity timeout: lets a batch end as soon as the prefetched messages are drained
+        self._consumer = self.channel.consume(ANALYTICS_EVENTS_QUEUE, auto_ack=False, inactivity_timeout=0.05)
+
+    def _disconnect(self):
+        try:
+            if self.connection and self.connection.is_open:
+                self.connection.close()
+        except Exception:
+            pass
+        self.connection = self.channel = self._consumer = None
+
+    def _fetch(self, max_messages: int, timeout: float) -> List[Message]:
+        try:
+            self._connect()
+            batch = []
+            started = first_at = time.monotonic()
+            while len(batch) < max_messages:
+                method, _, body = next(self._consumer)
+                now = time.monotonic()
+                if method is None:
+                    # nothing buffered: wait up to `timeout` for the first
+                    # message, end the batch once it has any
+                    if batch or now - started >= timeout:
+                        break
+                    continue
+                if not batch:
+                    first_at = now
+                batch.append(Message(method.delivery_tag, body, method.routing_key, self.channel))
+                if now - first_at >= self.batch_wait:
+                    break
+            return batch
+        except Exception:
+            self._disconnect()
+            raise
+
+    def _settle(self, messages: List[Message], ack: bool, requeue: bool = True):
+        # tags belong to the channel that delivered them; after a reconnect
+        # the broker has already requeued those messages
+        messages = [m for m in messages if m.channel is self.channel]
+        if not messages or not self.channel.is_open:
+            return
+        try:
+            if ack:
+                # the consumer settles nacks and rejects of a batch first, so
+                # everything up to the last tag is to be acknowledged
+                self.channel.basic_ack(delivery_tag=max(m.tag for m in messages), multiple=True)
+            else:
+                for m in messages:
+                    self.channel.basic_nack(delivery_tag=m.tag, multiple=False, requeue=requeue)
+        except Exception:
+            self._disconnect()
+            raise
+
+    async def fetch(self, max_messages: int, timeout: float) -> List[Message]:
+        return await self._run(self._fetch, max_messages, timeout)
+
+    async def ack(self, messages: List[Message]):
+        await self._run(self._settle, messages, True)
+
+    async def nack(self, messages: List[Message]):
+        await self._run(self._settle, messages, False)
+
+    async def reject(self, messages: List[Message]):
+        await self._run(self._settle, messages, False, False)
+
+    async def close(self):
+        if self._executor is not None:
+            await self._run(self._disconnect)
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+
+class EventConsumer:
+    """
+    Fetches up to `prefetch` messages at a time, applies them as one batch
+    and acknowledges the batch. A batch that fails (Mongo or category-budget
+    unavailable during a recompute) is requeued and retried with backoff;
+    re-applying it is safe. An event that was in `max_attempts` failed
+    batches, and the events of a user whose recompute failed for good, are
+    dead-lettered. Malformed messages are logged and dropped.
+    """
+
+    def __init__(self, source=None, prefetch: int = ANALYTICS_EVENTS_PREFETCH, max_backoff: float = 30.0,
+                 max_attempts: int = ANALYTICS_EVENTS_MAX_ATTEMPTS):
+        self.logger = logging.getLogger("soa-analytics")
+        self.source = source if source is not None else RabbitMQEventSource(prefetch)
+        self.updater = IncrementalUpdater()
+        self.prefetch = max(1, prefetch)
+        self.max_backoff = max_backoff
+        self.max_attempts = max(1, max_attempts)
+        self._task: Optional[asyncio.Task] = None
+        # event_id -> failed batches it was in, while it is being retried
+        self._attempts: Dict[str, int] = {}
+
+        self.batches = 0
+        self.failed_batches = 0
+        self.outcomes: Dict[str, int] = {}
+        self.last_batch_at: Optional[datetime] = None
+        self.last_error: Optional[str] = None
+
+    def _count(self, event_type: str, outcome: str):
+        self.outcomes[outcome] = self.outcomes.get(outcome, 0) + 1
+        ANALYTICS_EVENTS.labels(event_type or "unknown", outcome).inc()
+
+    async def consume_once(self, timeout: float = 1.0) -> int:
+        """Fetches, applies and settles one batch; returns its size."""
+        messages = await self.source.fetch(self.prefetch, timeout)
+        if not messages:
+            return 0
+        parsed, invalid = [], []
+        for m in messages:
+            try:
+                parsed.append((m, parse_event(m.body, m.routing_key)))
+            except ValueError as e:
+                invalid.append(m)
+                self._count(m.routing_key, "invalid")
+                self.logger.error("Dropped invalid analytics event", extra={"detail": f"{e}: {m.body[:200]!r}"})
+        events = [e for _, e in parsed]
+        try:
+            outcomes = await self.updater.apply(events) if events else {}
+        except Exception:
+            await self._retry_later(parsed, invalid)
+            raise
+        except BaseException:
+            await self.source.nack(messages)
+            raise
+        failed = [m for m, e in parsed if outcomes.get(e["event_id"]) == "failed"]
+        await self.source.reject(failed)
+        await self.source.ack([m for m, e in parsed if outcomes.get(e["event_id"]) != "failed"] + invalid)
+        counted = set()
+        for e in events:
+            self._attempts.pop(e["event_id"], None)
+            outcome = "duplicate" if e["event_id"] in counted else outcomes.get(e["event_id"], "applied")
+            counted.add(e["event_id"])
+            self._count(e["type"], outcome)
+        self.batches += 1
+        self.last_batch_at = datetime.now()
+        ANALYTICS_EVENT_BATCH.observe(len(messages))
+        return len(messages)
+
+    async def _retry_later(self, parsed: List[Tuple[object, dict]], invalid: list):
+        """Requeues a failed batch, except events that have used up their attempts."""
+        retry, dead = [], []
+        for m, e in parsed:
+            attempts = self._attempts.get(e["event_id"], 0) + 1
+            if attempts >= self.max_attempts:
+                self._attempts.pop(e["event_id"], None)
+                dead.append((m, e))
+            else:
+                self._attempts[e["event_id"]] = attempts
+                retry.append(m)
+        if dead:
+            self.logger.error(
+                "Dead-lettered analytics events after repeated failures",
+                extra={"detail": f"events={len(dead)} attempts={self.max_attempts}"},
+            )
+        await self.source.reject([m for m, _ in dead])
+        await self.source.nack(retry)
+        await self.source.ack(invalid)
+        for _, e in dead:
+            self._count(e["type"], "failed")
+
+    async def _loop(self):
+        delay = 1.0
+        while True:
+            try:
+                await self.consume_once()
+                self.last_error = None
+                delay = 1.0
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.failed_batches += 1
+                self.last_error = str(e) or type(e).__name__
+                self.logger.error("Analytics event batch failed", extra={"detail": self.last_error})
+                await asyncio.sleep(delay)
+                delay = min(self.max_backoff, delay * 2)
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.source.close()
+
+    def stats(self):
+        return {
+            "running": self._task is not None and not self._task.done(),
+            "batches": self.batches,
+            "failed_batches": self.failed_batches,
+            "events": dict(self.outcomes),
+            "last_batch_at": self.last_batch_at,
+            "last_error": self.last_error,
+        }
+
+
+event_consumer = EventConsumer()
+
+
+async def _main(args):
+    auth_service.check_service_secret()
+    consumer = EventConsumer(prefetch=args.prefetch)
+    consumer.start()
+    try:
+        await consumer._task
+    finally:
+        await consumer.stop()
+        await category_budget_client.close()
+        await close_db()
+        stop_log_shipping()
+
+
+if __name__ == "__main__":
+    from logging_utils import setup_logging, start_log_shipping
+
+    parser = argparse.ArgumentParser(description="Apply item and budget events to stored analytics.")
+    parser.add_argument("--prefetch", type=int, default=ANALYTICS_EVENTS_PREFETCH,
+                        help="unacknowledged messages in flight, also the largest batch")
+    setup_logging("soa-analytics")
+    start_log_shipping()
+    asyncio.run(_main(parser.parse_args()))
@@ -0,0 +1,92 @@
+from datetime import date, timedelta
+from itertools import accumulate
+from typing import Dict, Iterable, List, Optional, Tuple
+
+# prefix differences carry float noise (0.1 + 0.2 - 0.1 != 0.2); rounded
+# well below a cent so sums still match what the rollup stores
+_DIGITS = 6
+
+
+class DailyHistogram:
+    """
+    A user's spend per day and category over [start, start + days), with a
+    prefix sum per category and one over all categories. Built once from the
+    `daily_spend` rollup, after which the total of any window is two lookups
+    and its day series O(days), independent of the number of items.
+    Days outside the covered range count as zero.
+    """
+
+    __slots__ = ("start", "days", "category_ids", "_codes", "_daily", "_prefix", "_total_daily", "_total_prefix")
+
+    def __init__(self, start: date, days: int, category_ids: List[str], daily: List[List[float]]):
+        self.start = start
+        self.days = days
+        self.category_ids = category_ids
+        self._codes = {cat_id: code for code, cat_id in enumerate(category_ids)}
+        self._daily = daily
+        self._prefix = [list(accumulate(row, initial=0.0)) for row in daily]
+        self._total_daily = [sum(col) for col in zip(*daily)] if daily else [0.0] * days
+        self._total_prefix = list(accumulate(self._total_daily, initial=0.0))
+
+    @classmethod
+    def from_entries(cls, entries: List[dict], category_ids: Optional[Iterable[str]] = None) -> "DailyHistogram":
+        """
+        Builds the histogram from `daily_spend` entries ({category_id, date,
+        spent}). With `category_ids`, entries of other categories (e.g. ones
+        deleted upstream) are left out of every sum, as from monthly rows.
+        """
+        if category_ids is not None:
+            known = set(category_ids)
+            entries = [e for e in entries if e["category_id"] in known]
+        if not entries:
+            return cls(date.today(), 0, [], [])
+        dates = [e["date"] for e in entries]
+        start = date.fromisoformat(min(dates))
+        days = (date.fromisoformat(max(dates)) - start).days + 1
+        category_ids = sorted({e["category_id"] for e in entries})
+        codes = {cat_id: code for code, cat_id in enumerate(category_ids)}
+        daily = [[0.0] * days for _ in category_ids]
+        for e in entries:
+            daily[codes[e["category_id"]]][(date.fromisoformat(e["date"]) - start).days] += e["spent"]
+        return cls(start, days, category_ids, daily)
+
+    def _index(self, day: date) -> int:
+        return min(max((day - self.start).days, 0), self.days)
+
+    def _bounds(self, start: date, end: date) -> Tuple[int, int]:
+        return self._index(start), self._index(end)
+
+    def total(self, start: date, end: date, category_id: Optional[str] = None) -> float:
+        """Spend with start <= date < end, of one category or all."""
+        lo, hi = self._bounds(start, end)
+        if category_id is None:
+            prefix = self._total_prefix
+        elif category_id in self._codes:
+            prefix = self._prefix[self._codes[category_id]]
+        else:
+            return 0.0
+        return round(prefix[hi] - prefix[lo], _DIGITS)
+
+    def by_category(self, start: date, end: date) -> Dict[str, float]:
+        """Spend per category with start <= date < end."""
+        lo, hi = self._bounds(start, end)
+        return {
+            cat_id: round(prefix[hi] - prefix[lo], _DIGITS)
+            for cat_id, prefix in zip(self.category_ids, self._prefix)
+        }
+
+    def daily(self, start: date, end: date, category_id: Optional[str] = None) -> List[Tuple[str, float]]:
+        """(YYYY-MM-DD, spent) for every day with start <= date < end, zeros included."""
+        if category_id is None:
+            values = self._total_daily
+        elif category_id in self._codes:
+            values = self._daily[self._codes[category_id]]
+        else:
+            values = ()
+        out = []
+        for i in range((end - start).days):
+            day = start + timedelta(days=i)
+            offset = (day - self.start).days
+            spent = values[offset] if 0 <= offset < len(values) else 0.0
+            out.append((day.isoformat(), round(spent, _DIGITS)))
+        return out
@@ -0,0 +1,219 @@
+"""
+Prometheus metrics for the analytics service, served on `GET /metrics`.
+
+prometheus_client is optional: without it (or with METRICS_ENABLED=false)
+every metric below is a no-op and `/metrics` returns 404. Observations are
+plain in-process counter updates, so the cost does not depend on whether
+anyone scrapes. With several worker processes set PROMETHEUS_MULTIPROC_DIR
+(see the prometheus_client docs) so the endpoint aggregates all workers.
+"""
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import prometheus_client
+    from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+except ImportError:  # pragma: no cover - prometheus_client is optional
+    prometheus_client = None
+
+from services.cache import analytics_cache
+from services.profiling import mongo_profiling_listeners, record
+
+METRICS_ENABLED = (
+    os.getenv("METRICS_ENABLED", "true").lower() in ("1", "true", "yes") and prometheus_client is not None
+)
+
+_BYTES_BUCKETS = tuple(2 ** p for p in range(10, 27, 2))  # 1 KiB .. 64 MiB
+_COUNT_BUCKETS = (0, 10, 100, 1_000, 10_000, 100_000, 1_000_000)
+_FAST_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+
+class _NoopMetric:
+    def labels(self, *args, **kwargs):
+        return self
+
+    def observe(self, value):
+        pass
+
+    def inc(self, value=1):
+        pass
+
+    def set(self, value):
+        pass
+
+
+_NOOP = _NoopMetric()
+
+
+def _histogram(name, documentation, labels, buckets=None):
+    if not METRICS_ENABLED:
+        return _NOOP
+    kwargs = {"buckets": buckets} if buckets else {}
+    return prometheus_client.Histogram(name, documentation, labels, **kwargs)
+
+
+def _counter(name, documentation, labels):
+    if not METRICS_ENABLED:
+        return _NOOP
+    return prometheus_client.Counter(name, documentation, labels)
+
+
+def _gauge(name, documentation, labels, multiprocess_mode="max"):
+    if not METRICS_ENABLED:
+        return _NOOP
+    return prometheus_client.Gauge(name, documentation, labels, multiprocess_mode=multiprocess_mode)
+
+
+REQUEST_SECONDS = _histogram(
+    "analytics_http_request_duration_seconds", "HTTP request latency by route template.",
+    ["method", "route", "status"],
+)
+UPSTREAM_SECONDS = _histogram(
+    "analytics_upstream_request_duration_seconds", "category-budget call latency, including the body.",
+    ["endpoint"],
+)
+UPSTREAM_REQUESTS = _counter(
+    "analytics_upstream_requests_total", "category-budget calls by endpoint and HTTP status.",
+    ["endpoint", "status"],
+)
+UPSTREAM_RETRIES = _counter(
+    "analytics_upstream_retries_total",
+    "category-budget retries by endpoint and reason; reason=budget_exhausted counts retries not taken.",
+    ["endpoint", "reason"],
+)
+UPSTREAM_HEDGES = _counter(
+    "analytics_upstream_hedged_requests_total", "Hedged category-budget requests sent, and how many won.",
+    ["endpoint", "outcome"],
+)
+UPSTREAM_CIRCUIT_STATE = _gauge(
+    "analytics_upstream_circuit_state", "category-budget circuit breaker: 0 closed, 1 half-open, 2 open.",
+    ["upstream"],
+)
+UPSTREAM_CIRCUIT_TRANSITIONS = _counter(
+    "analytics_upstream_circuit_transitions_total", "category-budget circuit breaker transitions by new state.",
+    ["upstream", "state"],
+)
+UPSTREAM_BYTES = _histogram(
+    "analytics_upstream_response_bytes", "Size of category-budget response bodies.",
+    ["endpoint"], _BYTES_BUCKETS,
+)
+MONGO_SECONDS = _histogram(
+    "analytics_mongo_operation_duration_seconds", "MongoDB command latency by collection and command.",
+    ["collection", "operation"], _FAST_BUCKETS,
+)
+MONGO_FAILURES = _counter(
+    "analytics_mongo_operation_failures_total", "Failed MongoDB commands by collection and command.",
+    ["collection", "operation"],
+)
+AGGREGATION_SECONDS = _histogram(
+    "analytics_aggregation_duration_seconds", "CPU time spent building analytics documents.",
+    ["kind"], _FAST_BUCKETS,
+)
+AGGREGATION_ITEMS = _histogram(
+    "analytics_aggregation_items", "Items (rollup refresh) or rollup entries (monthly/weekly) per aggregation.",
+    ["kind"], _COUNT_BUCKETS,
+)
+UPSTREAM_CACHE_LOOKUPS = _counter(
+    "analytics_upstream_cache_lookups_total", "Upstream response cache lookups by endpoint and result.",
+    ["endpoint", "result"],
+)
+SINGLEFLIGHT_CALLS = _counter(
+    "analytics_singleflight_calls_total",
+    "generate/recompute calls that ran (leader), joined an in-flight run (coalesced) or reused its result.",
+    ["kind", "outcome"],
+)
+
+ANALYTICS_EVENTS = _counter(
+    "analytics_events_total",
+    "Consumed item/budget events by type and outcome (applied, duplicate, gap, recompute, invalid).",
+    ["type", "outcome"],
+)
+ANALYTICS_EVENT_BATCH = _histogram(
+    "analytics_event_batch_size", "Events per consumed batch.",
+    [], (1, 5, 10, 25, 50, 100, 250, 500, 1000),
+)
+
+
+@contextmanager
+def timed(histogram, *labels, phase=None):
+    """
+    Observes the duration of the block on `histogram.labels(*labels)` and,
+    with `phase`, adds it to that phase of a profiled request.
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        histogram.labels(*labels).observe(elapsed)
+        if phase is not None:
+            record(phase, elapsed)
+
+
+def observe_request(method: str, route: str, status_code: int, seconds: float):
+    REQUEST_SECONDS.labels(method, route, str(status_code)).observe(seconds)
+
+
+if prometheus_client is not None:
+    from pymongo import monitoring
+
+    class MongoCommandMetrics(monitoring.CommandListener):
+        """pymongo command listener feeding MONGO_SECONDS / MONGO_FAILURES."""
+
+        def __init__(self):
+            self._pending = {}
+            self._lock = threading.Lock()
+
+        def started(self, event):
+            key = "collection" if event.command_name == "getMore" else event.command_name
+            collection = event.command.get(key)
+            if not isinstance(collection, str):
+                collection = "-"
+            with self._lock:
+                self._pending[(event.connection_id, event.request_id)] = collection
+
+        def _finish(self, event):
+            with self._lock:
+                return self._pending.pop((event.connection_id, event.request_id), "-")
+
+        def succeeded(self, event):
+            collection = self._finish(event)
+            MONGO_SECONDS.labels(collection, event.command_name).observe(event.duration_micros / 1e6)
+
+        def failed(self, event):
+            collection = self._finish(event)
+            MONGO_SECONDS.labels(collection, event.command_name).observe(event.duration_micros / 1e6)
+            MONGO_FAILURES.labels(collection, event.command_name).inc()
+
+    class CacheCollector:
+        """Exports analytics_cache.stats() at scrape time."""
+
+        def collect(self):
+            stats = analytics_cache.stats()
+            yield GaugeMetricFamily("analytics_cache_entries", "Documents in the analytics cache.", stats["size"])
+            for name in ("hits", "misses", "evictions", "expirations"):
+                yield CounterMetricFamily(
+                    f"analytics_cache_{name}", f"Analytics cache {name}.", value=stats[name]
+                )
+
+
+def mongo_event_listeners():
+    """Listeners to pass to the Mongo client; empty when metrics and profiling are disabled."""
+    return ([MongoCommandMetrics()] if METRICS_ENABLED else []) + mongo_profiling_listeners()
+
+
+if METRICS_ENABLED:
+    prometheus_client.REGISTRY.register(CacheCollector())
+
+
+def render_metrics():
+    """Returns (body, content type) for the /metrics endpoint."""
+    registry = prometheus_client.REGISTRY
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+
+        registry = prometheus_client.CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return prometheus_client.generate_latest(registry), prometheus_client.CONTENT_TYPE_LATEST
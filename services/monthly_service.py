@@ -1,20 +1,53 @@
+import asyncio
+import json
 import logging
-import os
 import re
-import requests
+import httpx
 from datetime import datetime
-from db_two.database import get_db
+from pymongo import ReturnDocument, UpdateOne
+from db_two.database import get_db, mongo_now
 from logging_utils import get_correlation_id
+from models.monthly_model import MONTHLY_RESPONSE_PROJECTION, MonthlyResponse
+from services.cache import MISSING, analytics_cache
+from services.category_budget_client import CATEGORY_BUDGET_SERVE_STALE, category_budget_client
+from services.etag import make_etag
+from services.metrics import AGGREGATION_ITEMS, AGGREGATION_SECONDS, timed
+from services.resilience import UpstreamUnavailableError
+from services.rollup_service import daily_spend_rollup, rollup_fingerprint, spent_by_category
+from services.singleflight import generate_flight
 
 MONTH_RE = re.compile(r"^\d{4}-(0[1-9]|1[0-2])$")
+MAX_BATCH_MONTHS = 24
+MAX_RANGE_MONTHS = 60
+RANGE_PROJECTION = {"_id": 1, "month": 1, "rows": 1, "created_at": 1, "updated_at": 1}
 
-CATEGORY_BUDGET_URL = os.getenv("CATEGORY_BUDGET_URL", "http://localhost:8002").rstrip("/")
+
+def validate_month_range(from_month: str, to_month: str, limit: int = MAX_RANGE_MONTHS):
+    if not MONTH_RE.match(from_month) or not MONTH_RE.match(to_month):
+        raise ValueError("month must be in YYYY-MM format")
+    if from_month > to_month:
+        raise ValueError("from must not be after to")
+    span = (int(to_month[0:4]) - int(from_month[0:4])) * 12 + int(to_month[5:7]) - int(from_month[5:7]) + 1
+    if span > limit:
+        raise ValueError(f"At most {limit} months can be read at once")
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
 
 class MonthlyService:
     def __init__(self):
         self.logger = logging.getLogger("soa-analytics")
-        self.db = get_db()
-        self.col = self.db["monthly_data"]
+
+    @property
+    def db(self):
+        return get_db()
+
+    @property
+    def col(self):
+        return self.db["monthly_data"]
 
     def _month_bounds(self, month: str):
         y = int(month[0:4])
@@ -26,172 +59,314 @@ class MonthlyService:
             end = datetime(y, m + 1, 1)
         return start, end
 
-    def _parse_iso(self, s):
-        try:
-            return datetime.fromisoformat(str(s).replace("Z", "+00:00"))
-        except Exception:
-            return None
+    def _month_range(self, from_month: str, to_month: str, limit: int = MAX_BATCH_MONTHS):
+        y, m = int(from_month[0:4]), int(from_month[5:7])
+        end_y, end_m = int(to_month[0:4]), int(to_month[5:7])
+        months = []
+        while (y, m) <= (end_y, end_m):
+            months.append(f"{y:04d}-{m:02d}")
+            if len(months) > limit:
+                break
+            m += 1
+            if m == 13:
+                y, m = y + 1, 1
+        return months
 
-    def generate(self, user_id: str, month: str, jwt_token: str = None):
-        if not MONTH_RE.match(month):
-            raise ValueError("month must be in YYYY-MM format")
+    def _resolve_months(self, months=None, from_month: str = None, to_month: str = None):
+        if months:
+            requested = list(months)
+        elif from_month and to_month:
+            validate_month_range(from_month, to_month)
+            requested = self._month_range(from_month, to_month)
+        else:
+            raise ValueError("Provide either months or from/to")
 
-        headers = {}
-        correlation_id = get_correlation_id()
-        if correlation_id:
-            headers["X-Correlation-Id"] = correlation_id
-        if jwt_token:
-            headers["Authorization"] = f"Bearer {jwt_token}"
+        for month in requested:
+            if not MONTH_RE.match(month):
+                raise ValueError("month must be in YYYY-MM format")
 
+        requested = sorted(set(requested))
+        if len(requested) > MAX_BATCH_MONTHS:
+            raise ValueError(f"At most {MAX_BATCH_MONTHS} months can be generated at once")
+        return requested
+
+    def _build_rows(self, categories, spent_by_cat, budget_by_cat):
+        rows = []
+        for c in categories:
+            cat_id = c["category_id"]
+            rows.append({
+                "category_id": cat_id,
+                "category_name": c["name"],
+                "budget": float(budget_by_cat.get(cat_id, 0)),
+                "spent": spent_by_cat.get(cat_id, 0.0)
+            })
+        return rows
+
+    def _month_documents(self, categories, months, entries, budgets_per_month, fingerprints):
+        """
+        (month, fingerprint, rows) of every month in `months` whose fingerprint
+        differs from the stored one in `fingerprints`. `entries` are the rollup
+        entries of the whole range, bucketed by month in a single pass.
+        """
+        entries_by_month = {month: [] for month in months}
+        for e in entries:
+            bucket = entries_by_month.get(e["date"][:7])
+            if bucket is not None:
+                bucket.append(e)
+
+        documents = []
+        for month, budgets in zip(months, budgets_per_month):
+            budget_by_cat = {str(b["category_id"]): float(b.get("limit", 0)) for b in budgets}
+            month_entries = entries_by_month[month]
+            fingerprint = rollup_fingerprint(categories, month_entries, sorted(budget_by_cat.items()))
+            if fingerprints.get(month) == fingerprint:
+                continue
+            rows = self._build_rows(categories, spent_by_category(month_entries), budget_by_cat)
+            documents.append((month, fingerprint, rows))
+        return documents
+
+    async def _stored_fingerprints(self, user_id: str, months):
+        cursor = self.col.find(
+            {"user_id": user_id, "month": {"$in": months}}, {"month": 1, "fingerprint": 1}
+        )
+        return {d["month"]: d.get("fingerprint") async for d in cursor}
+
+    def _unchanged(self, user_id: str, month: str, monthly_id):
         self.logger.info(
-            "Requesting budgets for monthly analytics",
+            "Monthly analytics unchanged",
             extra={
-                "correlation_id": correlation_id,
-                "url": f"{CATEGORY_BUDGET_URL}/{user_id}/budgets",
-                "method": "GET",
+                "correlation_id": get_correlation_id(),
+                "path": f"/{user_id}/analytics/monthly/{month}",
+                "detail": f"monthly_id={monthly_id}",
             },
         )
-        rb = requests.get(
-            f"{CATEGORY_BUDGET_URL}/{user_id}/budgets",
-            params={"month": month},
-            headers=headers,
-            timeout=8
-        )
-        if rb.status_code != 200:
-            try:
-                error_detail = rb.json().get("detail", rb.text)
-            except:
-                error_detail = rb.text or f"Status code: {rb.status_code}"
-            self.logger.error(
-                "Budget service error",
-                extra={
-                    "correlation_id": correlation_id,
-                    "url": f"{CATEGORY_BUDGET_URL}/{user_id}/budgets",
-                    "method": "GET",
-                    "status_code": rb.status_code,
-                    "detail": error_detail,
-                },
-            )
-            raise ValueError(f"Budget service error ({rb.status_code}): {error_detail}")
+        return {"message": "Monthly analytics unchanged", "monthly_id": str(monthly_id)}
 
-        budgets = rb.json()
-        budget_by_cat = {str(b["category_id"]): float(b.get("limit", 0)) for b in budgets}
-
-        self.logger.info(
-            "Requesting categories for monthly analytics",
+    async def _stale(self, user_id: str, month: str, error: UpstreamUnavailableError):
+        """
+        While category-budget is unavailable, answers with the last stored
+        document instead of failing, if there is one.
+        """
+        doc = None
+        if CATEGORY_BUDGET_SERVE_STALE:
+            doc = await self.col.find_one({"user_id": user_id, "month": month}, {"_id": 1})
+        if not doc:
+            raise error
+        self.logger.warning(
+            "Monthly analytics served stale",
             extra={
-                "correlation_id": correlation_id,
-                "url": f"{CATEGORY_BUDGET_URL}/{user_id}/categories",
-                "method": "GET",
+                "correlation_id": get_correlation_id(),
+                "path": f"/{user_id}/analytics/monthly/{month}",
+                "detail": f"monthly_id={doc['_id']} error={error}",
             },
         )
-        rc = requests.get(f"{CATEGORY_BUDGET_URL}/{user_id}/categories", headers=headers, timeout=8)
-        if rc.status_code != 200:
-            try:
-                error_detail = rc.json().get("detail", rc.text)
-            except:
-                error_detail = rc.text or f"Status code: {rc.status_code}"
-            self.logger.error(
-                "Category service error",
-                extra={
-                    "correlation_id": correlation_id,
-                    "url": f"{CATEGORY_BUDGET_URL}/{user_id}/categories",
-                    "method": "GET",
-                    "status_code": rc.status_code,
-                    "detail": error_detail,
-                },
-            )
-            raise ValueError(f"Category service error ({rc.status_code}): {error_detail}")
+        return {"message": "Monthly analytics not recomputed, upstream unavailable", "monthly_id": str(doc["_id"]), "stale": True}
 
-        categories = rc.json()
+    async def generate(self, user_id: str, month: str, jwt_token: str = None):
+        if not MONTH_RE.match(month):
+            raise ValueError("month must be in YYYY-MM format")
+        # concurrent generates/recomputes of the same month share one run
+        return await generate_flight.do(
+            ("monthly", user_id, month), lambda: self._generate(user_id, month, jwt_token)
+        )
+
+    async def _generate(self, user_id: str, month: str, jwt_token: str = None):
+        correlation_id = get_correlation_id()
 
         start, end = self._month_bounds(month)
-        rows = []
+        try:
+            existing, budgets, state = await asyncio.gather(
+                self.col.find_one({"user_id": user_id, "month": month}, {"_id": 1, "fingerprint": 1}),
+                category_budget_client.get_budgets(user_id, month, jwt_token),
+                daily_spend_rollup.ensure_fresh(user_id, jwt_token, end.date()),
+            )
+        except UpstreamUnavailableError as e:
+            return await self._stale(user_id, month, e)
+        budget_by_cat = {str(b["category_id"]): float(b.get("limit", 0)) for b in budgets}
 
-        for c in categories:
-            cat_id = str(c.get("category_id"))
-            cat_name = c.get("name", "Unknown")
+        entries = await daily_spend_rollup.window(user_id, start.date(), end.date())
+        AGGREGATION_ITEMS.labels("monthly").observe(len(entries))
+        with timed(AGGREGATION_SECONDS, "monthly", phase="aggregation"):
+            fingerprint = rollup_fingerprint(state["categories"], entries, sorted(budget_by_cat.items()))
+            if existing and existing.get("fingerprint") == fingerprint:
+                return self._unchanged(user_id, month, existing["_id"])
 
-            spent = 0.0
-            for it in c.get("items", []) or []:
-                dt = self._parse_iso(it.get("created_at"))
-                if not dt:
-                    continue
-                if start <= dt < end:
-                    price = float(it.get("item_price", 0))
-                    qty = int(it.get("item_quantity", 1))
-                    spent += price * qty
+            rows = self._build_rows(state["categories"], spent_by_category(entries), budget_by_cat)
 
-            budget = float(budget_by_cat.get(cat_id, 0))
+        now = mongo_now()
+        doc = await self.col.find_one_and_update(
+            {"user_id": user_id, "month": month},
+            {
+                "$set": {"rows": rows, "fingerprint": fingerprint, "updated_at": now},
+                "$setOnInsert": {"created_at": now},
+            },
+            projection={"_id": 1, "created_at": 1},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
 
-            rows.append({
-                "category_id": cat_id,
-                "category_name": cat_name,
-                "budget": budget,
-                "spent": spent
-            })
+        analytics_cache.invalidate(("monthly", user_id, month))
+        created = doc["created_at"] == now
+        message = "Monthly analytics generated" if created else "Monthly analytics updated"
+        self.logger.info(
+            message,
+            extra={
+                "correlation_id": correlation_id,
+                "path": f"/{user_id}/analytics/monthly/generate" if created else f"/{user_id}/analytics/monthly/{month}",
+                "detail": f"monthly_id={doc['_id']}",
+            },
+        )
+        return {"message": message, "monthly_id": str(doc["_id"])}
 
-        now = datetime.now()
-        existing = self.col.find_one({"user_id": user_id, "month": month})
+    async def generate_batch(self, user_id: str, months=None, from_month: str = None,
+                             to_month: str = None, jwt_token: str = None):
+        months = self._resolve_months(months, from_month, to_month)
+        return await generate_flight.do(
+            ("monthly_batch", user_id, tuple(months)), lambda: self._generate_batch(user_id, months, jwt_token)
+        )
 
-        if existing:
-            self.col.update_one(
-                {"_id": existing["_id"]},
-                {"$set": {"rows": rows, "updated_at": now}}
-            )
-            self.logger.info(
-                "Monthly analytics updated",
-                extra={
-                    "correlation_id": correlation_id,
-                    "path": f"/{user_id}/analytics/monthly/{month}",
-                    "detail": f"monthly_id={existing['_id']}",
+    async def _generate_batch(self, user_id: str, months, jwt_token: str = None):
+        correlation_id = get_correlation_id()
+
+        first_start, _ = self._month_bounds(months[0])
+        _, last_end = self._month_bounds(months[-1])
+        fingerprints, state, *budgets_per_month = await asyncio.gather(
+            self._stored_fingerprints(user_id, months),
+            daily_spend_rollup.ensure_fresh(user_id, jwt_token, last_end.date()),
+            *(category_budget_client.get_budgets(user_id, month, jwt_token) for month in months),
+        )
+
+        # one range read for the whole batch, bucketed by month in a single pass
+        entries = await daily_spend_rollup.window(user_id, first_start.date(), last_end.date())
+        AGGREGATION_ITEMS.labels("monthly_batch").observe(len(entries))
+        now = mongo_now()
+        with timed(AGGREGATION_SECONDS, "monthly_batch", phase="aggregation"):
+            documents = self._month_documents(state["categories"], months, entries, budgets_per_month, fingerprints)
+        ops = [
+            UpdateOne(
+                {"user_id": user_id, "month": month},
+                {
+                    "$set": {"rows": rows, "fingerprint": fingerprint, "updated_at": now},
+                    "$setOnInsert": {"created_at": now},
                 },
+                upsert=True,
             )
-            return {"message": "Monthly analytics updated", "monthly_id": str(existing["_id"])}
-
-        doc = {
-            "user_id": user_id,
-            "month": month,
-            "rows": rows,
-            "created_at": now,
-            "updated_at": now
-        }
-        res = self.col.insert_one(doc)
+            for month, fingerprint, rows in documents
+        ]
+
+        generated = updated = 0
+        if ops:
+            res = await self.col.bulk_write(ops, ordered=False)
+            generated, updated = res.upserted_count, res.matched_count
+        for month in months:
+            analytics_cache.invalidate(("monthly", user_id, month))
         self.logger.info(
-            "Monthly analytics generated",
+            "Monthly analytics batch generated",
             extra={
                 "correlation_id": correlation_id,
-                "path": f"/{user_id}/analytics/monthly/generate",
-                "detail": f"monthly_id={res.inserted_id}",
+                "path": f"/{user_id}/analytics/monthly/generate/batch",
+                "detail": f"months={len(months)} upserted={generated} modified={updated}",
             },
         )
-        return {"message": "Monthly analytics generated", "monthly_id": str(res.inserted_id)}
-    
-    def generate_another(self, user_id: str, month: str):
-        requests.get("http://localhost:8080/")
+        return {
+            "message": "Monthly analytics batch generated",
+            "months": months,
+            "generated": generated,
+            "updated": updated,
+            "unchanged": len(months) - len(ops),
+        }
+
+    async def get_range(self, user_id: str, from_month: str, to_month: str, totals: bool = False):
+        """
+        Stored analytics for every month in [from_month, to_month], read with
+        one indexed range query. Validates eagerly and returns an async
+        iterator of JSON chunks: months in order as they come off the cursor,
+        then the months without a document and, with `totals`, budget and
+        spent per category summed over the range.
+        """
+        validate_month_range(from_month, to_month)
+        cursor = self.col.find(
+            {"user_id": user_id, "month": {"$gte": from_month, "$lte": to_month}}, RANGE_PROJECTION
+        ).sort("month", 1)
+        return self._stream_range(cursor, user_id, from_month, to_month, totals)
+
+    async def _stream_range(self, cursor, user_id: str, from_month: str, to_month: str, totals: bool):
+        head = {"user_id": user_id, "from": from_month, "to": to_month}
+        yield json.dumps(head)[:-1] + ', "months": ['
+
+        found = set()
+        by_cat = {}
+        async for doc in cursor:
+            rows = doc.get("rows", [])
+            item = {
+                "monthly_id": str(doc["_id"]),
+                "month": doc["month"],
+                "rows": rows,
+                "created_at": doc.get("created_at"),
+                "updated_at": doc.get("updated_at"),
+            }
+            yield ("," if found else "") + json.dumps(item, default=_json_default)
+            found.add(doc["month"])
+            if totals:
+                for row in rows:
+                    total = by_cat.setdefault(row["category_id"], {
+                        "category_id": row["category_id"], "category_name": row["category_name"],
+                        "budget": 0.0, "spent": 0.0,
+                    })
+                    # names can change over the range; report the latest one
+                    total["category_name"] = row["category_name"]
+                    total["budget"] += row.get("budget", 0.0)
+                    total["spent"] += row.get("spent", 0.0)
+
+        missing = [m for m in self._month_range(from_month, to_month, MAX_RANGE_MONTHS) if m not in found]
+        tail = {"missing": missing}
+        if totals:
+            tail["totals"] = list(by_cat.values())
+        yield "], " + json.dumps(tail)[1:]
+
+    async def generate_another(self, user_id: str, month: str):
+        async with httpx.AsyncClient() as client:
+            await client.get("http://localhost:8080/")
         
-    def get(self, user_id: str, month: str):
+    async def get_etag(self, user_id: str, month: str) -> str:
+        """ETag of the stored document, read with an _id/updated_at projection only."""
         if not MONTH_RE.match(month):
             raise ValueError("month must be in YYYY-MM format")
 
-        doc = self.col.find_one({"user_id": user_id, "month": month})
+        cached = analytics_cache.get(("monthly", user_id, month))
+        if cached is not MISSING:
+            return make_etag(cached.monthly_id, cached.updated_at)
+
+        doc = await self.col.find_one({"user_id": user_id, "month": month}, {"_id": 1, "updated_at": 1})
         if not doc:
             raise ValueError("Monthly analytics not found")
+        return make_etag(doc["_id"], doc.get("updated_at"))
 
-        return {
-            "monthly_id": str(doc["_id"]),
-            "user_id": doc["user_id"],
-            "month": doc["month"],
-            "rows": doc.get("rows", []),
-            "created_at": doc.get("created_at"),
-            "updated_at": doc.get("updated_at"),
-        }
+    async def get(self, user_id: str, month: str) -> MonthlyResponse:
+        if not MONTH_RE.match(month):
+            raise ValueError("month must be in YYYY-MM format")
+
+        key = ("monthly", user_id, month)
+        cached = analytics_cache.get(key)
+        if cached is not MISSING:
+            return cached
+        generation = analytics_cache.generation(key)
+
+        doc = await self.col.find_one({"user_id": user_id, "month": month}, MONTHLY_RESPONSE_PROJECTION)
+        if not doc:
+            raise ValueError("Monthly analytics not found")
+
+        result = MonthlyResponse.from_document(doc)
+        analytics_cache.set(key, result, generation)
+        return result
 
-    def delete(self, user_id: str, month: str):
+    async def delete(self, user_id: str, month: str):
         if not MONTH_RE.match(month):
             raise ValueError("month must be in YYYY-MM format")
 
-        res = self.col.delete_one({"user_id": user_id, "month": month})
+        res = await self.col.delete_one({"user_id": user_id, "month": month})
+        analytics_cache.invalidate(("monthly", user_id, month))
+        generate_flight.forget(("monthly", user_id, month))
         if res.deleted_count == 0:
             raise ValueError("Monthly analytics not found")
         return {"message": "Monthly analytics deleted"}
@@ -0,0 +1,236 @@
+"""
+Opt-in per-request profiling for finding out where a slow request spent
+its time.
+
+With REQUEST_PROFILING_ENABLED a request is profiled when it carries
+`X-Profile-Token: <REQUEST_PROFILING_TOKEN>`, when its path starts with a
+user id listed in REQUEST_PROFILING_USERS, or at random with
+REQUEST_PROFILING_SAMPLE_RATE. A profiled request collects a breakdown of
+upstream, Mongo, aggregation and serialization time that is attached to its
+request log record (and so published to RabbitMQ). With
+REQUEST_PROFILING_DIR set, the request also runs under pyinstrument (when
+installed) or cProfile and the full profile is written there.
+
+Disabled, nothing is registered: the middleware has no profiling path, no
+Mongo listener is installed and `record` returns on its first check.
+"""
+import asyncio
+import cProfile
+import hmac
+import logging
+import os
+import random
+import re
+import time
+from collections import defaultdict
+from contextvars import ContextVar
+from datetime import datetime
+from typing import Optional
+
+try:
+    import pyinstrument
+except ImportError:  # pragma: no cover - pyinstrument is optional
+    pyinstrument = None
+
+REQUEST_PROFILING_ENABLED = os.getenv("REQUEST_PROFILING_ENABLED", "false").lower() in ("1", "true", "yes")
+REQUEST_PROFILING_TOKEN = os.getenv("REQUEST_PROFILING_TOKEN", "")
+REQUEST_PROFILING_USERS = {u.strip() for u in os.getenv("REQUEST_PROFILING_USERS", "").split(",") if u.strip()}
+REQUEST_PROFILING_SAMPLE_RATE = float(os.getenv("REQUEST_PROFILING_SAMPLE_RATE", "0"))
+REQUEST_PROFILING_DIR = os.getenv("REQUEST_PROFILING_DIR", "")
+REQUEST_PROFILING_PROFILER = os.getenv("REQUEST_PROFILING_PROFILER", "auto")
+
+PROFILE_HEADER = "X-Profile-Token"
+PHASES = ("upstream", "mongo", "aggregation", "serialization")
+
+_current: ContextVar[Optional["RequestProfile"]] = ContextVar("request_profile", default=None)
+
+
+class RequestProfile:
+    """Summed durations and counts per phase of one profiled request."""
+
+    __slots__ = ("seconds", "calls", "started", "profiler", "profiler_name", "by_token")
+
+    def __init__(self, by_token: bool = False):
+        self.seconds = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.started = time.perf_counter()
+        self.profiler = None
+        self.profiler_name = None
+        self.by_token = by_token
+
+    def summary(self) -> dict:
+        # phases can overlap (e.g. concurrent upstream calls), so their sum
+        # may exceed the total
+        out = {"total_ms": round((time.perf_counter() - self.started) * 1000, 2)}
+        for name in PHASES:
+            out[f"{name}_ms"] = round(self.seconds[name] * 1000, 2)
+            out[f"{name}_calls"] = self.calls[name]
+        return out
+
+
+def record(phase: str, seconds: float):
+    """Adds `seconds` to `phase` of the request being profiled, if any."""
+    if not REQUEST_PROFILING_ENABLED:
+        return
+    profile = _current.get()
+    if profile is not None:
+        profile.seconds[phase] += seconds
+        profile.calls[phase] += 1
+
+
+class _Phase:
+    __slots__ = ("name", "started")
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+
+    def __exit__(self, *exc):
+        record(self.name, time.perf_counter() - self.started)
+
+
+class _NoPhase:
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc):
+        pass
+
+
+_NO_PHASE = _NoPhase()
+
+
+def phase(name: str):
+    """Context manager timing a block as `name`; a shared no-op when profiling is off."""
+    if not REQUEST_PROFILING_ENABLED or _current.get() is None:
+        return _NO_PHASE
+    return _Phase(name)
+
+
+if REQUEST_PROFILING_ENABLED:
+    from pymongo import monitoring
+
+    class MongoCommandProfiler(monitoring.CommandListener):
+        """Adds each Mongo command's duration to the profiled request that issued it."""
+
+        def started(self, event):
+            pass
+
+        def succeeded(self, event):
+            record("mongo", event.duration_micros / 1e6)
+
+        def failed(self, event):
+            record("mongo", event.duration_micros / 1e6)
+
+
+def mongo_profiling_listeners():
+    return [MongoCommandProfiler()] if REQUEST_PROFILING_ENABLED else []
+
+
+def _safe_name(value: str) -> str:
+    return re.sub(r"[^A-Za-z0-9_.-]", "_", value)[:80] or "request"
+
+
+class RequestProfiler:
+    """
+    Chooses which requests to profile and runs the full profiler for them.
+    Only one full profiler runs at a time; requests selected meanwhile get
+    the breakdown only. cProfile sees everything the event loop runs while
+    it is active, including other requests; pyinstrument follows the
+    request's own task.
+    """
+
+    def __init__(self, token: str = REQUEST_PROFILING_TOKEN, users=REQUEST_PROFILING_USERS,
+                 sample_rate: float = REQUEST_PROFILING_SAMPLE_RATE, directory: str = REQUEST_PROFILING_DIR,
+                 profiler: str = REQUEST_PROFILING_PROFILER):
+        self.logger = logging.getLogger("soa-analytics")
+        self.token = token
+        self.users = set(users)
+        self.sample_rate = sample_rate
+        self.directory = directory
+        if profiler == "auto":
+            profiler = "pyinstrument" if pyinstrument is not None else "cprofile"
+        if profiler == "pyinstrument" and pyinstrument is None:
+            self.logger.warning("pyinstrument is not installed, profiling with cProfile")
+            profiler = "cprofile"
+        self.profiler = profiler
+        self._busy = False
+        self.profiled = 0
+        self.dumped = 0
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def select(self, request) -> Optional[RequestProfile]:
+        """A started RequestProfile if `request` is to be profiled, else None."""
+        supplied = request.headers.get(PROFILE_HEADER)
+        by_token = bool(self.token and supplied and hmac.compare_digest(supplied, self.token))
+        if not by_token:
+            user_id = request.url.path.split("/", 2)[1]
+            if user_id not in self.users and not (self.sample_rate > 0 and random.random() < self.sample_rate):
+                return None
+
+        profile = RequestProfile(by_token)
+        _current.set(profile)
+        self.profiled += 1
+        if self.directory and self.profiler != "none" and not self._busy:
+            self._busy = True
+            if self.profiler == "pyinstrument":
+                profile.profiler = pyinstrument.Profiler(async_mode="enabled")
+            else:
+                profile.profiler = cProfile.Profile()
+            profile.profiler_name = self.profiler
+            try:
+                profile.profiler.start() if self.profiler == "pyinstrument" else profile.profiler.enable()
+            except (RuntimeError, ValueError) as e:
+                # another profiler is already active in this thread
+                self.logger.warning("Request profiler not started", extra={"detail": str(e)})
+                profile.profiler = profile.profiler_name = None
+                self._busy = False
+        return profile
+
+    async def finish(self, profile: RequestProfile, request, correlation_id: str) -> dict:
+        """Stops the profiler, writes the full profile if one ran and returns the breakdown."""
+        summary = profile.summary()
+        if profile.profiler is None:
+            return summary
+        try:
+            if profile.profiler_name == "pyinstrument":
+                profile.profiler.stop()
+            else:
+                profile.profiler.disable()
+        finally:
+            self._busy = False
+
+        stamp = datetime.now().strftime("%Y%m%dT%H%M%S")
+        base = f"{stamp}-{request.method}-{_safe_name(request.url.path.strip('/'))}-{_safe_name(correlation_id)}"
+        ext = "html" if profile.profiler_name == "pyinstrument" else "prof"
+        path = os.path.join(self.directory, f"{base}.{ext}")
+        try:
+            await asyncio.to_thread(self._write, profile, path)
+            summary["profile_file"] = path
+            self.dumped += 1
+        except OSError as e:
+            self.logger.warning("Failed to write request profile", extra={"detail": f"{path}: {e}"})
+        return summary
+
+    def _write(self, profile: RequestProfile, path: str):
+        if profile.profiler_name == "pyinstrument":
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(profile.profiler.output_html())
+        else:
+            profile.profiler.dump_stats(path)
+
+    @staticmethod
+    def server_timing(summary: dict) -> str:
+        """Server-Timing header value for a breakdown."""
+        parts = [f"{name};dur={summary[f'{name}_ms']}" for name in PHASES if summary[f"{name}_calls"]]
+        parts.append(f"total;dur={summary['total_ms']}")
+        return ", ".join(parts)
+
+    def stats(self):
+        return {"profiled": self.profiled, "dumped": self.dumped, "profiler": self.profiler}
+
+
+request_profiler = RequestProfiler() if REQUEST_PROFILING_ENABLED else None
@@ -0,0 +1,154 @@
+"""
+Building blocks for keeping upstream tail latency bounded: a retry budget,
+jittered backoff, a latency window for hedging delays and a circuit
+breaker. They hold no I/O; `CategoryBudgetClient` wires them together.
+"""
+import math
+import random
+import time
+from collections import deque
+from typing import Callable, Optional
+
+
+class UpstreamUnavailableError(ValueError):
+    """
+    Upstream is failing or the circuit is open. A ValueError so existing
+    handlers keep working; routes that can tell it apart answer 503 with
+    `retry_after` as Retry-After.
+    """
+
+    def __init__(self, message: str, retry_after: float = 0.0):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def backoff(attempt: int, base: float, cap: float) -> float:
+    """Full-jitter exponential backoff before retry number `attempt` (1-based)."""
+    return random.uniform(0, min(cap, base * 2 ** (attempt - 1)))
+
+
+class RetryBudget:
+    """
+    Retries (and hedged requests) may add at most `ratio` of the calls seen
+    in the last `window` seconds, plus `min_per_second` so a quiet process
+    can still retry. Keeps a failing upstream from receiving a multiple of
+    the normal load.
+    """
+
+    def __init__(self, ratio: float, min_per_second: float, window: float = 10.0):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.window = window
+        self._calls = deque()
+        self._retries = deque()
+        self.exhausted = 0
+
+    def _trim(self, now: float):
+        cutoff = now - self.window
+        for q in (self._calls, self._retries):
+            while q and q[0] < cutoff:
+                q.popleft()
+
+    def record_call(self):
+        self._calls.append(time.monotonic())
+
+    def try_spend(self) -> bool:
+        now = time.monotonic()
+        self._trim(now)
+        allowed = self.min_per_second * self.window + self.ratio * len(self._calls)
+        if len(self._retries) + 1 > allowed:
+            self.exhausted += 1
+            return False
+        self._retries.append(now)
+        return True
+
+
+class LatencyWindow:
+    """Recent successful call latencies, for the hedging delay."""
+
+    def __init__(self, size: int = 200, min_samples: int = 20):
+        self._samples = deque(maxlen=size)
+        self.min_samples = min_samples
+
+    def record(self, seconds: float):
+        self._samples.append(seconds)
+
+    def percentile(self, pct: float) -> Optional[float]:
+        if len(self._samples) < self.min_samples:
+            return None
+        ordered = sorted(self._samples)
+        k = max(0, min(len(ordered) - 1, math.ceil(pct / 100 * len(ordered)) - 1))
+        return ordered[k]
+
+
+class CircuitBreaker:
+    """
+    Consecutive-failure breaker. After `failure_threshold` failures in a row
+    it opens and rejects calls for `reset_timeout` seconds, then lets up to
+    `probes` calls through (half-open): a success closes it, a failure opens
+    it again. `on_change(state)` is called on every transition.
+    """
+
+    CLOSED = "closed"
+    HALF_OPEN = "half_open"
+    OPEN = "open"
+
+    def __init__(self, failure_threshold: int, reset_timeout: float, probes: int = 1,
+                 on_change: Callable[[str], None] = None):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.probes = max(1, probes)
+        self.on_change = on_change
+        self.state = self.CLOSED
+        self.failures = 0
+        self._opened_at = 0.0
+        self._probes_started = []
+
+    @property
+    def enabled(self) -> bool:
+        return self.failure_threshold > 0
+
+    def _set(self, state: str):
+        if state != self.state:
+            self.state = state
+            if self.on_change:
+                self.on_change(state)
+
+    def retry_after(self) -> float:
+        if self.state != self.OPEN:
+            return 0.0
+        return max(0.0, self._opened_at + self.reset_timeout - time.monotonic())
+
+    def allow(self) -> bool:
+        if not self.enabled:
+            return True
+        now = time.monotonic()
+        if self.state == self.OPEN:
+            if now < self._opened_at + self.reset_timeout:
+                return False
+            self._set(self.HALF_OPEN)
+            self._probes_started = []
+        if self.state == self.HALF_OPEN:
+            # probes that never reported back are given up on after reset_timeout
+            self._probes_started = [t for t in self._probes_started if now < t + self.reset_timeout]
+            if len(self._probes_started) >= self.probes:
+                return False
+            self._probes_started.append(now)
+        return True
+
+    def record_success(self):
+        self.failures = 0
+        self._probes_started = []
+        self._set(self.CLOSED)
+
+    def record_failure(self):
+        if not self.enabled:
+            return
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            self._opened_at = time.monotonic()
+            self._probes_started = []
+            self._set(self.OPEN)
+
+    def stats(self):
+        return {"state": self.state, "failures": self.failures, "retry_after": round(self.retry_after(), 3)}
@@ -0,0 +1,196 @@
+import hashlib
+import logging
+import os
+from datetime import date, timedelta
+from typing import Dict, List, Optional, Tuple
+
+from pymongo import DeleteMany, UpdateOne
+
+from db_two.database import get_db, mongo_now
+from logging_utils import get_correlation_id
+from services.aggregation import DailyTotalsBuilder
+from services.category_budget_client import category_budget_client
+from services.metrics import AGGREGATION_ITEMS, AGGREGATION_SECONDS, timed
+from services.singleflight import generate_flight
+
+DAILY_SPEND_SEAL_DAYS = int(os.getenv("DAILY_SPEND_SEAL_DAYS", "2"))
+
+
+def rollup_fingerprint(categories: List[dict], entries: List[dict], *extra) -> str:
+    """
+    Digest of the category list, the rollup entries of a window and any
+    `extra` values (budgets, window keys). Equal digests mean the analytics
+    document built from them would be identical.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    for c in categories:
+        h.update(f"{c['category_id']}\x1f{c['name']}\x1e".encode("utf-8"))
+    for e in sorted(entries, key=lambda e: (e["date"], e["category_id"])):
+        h.update(f"{e['date']}|{e['category_id']}|{e['spent']!r}\x1e".encode("utf-8"))
+    for value in extra:
+        h.update(repr(value).encode("utf-8"))
+    return h.hexdigest()
+
+
+class DailySpendRollup:
+    """
+    `daily_spend` holds one document per (user_id, category_id, date) with the
+    summed spend of that day. `daily_spend_state` records per user up to which
+    day the rollup is sealed, the category list and the upstream validators.
+
+    Days older than DAILY_SPEND_SEAL_DAYS are sealed on every refresh and are
+    not re-read from category-budget afterwards, so monthly/weekly generation
+    only downloads the categories payload when its window has open days.
+    """
+
+    def __init__(self):
+        self.logger = logging.getLogger("soa-analytics")
+
+    @property
+    def db(self):
+        return get_db()
+
+    @property
+    def col(self):
+        return self.db["daily_spend"]
+
+    @property
+    def state_col(self):
+        return self.db["daily_spend_state"]
+
+    def _sealed_through(self) -> str:
+        return (date.today() - timedelta(days=DAILY_SPEND_SEAL_DAYS)).isoformat()
+
+    async def _write(self, user_id: str, categories: List[dict], totals: List[Tuple[int, str, float]],
+               first_open: str, state: dict):
+        now = mongo_now()
+        ops = [
+            UpdateOne(
+                {"user_id": user_id, "category_id": categories[code]["category_id"], "date": day},
+                {"$set": {"spent": spent, "updated_at": now}},
+                upsert=True,
+            )
+            for code, day, spent in totals
+        ]
+        # upserts first, then only the open-day entries this rebuild did not
+        # write: a concurrent window() read sees old or new values, never a
+        # rollup with the open days missing
+        flt = {"user_id": user_id, "updated_at": {"$ne": now}}
+        if first_open:
+            flt["date"] = {"$gte": first_open}
+        ops.append(DeleteMany(flt))
+        await self.col.bulk_write(ops, ordered=True)
+        # rebuilt_at changes only when entries were rewritten, so it
+        # identifies the rollup's content (e.g. for cached histograms)
+        state["rebuilt_at"] = now
+        await self.state_col.update_one(
+            {"user_id": user_id}, {"$set": {**state, "refreshed_at": now}}, upsert=True
+        )
+
+    async def ensure_fresh(self, user_id: str, jwt_token: str = None, until: date = None) -> dict:
+        """
+        Makes sure every day before `until` (default: tomorrow) is current and
+        returns the user's state document. Only days after `sealed_through` are
+        rebuilt from upstream.
+        """
+        until = until or date.today() + timedelta(days=1)
+        state = await self.state_col.find_one({"user_id": user_id}, {"_id": 0})
+        last_needed = (until - timedelta(days=1)).isoformat()
+        if state and state["sealed_through"] >= last_needed:
+            return state
+        # one refresh per user at a time: it rebuilds every open day whatever
+        # `until` is, so concurrent monthly/weekly/window generates share it
+        return await generate_flight.do(
+            ("rollup", user_id), lambda: self._refresh(user_id, jwt_token, state)
+        )
+
+    async def _refresh(self, user_id: str, jwt_token: str, state: Optional[dict]) -> dict:
+        sealed_through = self._sealed_through()
+        first_open = None
+        if state:
+            first_open = (date.fromisoformat(state["sealed_through"]) + timedelta(days=1)).isoformat()
+        builder = DailyTotalsBuilder(date.fromisoformat(first_open) if first_open else None)
+        res = await category_budget_client.stream_categories(
+            user_id, builder, jwt_token, state.get("validators") if state else None
+        )
+        if res.not_modified:
+            # nothing changed upstream since the last refresh, so the open days
+            # are as current as they will get and can be sealed as they are
+            sealed_through = max(sealed_through, state["sealed_through"])
+            await self.state_col.update_one(
+                {"user_id": user_id},
+                {"$set": {"sealed_through": sealed_through, "refreshed_at": mongo_now()}},
+            )
+            return {**state, "sealed_through": sealed_through}
+
+        categories = [
+            {"category_id": cat_id, "name": name}
+            for cat_id, name in zip(builder.category_ids, builder.category_names)
+        ]
+        if state:
+            sealed_through = max(sealed_through, state["sealed_through"])
+        with timed(AGGREGATION_SECONDS, "rollup", phase="aggregation"):
+            totals = builder.totals()
+        AGGREGATION_ITEMS.labels("rollup").observe(builder.items)
+
+        new_state = {
+            "user_id": user_id,
+            "sealed_through": sealed_through,
+            "categories": categories,
+            "validators": res.validators,
+        }
+        await self._write(user_id, categories, totals, first_open, new_state)
+        self.logger.info(
+            "Daily spend rollup refreshed",
+            extra={
+                "correlation_id": get_correlation_id(),
+                "path": f"/{user_id}/analytics",
+                "detail": f"from={first_open or 'start'} items={builder.items} entries={len(totals)}",
+            },
+        )
+        return new_state
+
+    async def reset(self, user_id: str):
+        """
+        Forgets the sealed state of `user_id`, so the next refresh rebuilds
+        every day from upstream. Used when incremental updates were missed.
+        """
+        await self.state_col.delete_one({"user_id": user_id})
+
+    async def touch(self, user_id: str, now):
+        """
+        Records that entries of `user_id` were changed outside a refresh (an
+        incremental update), so every process sees a new `rebuilt_at` and
+        rebuilds its cached histogram.
+        """
+        await self.state_col.update_one({"user_id": user_id}, {"$set": {"rebuilt_at": now}})
+
+    async def window(self, user_id: str, start: date, end: date) -> List[dict]:
+        """Rollup entries with start <= date < end (indexed range query)."""
+        return await self.col.find(
+            {"user_id": user_id, "date": {"$gte": start.isoformat(), "$lt": end.isoformat()}},
+            {"_id": 0, "category_id": 1, "date": 1, "spent": 1},
+        ).to_list()
+
+    async def entries(self, user_id: str) -> List[dict]:
+        """Every rollup entry of `user_id` (index prefix on user_id)."""
+        return await self.col.find(
+            {"user_id": user_id}, {"_id": 0, "category_id": 1, "date": 1, "spent": 1}
+        ).to_list()
+
+
+def spent_by_category(entries: List[dict]) -> Dict[str, float]:
+    totals: Dict[str, float] = {}
+    for e in entries:
+        totals[e["category_id"]] = totals.get(e["category_id"], 0.0) + e["spent"]
+    return totals
+
+
+def spent_by_date(entries: List[dict]) -> Dict[str, float]:
+    totals: Dict[str, float] = {}
+    for e in entries:
+        totals[e["date"]] = totals.get(e["date"], 0.0) + e["spent"]
+    return totals
+
+
+daily_spend_rollup = DailySpendRollup()
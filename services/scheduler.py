@@ -0,0 +1,221 @@
+"""
+Off-peak precomputation of last-7-days and current-month analytics.
+
+Runs inside the app (enabled via SCHEDULER_ENABLED, started from the
+lifespan) or as a one-off job:
+
+    python -m services.scheduler --once [--users u1,u2] [--concurrency 4]
+"""
+import argparse
+import asyncio
+import logging
+import os
+import random
+import time
+from datetime import datetime, timedelta
+from typing import Iterable, List, Optional
+from uuid import uuid4
+
+
+from db_two.database import close_db, get_db
+from logging_utils import correlation_id_var, stop_log_shipping
+from services.auth_service import auth_service
+from services.category_budget_client import category_budget_client
+from services.monthly_service import MonthlyService
+from services.resilience import UpstreamUnavailableError
+from services.weekly_service import WeeklyService
+
+SCHEDULER_ENABLED = os.getenv("SCHEDULER_ENABLED", "false").lower() in ("1", "true", "yes")
+SCHEDULER_RUN_AT = os.getenv("SCHEDULER_RUN_AT", "00:15")
+SCHEDULER_CONCURRENCY = int(os.getenv("SCHEDULER_CONCURRENCY", "4"))
+SCHEDULER_RATE_LIMIT = float(os.getenv("SCHEDULER_RATE_LIMIT", "10"))
+SCHEDULER_JITTER = float(os.getenv("SCHEDULER_JITTER", "300"))
+SCHEDULER_TOKEN_TTL = int(os.getenv("SCHEDULER_TOKEN_TTL", "300"))
+
+# upstream calls per user: categories for the daily rollup, budgets for monthly
+CALLS_PER_USER = 2
+
+
+class RateLimiter:
+    """
+    Token bucket limiting upstream calls per second within this process. It
+    is not shared between workers, which is why only one instance should run
+    the scheduler.
+    """
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.capacity = max(rate, 1.0)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, tokens: float = 1.0):
+        if self.rate <= 0:
+            return
+        tokens = min(tokens, self.capacity)
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                await asyncio.sleep((tokens - self._tokens) / self.rate)
+
+
+class PrecomputeScheduler:
+    def __init__(self, concurrency: int = SCHEDULER_CONCURRENCY, rate_limit: float = SCHEDULER_RATE_LIMIT,
+                 run_at: str = SCHEDULER_RUN_AT, jitter: float = SCHEDULER_JITTER):
+        self.logger = logging.getLogger("soa-analytics")
+        self.monthly_service = MonthlyService()
+        self.weekly_service = WeeklyService()
+        self.concurrency = max(1, concurrency)
+        self.rate_limit = rate_limit
+        self.run_at = run_at
+        self.jitter = jitter
+        self._task: Optional[asyncio.Task] = None
+
+        self.running = False
+        self.runs = 0
+        self.users_total = 0
+        self.users_done = 0
+        self.users_failed = 0
+        self.last_run_started: Optional[datetime] = None
+        self.last_run_finished: Optional[datetime] = None
+        self.last_run_seconds: Optional[float] = None
+
+    async def _known_users(self) -> List[str]:
+        db = get_db()
+        users = set(await db["weekly_data"].distinct("user_id"))
+        users.update(await db["monthly_data"].distinct("user_id"))
+        return sorted(users)
+
+    async def _refresh_user(self, user_id: str, month: str, limiter: RateLimiter, sem: asyncio.Semaphore):
+        async with sem:
+            if self.jitter > 0:
+                # small per-user jitter so workers don't hit upstream in lockstep
+                await asyncio.sleep(random.uniform(0, min(self.jitter, 1.0)))
+            await limiter.acquire(CALLS_PER_USER)
+            correlation_id_var.set(f"scheduler-{uuid4()}")
+            try:
+                token = auth_service.create_service_token(user_id, SCHEDULER_TOKEN_TTL)
+                results = [
+                    await self.weekly_service.generate_last7days(user_id, token),
+                    await self.monthly_service.generate(user_id, month, token),
+                ]
+                # a stale answer means upstream was unavailable and nothing was refreshed
+                if any(r.get("stale") for r in results):
+                    raise UpstreamUnavailableError("category-budget unavailable, served stale")
+                self.users_done += 1
+            except Exception as e:
+                self.users_failed += 1
+                self.logger.error(
+                    "Scheduled precompute failed",
+                    extra={"path": f"/{user_id}/analytics", "detail": str(e)},
+                )
+
+    async def run_once(self, users: Optional[Iterable[str]] = None):
+        """Regenerates last-7-days and current-month analytics for every known user."""
+        if users is None:
+            users = await self._known_users()
+        users = list(users)
+        month = datetime.now().strftime("%Y-%m")
+
+        self.running = True
+        self.users_total = len(users)
+        self.users_done = 0
+        self.users_failed = 0
+        self.last_run_started = datetime.now()
+        started = time.perf_counter()
+        self.logger.info("Scheduled precompute started", extra={"detail": f"users={len(users)}"})
+
+        limiter = RateLimiter(self.rate_limit)
+        sem = asyncio.Semaphore(self.concurrency)
+        try:
+            await asyncio.gather(*(self._refresh_user(u, month, limiter, sem) for u in users))
+        finally:
+            self.running = False
+            self.runs += 1
+            self.last_run_finished = datetime.now()
+            self.last_run_seconds = time.perf_counter() - started
+            self.logger.info(
+                "Scheduled precompute finished",
+                extra={"detail": f"done={self.users_done} failed={self.users_failed} seconds={self.last_run_seconds:.1f}"},
+            )
+
+    def _seconds_until_next_run(self) -> float:
+        hour, minute = (int(part) for part in self.run_at.split(":"))
+        now = datetime.now()
+        next_run = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+        if next_run <= now:
+            next_run += timedelta(days=1)
+        return (next_run - now).total_seconds() + random.uniform(0, self.jitter)
+
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(self._seconds_until_next_run())
+            try:
+                await self.run_once()
+            except Exception as e:
+                self.logger.error("Scheduled precompute crashed", extra={"detail": str(e)})
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self):
+        return {
+            "running": self.running,
+            "runs": self.runs,
+            "users_total": self.users_total,
+            "users_done": self.users_done,
+            "users_failed": self.users_failed,
+            "last_run_started": self.last_run_started,
+            "last_run_finished": self.last_run_finished,
+            "last_run_seconds": self.last_run_seconds,
+        }
+
+
+precompute_scheduler = PrecomputeScheduler()
+
+
+async def _main(args):
+    scheduler = PrecomputeScheduler(concurrency=args.concurrency, rate_limit=args.rate_limit, jitter=0)
+    users = args.users.split(",") if args.users else None
+    auth_service.check_service_secret()
+    try:
+        if args.once:
+            await scheduler.run_once(users)
+        else:
+            scheduler.start()
+            await scheduler._task
+    finally:
+        await category_budget_client.close()
+        await close_db()
+        stop_log_shipping()
+    print(scheduler.stats())
+
+
+if __name__ == "__main__":
+    from logging_utils import setup_logging, start_log_shipping
+
+    parser = argparse.ArgumentParser(description="Precompute last-7-days and current-month analytics.")
+    parser.add_argument("--once", action="store_true", help="run a single pass and exit")
+    parser.add_argument("--users", help="comma separated user ids (default: every known user)")
+    parser.add_argument("--concurrency", type=int, default=SCHEDULER_CONCURRENCY)
+    parser.add_argument("--rate-limit", type=float, default=SCHEDULER_RATE_LIMIT,
+                        help="upstream calls per second, 0 disables the limit")
+    setup_logging("soa-analytics")
+    start_log_shipping()
+    asyncio.run(_main(parser.parse_args()))
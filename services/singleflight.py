@@ -0,0 +1,84 @@
+import asyncio
+import os
+import time
+from typing import Any, Awaitable, Callable, Hashable
+
+from services.metrics import SINGLEFLIGHT_CALLS
+
+SINGLEFLIGHT_ENABLED = os.getenv("SINGLEFLIGHT_ENABLED", "true").lower() in ("1", "true", "yes")
+SINGLEFLIGHT_REUSE_SECONDS = float(os.getenv("SINGLEFLIGHT_REUSE_SECONDS", "0"))
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key into one computation.
+
+    The first caller for a key (the leader) starts `fn()` as a task; callers
+    arriving while it runs await the same task and get its result or its
+    exception. A successful result is also handed out for `reuse_seconds`
+    after it completes. Keys are tuples whose first element is the kind used
+    as the metrics label.
+
+    The task is shielded, so a caller that disconnects does not cancel the
+    computation for the others.
+    """
+
+    def __init__(self, reuse_seconds: float = 0.0, enabled: bool = True):
+        self.reuse_seconds = reuse_seconds
+        self.enabled = enabled
+        self._inflight: "dict[Hashable, asyncio.Future]" = {}
+        self._recent: "dict[Hashable, tuple]" = {}
+        self.leaders = 0
+        self.coalesced = 0
+        self.reused = 0
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        if not self.enabled:
+            return await fn()
+        kind = key[0] if isinstance(key, tuple) else "-"
+
+        recent = self._recent.get(key)
+        if recent is not None:
+            if recent[0] > time.monotonic():
+                self.reused += 1
+                SINGLEFLIGHT_CALLS.labels(kind, "reused").inc()
+                return recent[1]
+            del self._recent[key]
+
+        task = self._inflight.get(key)
+        if task is not None:
+            self.coalesced += 1
+            SINGLEFLIGHT_CALLS.labels(kind, "coalesced").inc()
+            return await asyncio.shield(task)
+
+        self.leaders += 1
+        SINGLEFLIGHT_CALLS.labels(kind, "leader").inc()
+        task = asyncio.ensure_future(fn())
+        self._inflight[key] = task
+        task.add_done_callback(lambda t: self._done(key, t))
+        return await asyncio.shield(task)
+
+    def _done(self, key: Hashable, task: asyncio.Future):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        if self.reuse_seconds > 0 and not task.cancelled() and task.exception() is None:
+            self._recent[key] = (time.monotonic() + self.reuse_seconds, task.result())
+        if len(self._recent) > 1000:
+            now = time.monotonic()
+            for k in [k for k, (expires_at, _) in self._recent.items() if expires_at <= now]:
+                del self._recent[k]
+
+    def forget(self, key: Hashable):
+        """Drops a reusable result, e.g. after the document was deleted."""
+        self._recent.pop(key, None)
+
+    def stats(self):
+        return {
+            "in_flight": len(self._inflight),
+            "leaders": self.leaders,
+            "coalesced": self.coalesced,
+            "reused": self.reused,
+        }
+
+
+generate_flight = SingleFlight(SINGLEFLIGHT_REUSE_SECONDS, SINGLEFLIGHT_ENABLED)
@@ -0,0 +1,109 @@
+import logging
+from db_two.database import get_db
+from services.monthly_service import validate_month_range
+
+MAX_TOP_CATEGORIES = 50
+
+
+def _utilization(spent, budget):
+    """spent / budget, null for categories without a budget."""
+    return {"$cond": [{"$gt": [budget, 0]}, {"$divide": [spent, budget]}, None]}
+
+
+class SummaryService:
+    """
+    Cross-month summaries computed by MongoDB aggregation pipelines over
+    `monthly_data.rows`. Every pipeline starts with a `{user_id, month}`
+    range $match and a month $sort, both served by `user_month_unique`, so
+    only the summary is sent back and no rows are touched in Python.
+    """
+
+    def __init__(self):
+        self.logger = logging.getLogger("soa-analytics")
+
+    @property
+    def db(self):
+        return get_db()
+
+    @property
+    def col(self):
+        return self.db["monthly_data"]
+
+    def _months(self, user_id: str, from_month: str, to_month: str):
+        validate_month_range(from_month, to_month)
+        return [
+            {"$match": {"user_id": user_id, "month": {"$gte": from_month, "$lte": to_month}}},
+            {"$sort": {"month": 1}},
+        ]
+
+    def _by_category(self):
+        return [
+            {"$project": {"_id": 0, "rows": 1}},
+            {"$unwind": "$rows"},
+            {"$group": {
+                "_id": "$rows.category_id",
+                # input is in month order, so this is the latest name
+                "category_name": {"$last": "$rows.category_name"},
+                "budget": {"$sum": "$rows.budget"},
+                "spent": {"$sum": "$rows.spent"},
+                "months": {"$sum": 1},
+                "over_budget_months": {"$sum": {"$cond": [
+                    {"$and": [{"$gt": ["$rows.budget", 0]}, {"$gt": ["$rows.spent", "$rows.budget"]}]}, 1, 0,
+                ]}},
+                "overspent": {"$sum": {"$cond": [
+                    {"$gt": ["$rows.budget", 0]},
+                    {"$max": [{"$subtract": ["$rows.spent", "$rows.budget"]}, 0]},
+                    0,
+                ]}},
+            }},
+        ]
+
+    def _category_fields(self):
+        return {
+            "_id": 0,
+            "category_id": "$_id",
+            "category_name": 1,
+            "budget": 1,
+            "spent": 1,
+            "utilization": _utilization("$spent", "$budget"),
+            "months": 1,
+            "over_budget_months": 1,
+            "overspent": 1,
+        }
+
+    async def categories(self, user_id: str, from_month: str, to_month: str):
+        """Budget, spent and utilization per category summed over the range, by spent desc."""
+        pipeline = self._months(user_id, from_month, to_month) + self._by_category() + [
+            {"$sort": {"spent": -1, "_id": 1}},
+            {"$project": self._category_fields()},
+        ]
+        categories = await (await self.col.aggregate(pipeline)).to_list()
+        return {"user_id": user_id, "from": from_month, "to": to_month, "categories": categories}
+
+    async def over_budget(self, user_id: str, from_month: str, to_month: str, limit: int = 5):
+        """Categories that went over budget in the range, by total overspend desc."""
+        if limit < 1 or limit > MAX_TOP_CATEGORIES:
+            raise ValueError(f"limit must be between 1 and {MAX_TOP_CATEGORIES}")
+        pipeline = self._months(user_id, from_month, to_month) + self._by_category() + [
+            {"$match": {"overspent": {"$gt": 0}}},
+            {"$sort": {"overspent": -1, "_id": 1}},
+            {"$limit": limit},
+            {"$project": self._category_fields()},
+        ]
+        categories = await (await self.col.aggregate(pipeline)).to_list()
+        return {"user_id": user_id, "from": from_month, "to": to_month, "categories": categories}
+
+    async def trend(self, user_id: str, from_month: str, to_month: str):
+        """Total budget, spent and utilization per month, in month order."""
+        pipeline = self._months(user_id, from_month, to_month) + [
+            {"$project": {
+                "_id": 0,
+                "month": 1,
+                "budget": {"$sum": "$rows.budget"},
+                "spent": {"$sum": "$rows.spent"},
+                "categories": {"$size": {"$ifNull": ["$rows", []]}},
+            }},
+            {"$addFields": {"utilization": _utilization("$spent", "$budget")}},
+        ]
+        months = await (await self.col.aggregate(pipeline)).to_list()
+        return {"user_id": user_id, "from": from_month, "to": to_month, "months": months}
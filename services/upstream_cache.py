@@ -0,0 +1,240 @@
+"""
+Short-lived cache of category-budget response bodies, shared by everything
+in the process that talks to the category-budget client.
+
+Entries are keyed by (user_id, endpoint, month) and hold the raw body plus
+its validators. The in-memory part is an LRU bounded by total body bytes;
+with UPSTREAM_CACHE_DIR set, entries are also written there so other
+workers on the host and restarted workers can reuse them until they expire.
+
+Invalidating a user also records the time in Mongo
+(`upstream_cache_invalidations`). Every hit checks it, so entries fetched
+before the invalidation are dropped in every worker and replica, not only in
+the one that handled it.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+from pymongo.errors import PyMongoError
+
+from db_two.database import get_db
+from services.metrics import UPSTREAM_CACHE_LOOKUPS
+
+UPSTREAM_CACHE_ENABLED = os.getenv("UPSTREAM_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+UPSTREAM_CACHE_TTL = float(os.getenv("UPSTREAM_CACHE_TTL", "30"))
+UPSTREAM_CACHE_MAX_BYTES = int(os.getenv("UPSTREAM_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+UPSTREAM_CACHE_MAX_ENTRY_BYTES = int(os.getenv("UPSTREAM_CACHE_MAX_ENTRY_BYTES", str(8 * 1024 * 1024)))
+UPSTREAM_CACHE_DIR = os.getenv("UPSTREAM_CACHE_DIR", "")
+
+CacheKey = Tuple[str, str, Optional[str]]
+
+
+class CachedResponse:
+    __slots__ = ("body", "validators", "expires_at", "fetched_at")
+
+    def __init__(self, body: bytes, validators: dict, expires_at: float, fetched_at: float = 0.0):
+        self.body = body
+        self.validators = validators
+        self.expires_at = expires_at
+        # when the request for the body was sent; anything invalidated
+        # after that may be missing from it
+        self.fetched_at = fetched_at
+
+
+def _user_prefix(user_id: str) -> str:
+    return hashlib.blake2b(user_id.encode("utf-8"), digest_size=12).hexdigest()
+
+
+def _file_name(key: CacheKey) -> str:
+    user_id, endpoint, month = key
+    return f"{_user_prefix(user_id)}-{endpoint}-{month or '_'}.bin"
+
+
+class UpstreamCache:
+    """
+    TTL + byte-bounded LRU of upstream bodies with an optional disk store.
+    Expiry uses wall-clock time so disk entries stay valid across processes.
+    """
+
+    def __init__(self, ttl: float, max_bytes: int, max_entry_bytes: int,
+                 directory: str = "", enabled: bool = True):
+        self.logger = logging.getLogger("soa-analytics")
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = min(max_entry_bytes, max_bytes)
+        self.directory = directory
+        self.enabled = enabled and ttl > 0 and max_bytes > 0
+        self._data: "OrderedDict[CacheKey, CachedResponse]" = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if self.enabled and directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def accepts(self, size: int) -> bool:
+        """Whether a body of `size` bytes would be cached at all."""
+        return self.enabled and size <= self.max_entry_bytes
+
+    @property
+    def invalidations(self):
+        return get_db()["upstream_cache_invalidations"]
+
+    async def _invalidated_since(self, user_id: str, entry: CachedResponse) -> bool:
+        """Whether `user_id` was invalidated (by any process) after `entry` was fetched."""
+        try:
+            doc = await self.invalidations.find_one({"user_id": user_id}, {"_id": 0, "at": 1})
+        except PyMongoError as e:
+            # cannot tell, so the entry is not trusted
+            self.logger.warning("Upstream cache invalidations unreadable", extra={"detail": str(e)})
+            return True
+        return doc is not None and doc["at"] >= entry.fetched_at
+
+    async def get(self, key: CacheKey) -> Optional[CachedResponse]:
+        if not self.enabled:
+            return None
+        endpoint = key[1]
+        entry = self._data.get(key)
+        if entry is not None and entry.expires_at <= time.time():
+            self._drop(key)
+            entry = None
+        result = "hit"
+        if entry is None and self.directory:
+            entry = await asyncio.to_thread(self._read_file, key)
+            result = "disk_hit"
+        if entry is not None and await self._invalidated_since(key[0], entry):
+            self._drop(key)
+            entry = None
+        if entry is not None:
+            if result == "hit":
+                self._data.move_to_end(key)
+                self.hits += 1
+            else:
+                self._put(key, entry)
+                self.disk_hits += 1
+            UPSTREAM_CACHE_LOOKUPS.labels(endpoint, result).inc()
+            return entry
+
+        self.misses += 1
+        UPSTREAM_CACHE_LOOKUPS.labels(endpoint, "miss").inc()
+        return None
+
+    async def set(self, key: CacheKey, body: bytes, validators: dict, fetched_at: Optional[float] = None):
+        """Caches `body`; `fetched_at` is when its request was sent (default: now)."""
+        if not self.accepts(len(body)):
+            return
+        now = time.time()
+        entry = CachedResponse(body, validators, now + self.ttl, fetched_at if fetched_at is not None else now)
+        self._put(key, entry)
+        if self.directory:
+            await asyncio.to_thread(self._write_file, key, entry)
+
+    async def invalidate(self, user_id: str):
+        """
+        Drops every cached response of `user_id`, in memory and on disk, and
+        records the invalidation so other processes drop theirs on lookup.
+        """
+        if not self.enabled:
+            return
+        at = time.time()
+        for key in [k for k in self._data if k[0] == user_id]:
+            self._drop(key)
+        if self.directory:
+            await asyncio.to_thread(self._remove_files, _user_prefix(user_id))
+        await self.invalidations.update_one({"user_id": user_id}, {"$max": {"at": at}}, upsert=True)
+
+    def clear(self):
+        self._data.clear()
+        self._bytes = 0
+
+    def _put(self, key: CacheKey, entry: CachedResponse):
+        self._drop(key)
+        self._data[key] = entry
+        self._bytes += len(entry.body)
+        while self._bytes > self.max_bytes:
+            _, old = self._data.popitem(last=False)
+            self._bytes -= len(old.body)
+            self.evictions += 1
+
+    def _drop(self, key: CacheKey):
+        old = self._data.pop(key, None)
+        if old is not None:
+            self._bytes -= len(old.body)
+
+    # disk store: one file per key, a JSON header line followed by the body
+
+    def _read_file(self, key: CacheKey) -> Optional[CachedResponse]:
+        path = os.path.join(self.directory, _file_name(key))
+        try:
+            with open(path, "rb") as f:
+                header = json.loads(f.readline())
+                if header["expires_at"] <= time.time():
+                    entry = None
+                else:
+                    entry = CachedResponse(
+                        f.read(), header["validators"], header["expires_at"], header.get("fetched_at", 0.0)
+                    )
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError) as e:
+            self.logger.warning("Unreadable upstream cache file", extra={"detail": f"{path}: {e}"})
+            entry = None
+        if entry is None:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        return entry
+
+    def _write_file(self, key: CacheKey, entry: CachedResponse):
+        path = os.path.join(self.directory, _file_name(key))
+        tmp = f"{path}.{os.getpid()}.tmp"
+        header = json.dumps(
+            {"expires_at": entry.expires_at, "fetched_at": entry.fetched_at, "validators": entry.validators}
+        )
+        try:
+            with open(tmp, "wb") as f:
+                f.write(header.encode("utf-8") + b"\n")
+                f.write(entry.body)
+            os.replace(tmp, path)
+        except OSError as e:
+            self.logger.warning("Failed to write upstream cache file", extra={"detail": f"{path}: {e}"})
+
+    def _remove_files(self, prefix: str):
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return
+        for name in names:
+            if name.startswith(prefix + "-"):
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError:
+                    pass
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        return {
+            "size": len(self._data),
+            "bytes": self._bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+upstream_cache = UpstreamCache(
+    UPSTREAM_CACHE_TTL, UPSTREAM_CACHE_MAX_BYTES, UPSTREAM_CACHE_MAX_ENTRY_BYTES,
+    UPSTREAM_CACHE_DIR, UPSTREAM_CACHE_ENABLED,
+)
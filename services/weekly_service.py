@@ -1,136 +1,153 @@
+import asyncio
 import logging
-import os
-import requests
 from datetime import datetime, timedelta
-from db_two.database import get_db
+from pymongo import ReturnDocument
+from db_two.database import get_db, mongo_now
 from logging_utils import get_correlation_id
-
-CATEGORY_BUDGET_URL = os.getenv("CATEGORY_BUDGET_URL", "http://localhost:8002").rstrip("/")
+from models.weekly_model import WEEKLY_RESPONSE_PROJECTION, WeeklyResponse
+from services.cache import MISSING, analytics_cache
+from services.category_budget_client import CATEGORY_BUDGET_SERVE_STALE
+from services.etag import make_etag
+from services.metrics import AGGREGATION_ITEMS, AGGREGATION_SECONDS, timed
+from services.resilience import UpstreamUnavailableError
+from services.rollup_service import daily_spend_rollup, rollup_fingerprint, spent_by_date
+from services.singleflight import generate_flight
 
 class WeeklyService:
     def __init__(self):
         self.logger = logging.getLogger("soa-analytics")
-        self.db = get_db()
-        self.col = self.db["weekly_data"]
 
-    def _parse_iso(self, s):
-        try:
-            return datetime.fromisoformat(str(s).replace("Z", "+00:00"))
-        except Exception:
-            return None
+    @property
+    def db(self):
+        return get_db()
 
-    def generate_last7days(self, user_id: str, jwt_token: str = None):
+    @property
+    def col(self):
+        return self.db["weekly_data"]
+
+    def _unchanged(self, user_id: str, weekly_id):
+        self.logger.info(
+            "Weekly analytics unchanged",
+            extra={
+                "correlation_id": get_correlation_id(),
+                "path": f"/{user_id}/analytics/weekly/last7/recompute",
+                "detail": f"weekly_id={weekly_id}",
+            },
+        )
+        return {"message": "Weekly analytics unchanged", "weekly_id": str(weekly_id)}
+
+    async def _stale(self, user_id: str, error: UpstreamUnavailableError):
+        """
+        While category-budget is unavailable, answers with the last stored
+        document instead of failing, if there is one.
+        """
+        doc = None
+        if CATEGORY_BUDGET_SERVE_STALE:
+            doc = await self.col.find_one({"user_id": user_id, "type": "last7days"}, {"_id": 1})
+        if not doc:
+            raise error
+        self.logger.warning(
+            "Weekly analytics served stale",
+            extra={
+                "correlation_id": get_correlation_id(),
+                "path": f"/{user_id}/analytics/weekly/last7/recompute",
+                "detail": f"weekly_id={doc['_id']} error={error}",
+            },
+        )
+        return {"message": "Weekly analytics not recomputed, upstream unavailable", "weekly_id": str(doc["_id"]), "stale": True}
+
+    def _window_start(self) -> datetime:
         today = datetime.now()
-        start = (today - timedelta(days=6)).replace(hour=0, minute=0, second=0, microsecond=0)
-        end = (today + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+        return (today - timedelta(days=6)).replace(hour=0, minute=0, second=0, microsecond=0)
 
+    async def generate_last7days(self, user_id: str, jwt_token: str = None):
+        start = self._window_start()
+        # keyed by the window start so a run straddling midnight is not reused for the next day
+        return await generate_flight.do(
+            ("weekly", user_id, start.strftime("%Y-%m-%d")), lambda: self._generate_last7days(user_id, start, jwt_token)
+        )
+
+    async def _generate_last7days(self, user_id: str, start: datetime, jwt_token: str = None):
         keys = []
         for i in range(7):
             keys.append((start + timedelta(days=i)).strftime("%Y-%m-%d"))
 
-        spent_by_day = {k: 0.0 for k in keys}
-
-        headers = {}
         correlation_id = get_correlation_id()
-        if correlation_id:
-            headers["X-Correlation-Id"] = correlation_id
-        if jwt_token:
-            headers["Authorization"] = f"Bearer {jwt_token}"
 
-        self.logger.info(
-            "Requesting categories for weekly analytics",
-            extra={
-                "correlation_id": correlation_id,
-                "url": f"{CATEGORY_BUDGET_URL}/{user_id}/categories",
-                "method": "GET",
+        end = start + timedelta(days=len(keys))
+        try:
+            existing, state = await asyncio.gather(
+                self.col.find_one({"user_id": user_id, "type": "last7days"}, {"_id": 1, "fingerprint": 1}),
+                daily_spend_rollup.ensure_fresh(user_id, jwt_token, end.date()),
+            )
+        except UpstreamUnavailableError as e:
+            return await self._stale(user_id, e)
+
+        entries = await daily_spend_rollup.window(user_id, start.date(), end.date())
+        AGGREGATION_ITEMS.labels("weekly").observe(len(entries))
+        with timed(AGGREGATION_SECONDS, "weekly", phase="aggregation"):
+            fingerprint = rollup_fingerprint(state["categories"], entries, keys)
+            if existing and existing.get("fingerprint") == fingerprint:
+                return self._unchanged(user_id, existing["_id"])
+
+            spent = spent_by_date(entries)
+            days = [{"date": k, "spent": spent.get(k, 0.0)} for k in keys]
+
+        now = mongo_now()
+        doc = await self.col.find_one_and_update(
+            {"user_id": user_id, "type": "last7days"},
+            {
+                "$set": {"days": days, "fingerprint": fingerprint, "updated_at": now},
+                "$setOnInsert": {"created_at": now},
             },
+            projection={"_id": 1, "created_at": 1},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
         )
-        rc = requests.get(f"{CATEGORY_BUDGET_URL}/{user_id}/categories", headers=headers, timeout=8)
-        if rc.status_code != 200:
-            try:
-                error_detail = rc.json().get("detail", rc.text)
-            except:
-                error_detail = rc.text or f"Status code: {rc.status_code}"
-            self.logger.error(
-                "Category service error",
-                extra={
-                    "correlation_id": correlation_id,
-                    "url": f"{CATEGORY_BUDGET_URL}/{user_id}/categories",
-                    "method": "GET",
-                    "status_code": rc.status_code,
-                    "detail": error_detail,
-                },
-            )
-            raise ValueError(f"Category service error ({rc.status_code}): {error_detail}")
-
-        categories = rc.json()
-
-        for c in categories:
-            for it in c.get("items", []) or []:
-                dt = self._parse_iso(it.get("created_at"))
-                if not dt:
-                    continue
-                if start <= dt < end:
-                    k = dt.strftime("%Y-%m-%d")
-                    if k in spent_by_day:
-                        price = float(it.get("item_price", 0))
-                        qty = int(it.get("item_quantity", 1))
-                        spent_by_day[k] += price * qty
-
-        days = [{"date": k, "spent": spent_by_day[k]} for k in keys]
-
-        now = datetime.now()
-        existing = self.col.find_one({"user_id": user_id, "type": "last7days"})
-
-        if existing:
-            self.col.update_one(
-                {"_id": existing["_id"]},
-                {"$set": {"days": days, "updated_at": now}}
-            )
-            self.logger.info(
-                "Weekly analytics updated",
-                extra={
-                    "correlation_id": correlation_id,
-                    "path": f"/{user_id}/analytics/weekly/last7/recompute",
-                    "detail": f"weekly_id={existing['_id']}",
-                },
-            )
-            return {"message": "Weekly analytics updated", "weekly_id": str(existing["_id"])}
-
-        doc = {
-            "user_id": user_id,
-            "type": "last7days",
-            "days": days,
-            "created_at": now,
-            "updated_at": now
-        }
-        res = self.col.insert_one(doc)
+
+        analytics_cache.invalidate(("weekly", user_id, "last7days"))
+        created = doc["created_at"] == now
+        message = "Weekly analytics generated" if created else "Weekly analytics updated"
         self.logger.info(
-            "Weekly analytics generated",
+            message,
             extra={
                 "correlation_id": correlation_id,
-                "path": f"/{user_id}/analytics/weekly/last7/generate",
-                "detail": f"weekly_id={res.inserted_id}",
+                "path": f"/{user_id}/analytics/weekly/last7/generate" if created else f"/{user_id}/analytics/weekly/last7/recompute",
+                "detail": f"weekly_id={doc['_id']}",
             },
         )
-        return {"message": "Weekly analytics generated", "weekly_id": str(res.inserted_id)}
+        return {"message": message, "weekly_id": str(doc["_id"])}
+
+    async def get_last7days_etag(self, user_id: str) -> str:
+        """ETag of the stored document, read with an _id/updated_at projection only."""
+        cached = analytics_cache.get(("weekly", user_id, "last7days"))
+        if cached is not MISSING:
+            return make_etag(cached.weekly_id, cached.updated_at)
 
-    def get_last7days(self, user_id: str):
-        doc = self.col.find_one({"user_id": user_id, "type": "last7days"})
+        doc = await self.col.find_one({"user_id": user_id, "type": "last7days"}, {"_id": 1, "updated_at": 1})
         if not doc:
             raise ValueError("Weekly analytics not found")
+        return make_etag(doc["_id"], doc.get("updated_at"))
+
+    async def get_last7days(self, user_id: str) -> WeeklyResponse:
+        key = ("weekly", user_id, "last7days")
+        cached = analytics_cache.get(key)
+        if cached is not MISSING:
+            return cached
+        generation = analytics_cache.generation(key)
+
+        doc = await self.col.find_one({"user_id": user_id, "type": "last7days"}, WEEKLY_RESPONSE_PROJECTION)
+        if not doc:
+            raise ValueError("Weekly analytics not found")
+
+        result = WeeklyResponse.from_document(doc)
+        analytics_cache.set(key, result, generation)
+        return result
 
-        return {
-            "weekly_id": str(doc["_id"]),
-            "user_id": doc["user_id"],
-            "type": doc.get("type", "last7days"),
-            "days": doc.get("days", []),
-            "created_at": doc.get("created_at"),
-            "updated_at": doc.get("updated_at"),
-        }
-
-    def delete_last7days(self, user_id: str):
-        res = self.col.delete_one({"user_id": user_id, "type": "last7days"})
+    async def delete_last7days(self, user_id: str):
+        res = await self.col.delete_one({"user_id": user_id, "type": "last7days"})
+        analytics_cache.invalidate(("weekly", user_id, "last7days"))
+        generate_flight.forget(("weekly", user_id, self._window_start().strftime("%Y-%m-%d")))
         if res.deleted_count == 0:
             raise ValueError("Weekly analytics not found")
         return {"message": "Weekly analytics deleted"}
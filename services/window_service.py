@@ -0,0 +1,247 @@
+import asyncio
+import logging
+import os
+import re
+from datetime import date, timedelta
+from typing import Optional, Tuple
+from pymongo import ReturnDocument
+from db_two.database import get_db, mongo_now
+from logging_utils import get_correlation_id
+from models.window_model import WINDOW_RESPONSE_PROJECTION, WindowResponse
+from services.cache import MISSING, TTLCache, analytics_cache
+from services.category_budget_client import CATEGORY_BUDGET_SERVE_STALE
+from services.etag import make_etag
+from services.histogram import DailyHistogram
+from services.metrics import AGGREGATION_ITEMS, AGGREGATION_SECONDS, timed
+from services.resilience import UpstreamUnavailableError
+from services.rollup_service import daily_spend_rollup, rollup_fingerprint
+from services.singleflight import generate_flight
+
+DAY_RE = re.compile(r"^\d{4}-\d{2}-\d{2}$")
+WINDOW_MAX_DAYS = int(os.getenv("WINDOW_MAX_DAYS", "366"))
+WINDOW_HISTOGRAM_CACHE_SIZE = int(os.getenv("WINDOW_HISTOGRAM_CACHE_SIZE", "1000"))
+WINDOW_HISTOGRAM_CACHE_TTL = float(os.getenv("WINDOW_HISTOGRAM_CACHE_TTL", "300"))
+
+# user_id -> (daily_spend_state.rebuilt_at, DailyHistogram)
+histogram_cache = TTLCache(WINDOW_HISTOGRAM_CACHE_SIZE, WINDOW_HISTOGRAM_CACHE_TTL)
+
+
+def _parse_day(value: str) -> date:
+    if not DAY_RE.match(value or ""):
+        raise ValueError("date must be in YYYY-MM-DD format")
+    try:
+        return date.fromisoformat(value)
+    except ValueError:
+        raise ValueError("date must be in YYYY-MM-DD format")
+
+
+def resolve_window(from_day: Optional[str] = None, to_day: Optional[str] = None, last: Optional[int] = None,
+                   today: Optional[date] = None) -> Tuple[date, date]:
+    """
+    First and last day (inclusive) of a window given either as `from`/`to`
+    or as the `last` N days up to and including today.
+    """
+    if last is not None:
+        if from_day or to_day:
+            raise ValueError("Give either from and to or last, not both")
+        if last < 1 or last > WINDOW_MAX_DAYS:
+            raise ValueError(f"last must be between 1 and {WINDOW_MAX_DAYS}")
+        end = today or date.today()
+        return end - timedelta(days=last - 1), end
+    if not from_day or not to_day:
+        raise ValueError("Give either from and to or last")
+    start, end = _parse_day(from_day), _parse_day(to_day)
+    if start > end:
+        raise ValueError("from must not be after to")
+    if (end - start).days + 1 > WINDOW_MAX_DAYS:
+        raise ValueError(f"At most {WINDOW_MAX_DAYS} days can be read at once")
+    return start, end
+
+
+def window_key(start: date, end: date) -> str:
+    return f"{start.isoformat()}..{end.isoformat()}"
+
+
+class WindowService:
+    """
+    Analytics over any range of days, stored in `window_data` keyed by
+    (user_id, window, category_id). Every window is answered from the
+    user's DailyHistogram, which is built from the `daily_spend` rollup once
+    per rollup refresh and kept in `histogram_cache`.
+    """
+
+    def __init__(self):
+        self.logger = logging.getLogger("soa-analytics")
+
+    @property
+    def db(self):
+        return get_db()
+
+    @property
+    def col(self):
+        return self.db["window_data"]
+
+    def _filter(self, user_id: str, window: str, category_id: Optional[str]):
+        return {"user_id": user_id, "window": window, "category_id": category_id}
+
+    async def histogram(self, user_id: str, state: dict) -> DailyHistogram:
+        """The user's histogram for the rollup described by `state`."""
+        stamp = state.get("rebuilt_at")
+        cached = histogram_cache.get(user_id)
+        if cached is not MISSING and cached[0] == stamp:
+            return cached[1]
+        return await generate_flight.do(
+            ("histogram", user_id, stamp), lambda: self._build_histogram(user_id, state)
+        )
+
+    async def _build_histogram(self, user_id: str, state: dict) -> DailyHistogram:
+        stamp = state.get("rebuilt_at")
+        generation = histogram_cache.generation(user_id)
+        entries = await daily_spend_rollup.entries(user_id)
+        AGGREGATION_ITEMS.labels("histogram").observe(len(entries))
+        with timed(AGGREGATION_SECONDS, "histogram", phase="aggregation"):
+            # the state's categories are the ones a window reports, so its
+            # spent equals the sum of its categories
+            histogram = DailyHistogram.from_entries(entries, [c["category_id"] for c in state["categories"]])
+        histogram_cache.set(user_id, (stamp, histogram), generation)
+        return histogram
+
+    def _unchanged(self, user_id: str, window_id):
+        self.logger.info(
+            "Window analytics unchanged",
+            extra={
+                "correlation_id": get_correlation_id(),
+                "path": f"/{user_id}/analytics/window/recompute",
+                "detail": f"window_id={window_id}",
+            },
+        )
+        return {"message": "Window analytics unchanged", "window_id": str(window_id)}
+
+    async def _stale(self, user_id: str, flt: dict, error: UpstreamUnavailableError):
+        """
+        While category-budget is unavailable, answers with the last stored
+        document instead of failing, if there is one.
+        """
+        doc = None
+        if CATEGORY_BUDGET_SERVE_STALE:
+            doc = await self.col.find_one(flt, {"_id": 1})
+        if not doc:
+            raise error
+        self.logger.warning(
+            "Window analytics served stale",
+            extra={
+                "correlation_id": get_correlation_id(),
+                "path": f"/{user_id}/analytics/window/recompute",
+                "detail": f"window_id={doc['_id']} error={error}",
+            },
+        )
+        return {"message": "Window analytics not recomputed, upstream unavailable", "window_id": str(doc["_id"]), "stale": True}
+
+    async def generate(self, user_id: str, start: date, end: date, category_id: str = None, jwt_token: str = None):
+        window = window_key(start, end)
+        return await generate_flight.do(
+            ("window", user_id, window, category_id),
+            lambda: self._generate(user_id, start, end, category_id, jwt_token),
+        )
+
+    async def _generate(self, user_id: str, start: date, end: date, category_id: str = None, jwt_token: str = None):
+        window = window_key(start, end)
+        flt = self._filter(user_id, window, category_id)
+        stop = end + timedelta(days=1)
+        correlation_id = get_correlation_id()
+
+        try:
+            existing, state = await asyncio.gather(
+                self.col.find_one(flt, {"_id": 1, "fingerprint": 1}),
+                daily_spend_rollup.ensure_fresh(user_id, jwt_token, stop),
+            )
+        except UpstreamUnavailableError as e:
+            return await self._stale(user_id, flt, e)
+
+        names = {c["category_id"]: c["name"] for c in state["categories"]}
+        if category_id is not None and category_id not in names:
+            raise ValueError("Category not found")
+
+        histogram = await self.histogram(user_id, state)
+        with timed(AGGREGATION_SECONDS, "window", phase="aggregation"):
+            days = [{"date": d, "spent": spent} for d, spent in histogram.daily(start, stop, category_id)]
+            by_category = histogram.by_category(start, stop)
+            categories = [
+                {"category_id": cat_id, "category_name": name, "spent": by_category.get(cat_id, 0.0)}
+                for cat_id, name in names.items()
+                if category_id is None or cat_id == category_id
+            ]
+            spent = histogram.total(start, stop, category_id)
+            fingerprint = rollup_fingerprint(state["categories"], [], window, category_id, days, categories)
+            if existing and existing.get("fingerprint") == fingerprint:
+                return self._unchanged(user_id, existing["_id"])
+
+        now = mongo_now()
+        doc = await self.col.find_one_and_update(
+            flt,
+            {
+                "$set": {
+                    "start": start.isoformat(),
+                    "end": end.isoformat(),
+                    "spent": spent,
+                    "days": days,
+                    "categories": categories,
+                    "fingerprint": fingerprint,
+                    "updated_at": now,
+                },
+                "$setOnInsert": {"created_at": now},
+            },
+            projection={"_id": 1, "created_at": 1},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+
+        analytics_cache.invalidate(("window", user_id, window, category_id))
+        created = doc["created_at"] == now
+        message = "Window analytics generated" if created else "Window analytics updated"
+        self.logger.info(
+            message,
+            extra={
+                "correlation_id": correlation_id,
+                "path": f"/{user_id}/analytics/window/generate" if created else f"/{user_id}/analytics/window/recompute",
+                "detail": f"window_id={doc['_id']} window={window}",
+            },
+        )
+        return {"message": message, "window_id": str(doc["_id"]), "window": window}
+
+    async def get_etag(self, user_id: str, start: date, end: date, category_id: str = None) -> str:
+        """ETag of the stored document, read with an _id/updated_at projection only."""
+        window = window_key(start, end)
+        cached = analytics_cache.get(("window", user_id, window, category_id))
+        if cached is not MISSING:
+            return make_etag(cached.window_id, cached.updated_at)
+
+        doc = await self.col.find_one(self._filter(user_id, window, category_id), {"_id": 1, "updated_at": 1})
+        if not doc:
+            raise ValueError("Window analytics not found")
+        return make_etag(doc["_id"], doc.get("updated_at"))
+
+    async def get(self, user_id: str, start: date, end: date, category_id: str = None) -> WindowResponse:
+        window = window_key(start, end)
+        key = ("window", user_id, window, category_id)
+        cached = analytics_cache.get(key)
+        if cached is not MISSING:
+            return cached
+        generation = analytics_cache.generation(key)
+
+        doc = await self.col.find_one(self._filter(user_id, window, category_id), WINDOW_RESPONSE_PROJECTION)
+        if not doc:
+            raise ValueError("Window analytics not found")
+
+        result = WindowResponse.from_document(doc)
+        analytics_cache.set(key, result, generation)
+        return result
+
+    async def delete(self, user_id: str, start: date, end: date, category_id: str = None):
+        window = window_key(start, end)
+        res = await self.col.delete_one(self._filter(user_id, window, category_id))
+        analytics_cache.invalidate(("window", user_id, window, category_id))
+        generate_flight.forget(("window", user_id, window, category_id))
+        if res.deleted_count == 0:
+            raise ValueError("Window analytics not found")
+        return {"message": "Window analytics deleted"}
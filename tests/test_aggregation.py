@@ -0,0 +1,111 @@
+"""
+The NumPy columnar path of services.aggregation must give exactly the same
+daily totals as the pure-Python fallback used when NumPy is not installed.
+
+    python -m pytest tests
+"""
+from datetime import date, datetime
+
+import pytest
+
+from benchmarks.synthetic import make_categories
+from services import aggregation
+from services.aggregation import DailyTotalsBuilder, daily_totals, to_columns
+from services.category_stream import fold_categories
+
+pytestmark = pytest.mark.skipif(not aggregation.HAS_NUMPY, reason="numpy is not installed")
+
+
+def _item(created_at, price=1.0, quantity=1):
+    return {"created_at": created_at, "item_price": price, "item_quantity": quantity}
+
+
+EDGE_CASES = {
+    "empty": [],
+    "no_items": [{"category_id": "c1", "name": "Food", "items": []}, {"category_id": "c2", "name": "Fun"}],
+    "bad_dates": [{"category_id": "c1", "name": "Food", "items": [
+        _item("2025-03-01T10:00:00"),
+        _item("not-a-date"),
+        _item(""),
+        _item(None),
+        _item("2024-13-45T00:00:00"),
+        _item("2025"),
+        _item("2025-03"),
+        _item("1741000000"),
+        _item("2025-03-01"),
+        _item("2025-03-01T23:30:00Z"),
+        _item("2025-03-01T23:30:00-05:00"),
+        _item("2025-03-02T00:30:00+02:00"),
+    ]}],
+    "bad_numbers": [{"category_id": "c1", "name": "Food", "items": [
+        _item("2025-03-01T10:00:00", "2.5", "2"),
+        _item("2025-03-01T11:00:00", "n/a", 1),
+        _item("2025-03-01T12:00:00", 3, "n/a"),
+        _item("2025-03-01T13:00:00", None, None),
+        _item("2025-03-01T14:00:00", 4, 2.9),
+        _item("2025-03-01T15:00:00", 4, "2.9"),
+        {"created_at": "2025-03-01T16:00:00"},
+    ]}],
+    "float_rounding": [
+        {"category_id": "c1", "name": "Food", "items": [_item("2025-03-01T10:00:00", 0.1) for _ in range(10)]
+         + [_item("2025-03-01T11:00:00", 19.99, 3), _item("2025-03-02T11:00:00", 1e-9), _item("2025-03-02T12:00:00", 1e9)]},
+        {"category_id": "c2", "name": "Fun", "items": [_item("2025-03-01T10:00:00", 0.7, 3), _item("2025-03-01T10:00:00", 0.2)]},
+    ],
+}
+
+
+def _synthetic():
+    return make_categories(
+        categories=5, items_per_category=400, days=60, malformed=0.05, end=datetime(2025, 12, 31, 23, 59, 59),
+        seed=7, bad_timestamps=0.05, aware=0.2,
+    )
+
+
+CASES = {**EDGE_CASES, "synthetic": _synthetic()}
+
+
+def _both(monkeypatch, fn):
+    """fn() with the NumPy path, then with the pure-Python fallback."""
+    with_numpy = fn()
+    with monkeypatch.context() as m:
+        m.setattr(aggregation, "HAS_NUMPY", False)
+        without_numpy = fn()
+    return with_numpy, without_numpy
+
+
+@pytest.mark.parametrize("since", [None, date(2025, 3, 2), date(2025, 12, 1)])
+@pytest.mark.parametrize("name", sorted(CASES))
+def test_daily_totals_numpy_matches_python(monkeypatch, name, since):
+    with_numpy, without_numpy = _both(monkeypatch, lambda: daily_totals(to_columns(CASES[name]), since))
+    assert with_numpy == without_numpy
+
+
+@pytest.mark.parametrize("batch_size", [1, 3, 1000])
+@pytest.mark.parametrize("name", sorted(CASES))
+def test_builder_numpy_matches_python(monkeypatch, name, batch_size):
+    def build():
+        builder = fold_categories(DailyTotalsBuilder(batch_size=batch_size), CASES[name])
+        return builder.category_ids, builder.totals()
+
+    with_numpy, without_numpy = _both(monkeypatch, build)
+    assert with_numpy == without_numpy
+
+
+@pytest.mark.parametrize("name", sorted(CASES))
+def test_builder_matches_daily_totals(name):
+    builder = fold_categories(DailyTotalsBuilder(batch_size=50), CASES[name])
+    expected = daily_totals(to_columns(CASES[name]))
+    assert [(code, day) for code, day, _ in builder.totals()] == [(code, day) for code, day, _ in expected]
+    # batches are summed separately, so only the order of additions differs
+    for (_, _, got), (_, _, want) in zip(builder.totals(), expected):
+        assert got == pytest.approx(want, rel=1e-12, abs=1e-12)
+
+
+def test_edge_case_values():
+    assert daily_totals(to_columns(EDGE_CASES["empty"])) == []
+    assert daily_totals(to_columns(EDGE_CASES["no_items"])) == []
+    # aware timestamps are converted to UTC days; partial dates are rejected
+    assert daily_totals(to_columns(EDGE_CASES["bad_dates"])) == [(0, "2025-03-01", 4.0), (0, "2025-03-02", 1.0)]
+    # quantities are truncated, unparseable numbers drop the item and a
+    # missing price counts as 0
+    assert daily_totals(to_columns(EDGE_CASES["bad_numbers"])) == [(0, "2025-03-01", 5.0 + 8.0 + 8.0)]